@@ -4,7 +4,7 @@ Web API
 import logging
 from flask import Flask
 from ..json import JsonEncoder
-from . import config
+from . import config, datastore
 from .routes import blueprints
 
 
@@ -17,6 +17,15 @@ def create_app():
 
     app.json_encoder = JsonEncoder # type: ignore
 
+    datastore.configure_pool(
+        role_switching   = app.config["DATASTORE_ROLE_SWITCHING"],
+        verifier_ttl     = app.config["DATASTORE_VERIFIER_TTL"],
+        max_size         = app.config["DATASTORE_POOL_MAX_SIZE"],
+        max_idle         = app.config["DATASTORE_POOL_MAX_IDLE"],
+        idle_timeout     = app.config["DATASTORE_POOL_IDLE_TIMEOUT"],
+        checkout_timeout = app.config["DATASTORE_POOL_CHECKOUT_TIMEOUT"],
+        ping_after       = app.config["DATASTORE_POOL_PING_AFTER"])
+
     for blueprint in blueprints:
         app.register_blueprint(blueprint)
 
@@ -2,9 +2,35 @@
 Flask app config values.
 """
 from os import environ
+from typing import Any, Callable, List, Tuple
 
-variables = [
+
+def boolean(value) -> bool:
+    """
+    Converts an environment variable *value* to a boolean.
+
+    >>> boolean("yes"), boolean("1"), boolean("True")
+    (True, True, True)
+    >>> boolean("no"), boolean("0"), boolean(""), boolean(False)
+    (False, False, False, False)
+    """
+    return str(value).strip().lower() in {"1", "true", "yes", "on"}
+
+
+variables: List[Tuple[str, Callable[[Any], Any], Any]] = [
     ("MAX_CONTENT_LENGTH", int, 20 * 1024**2),  # 20MB
+
+    # Database session pool; see id3c.db.pool.DatabaseSessionPool
+    ("DATASTORE_POOL_MAX_SIZE", int, 20),
+    ("DATASTORE_POOL_MAX_IDLE", int, 4),
+    ("DATASTORE_POOL_IDLE_TIMEOUT", float, 300),
+    ("DATASTORE_POOL_CHECKOUT_TIMEOUT", float, 10),
+    ("DATASTORE_POOL_PING_AFTER", float, 30),
+
+    # Share pooled sessions of a service user amongst API users by switching
+    # roles; see id3c.db.pool.RoleSwitchingSessionPool
+    ("DATASTORE_ROLE_SWITCHING", boolean, False),
+    ("DATASTORE_VERIFIER_TTL", float, 300),
 ]
 
 def from_environ() -> dict:
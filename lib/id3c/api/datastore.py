@@ -8,9 +8,10 @@ from psycopg2 import DataError, DatabaseError, IntegrityError, ProgrammingError,
 from psycopg2.errors import InsufficientPrivilege
 from typing import Any
 from uuid import UUID
-from werkzeug.exceptions import Forbidden, NotFound, Conflict
+from werkzeug.exceptions import Forbidden, NotFound, Conflict, ServiceUnavailable
 from .. import db
-from ..db import find_identifier, upsert_sample
+from ..db import find_identifier, find_identifiers, upsert_sample
+from ..db.pool import DatabaseSessionPool, PoolTimeoutError, RoleSwitchingSessionPool
 from ..db.session import DatabaseSession
 from .exceptions import AuthenticationRequired, BadRequest
 from .utils import export
@@ -18,6 +19,11 @@ from .utils import export
 
 LOG = logging.getLogger(__name__)
 
+# Sessions are pooled by credentials so that requests from the same user reuse
+# warm connections instead of paying for connection setup, TLS, and
+# authentication every time.  Reconfigured by :func:`configure_pool`.
+POOL = DatabaseSessionPool()
+
 
 def catch_permission_denied(function):
     """
@@ -37,22 +43,71 @@ def catch_permission_denied(function):
     return decorated
 
 
+@export
+def configure_pool(*, role_switching: bool = False, **settings) -> None:
+    """
+    Replaces the session pool used by :func:`login` with a new
+    :class:`~id3c.db.pool.DatabaseSessionPool` created with the given keyword
+    *settings*.
+
+    If *role_switching* is true, a
+    :class:`~id3c.db.pool.RoleSwitchingSessionPool` is used instead, which
+    logs in as the service user configured by the environment and switches
+    to each request's user with ``SET ROLE``.
+
+    Idle sessions in the previous pool are closed.
+    """
+    global POOL
+
+    if role_switching:
+        pool: DatabaseSessionPool = RoleSwitchingSessionPool(**settings)
+    else:
+        settings.pop("verifier_ttl", None)
+        pool = DatabaseSessionPool(**settings)
+
+    previous, POOL = POOL, pool
+    previous.close()
+
+
 @export
 def login(username: str, password: str) -> DatabaseSession:
     """
-    Creates a new database session authenticated as the given user.
+    Obtains a database session authenticated as the given user, reusing a
+    pooled session for the same credentials if one is available.
 
     Returns an opaque session object which other functions in this module
-    require.
+    require.  The session must be handed back with :func:`logout` when the
+    caller is done with it.
+
+    Raises a :class:`~werkzeug.exceptions.ServiceUnavailable` exception if
+    the pool is exhausted.
     """
     LOG.debug(f"Logging into PostgreSQL database as '{username}'")
 
     try:
-        return DatabaseSession(username = username, password = password)
+        session = POOL.checkout(username = username, password = password)
 
     except DatabaseError as error:
         raise AuthenticationRequired() from None
 
+    except PoolTimeoutError as error:
+        LOG.error(f"Unable to login as '{username}': {error}")
+        raise ServiceUnavailable() from None
+
+    LOG.debug(f"Session pool stats: {POOL.stats()}")
+
+    return session
+
+
+@export
+def logout(session: DatabaseSession) -> None:
+    """
+    Hands the *session* obtained from :func:`login` back to the pool.
+
+    Any uncommitted changes are rolled back.
+    """
+    POOL.release(session)
+
 
 @export
 @catch_permission_denied
@@ -230,7 +285,9 @@ def verify_barcode_use_list(session: DatabaseSession, barcode_use_list: list) ->
             left join warehouse.identifier on q.barcode::citext = identifier.barcode \
             left join warehouse.identifier_set using (identifier_set_id)".format(args_str)
 
-    result = session.fetch_all(sql, tuple(barcode_use_tuples))
+    with session.read_only() as reader:
+        result = reader.fetch_all(sql, tuple(barcode_use_tuples))
+
     return result
 
 
@@ -252,8 +309,8 @@ def fetch_identifier(session: DatabaseSession, id: str) -> Any:
     except ValueError:
         id_field = "barcode"
 
-    with session:
-        identifier = session.fetch_row(f"""
+    with session.read_only() as reader:
+        identifier = reader.fetch_row(f"""
             select uuid, barcode, generated, identifier_set.name as set, identifier_set.use
               from warehouse.identifier
               join warehouse.identifier_set using (identifier_set_id)
@@ -276,7 +333,7 @@ def fetch_identifier_sets(session: DatabaseSession) -> Any:
     Returns a list of named tuples with ``name``, ``description``, and ``use``
     attributes.
     """
-    with session, session.cursor() as cursor:
+    with session.read_only() as reader, reader.cursor() as cursor:
         cursor.execute("""
             select name, description, use
               from warehouse.identifier_set
@@ -420,8 +477,8 @@ def get_sample(session: DatabaseSession, barcode: str, barcode_type: str) -> Any
     raises a :class:`~werkzeug.exceptions.Conflict` exception.
     """
 
-    with session:
-        identifier = find_identifier(session, barcode) or None
+    with session.read_only() as reader:
+        identifier = find_identifier(reader, barcode) or None
 
         if not identifier:
             LOG.info(f"Identifier barcode «{barcode}» not found")
@@ -444,7 +501,7 @@ def get_sample(session: DatabaseSession, barcode: str, barcode_type: str) -> Any
             where {field} = %s
             """).format(field=identifier_field)
 
-        sample = session.fetch_row(query, (identifier.uuid,))
+        sample = reader.fetch_row(query, (identifier.uuid,))
 
     if not sample:
         raise NotFound(f"Sample record with {identifier.set_use} identifier barcode «{barcode}» not found")
@@ -464,9 +521,11 @@ def store_sample(session: DatabaseSession, sample: dict) -> Any:
     """
     with session:
         sample_barcode = sample.pop("sample_id", None)
-        sample_identifier = find_identifier(session, sample_barcode) if sample_barcode else None
         collection_barcode = sample.pop("collection_id", None)
-        collection_identifier = find_identifier(session, collection_barcode) if collection_barcode else None
+
+        identifiers = find_identifiers(session, [sample_barcode, collection_barcode])
+        sample_identifier = identifiers.get(sample_barcode) if sample_barcode else None
+        collection_identifier = identifiers.get(collection_barcode) if collection_barcode else None
 
         access_role = sample.pop("access_role", None)
 
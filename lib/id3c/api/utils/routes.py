@@ -18,7 +18,8 @@ def authenticated_datastore_session_required(route):
     the :class:`~id3c.api.datastore`.
 
     The logged in datastore *session* is provided as a keyword-argument to the
-    original route.
+    original route and logged out of (i.e. returned to the pool) when the route
+    returns.
 
     Raises a :class:`id3c.api.exceptions.AuthenticationRequired`
     exception if the request doesn't provide an ``Authorization`` header.
@@ -34,7 +35,10 @@ def authenticated_datastore_session_required(route):
             username = auth.username,
             password = auth.password)
 
-        return route(*args, **kwargs, session = session)
+        try:
+            return route(*args, **kwargs, session = session)
+        finally:
+            datastore.logout(session)
 
     return wrapped_route
 
@@ -8,12 +8,14 @@ import pickle
 from contextlib import contextmanager
 from functools import wraps
 from sys import maxsize
+from time import monotonic
 from typing import Iterator, Optional
 
 import click
 from cachetools import TTLCache
 
 from id3c.cli.redcap import Project
+from id3c.db.copy import Checkpoint, copy_ndjson_chunks, ndjson_chunks
 from id3c.db.session import DatabaseSession
 
 __all__ = [
@@ -54,7 +56,7 @@ class DatabaseSessionAction(enum.Enum):
     COMMIT = "commit"
 
 
-def with_database_session(command=None, *, pass_action: bool = False):
+def with_database_session(command=None, *, pass_action: bool = False, periodic_commits: bool = False):
     """
     Decorator to provide database session and error handling for a *command*.
 
@@ -67,6 +69,10 @@ def with_database_session(command=None, *, pass_action: bool = False):
     *command* (``--dry-run``, ``--prompt``, and ``--commit``) to control this
     behaviour.
 
+    Two more options (``--profile-queries`` and ``--profile-queries-output``)
+    enable per-statement timing of the session (see :py:mod:`id3c.db.profile`)
+    and report the slowest statements when the *command* finishes.
+
     >>> @click.command
     ... @with_database_session
     ... def cmd(db: DatabaseSession):
@@ -83,6 +89,20 @@ def with_database_session(command=None, *, pass_action: bool = False):
 
     One example where this is useful is when the *command* accesses
     non-database resources and wants to extend dry run mode to them as well.
+
+    If the optional, keyword-only argument *periodic_commits* is ``True``, two
+    more options (``--commit-every`` and ``--commit-interval``) set the
+    session's :attr:`~id3c.db.session.DatabaseSession.commit_every` and
+    :attr:`~id3c.db.session.DatabaseSession.commit_interval` with
+    ``--commit``, so that a long run can commit as it goes wherever the
+    *command* calls :meth:`~id3c.db.session.DatabaseSession.commit_if_due`.
+    They're ignored for a dry run and can't be used with ``--prompt``.
+
+    If the *command* is invoked with a
+    :class:`~id3c.db.session.DatabaseSession` as its context object (e.g.
+    ``command.main(args, obj = db)``), that session is used instead of a new
+    one.  A caller which runs the *command* repeatedly, like ``id3c etl run
+    --follow``, then keeps its connection and the caches scoped to it.
     """
 
     def decorator(command):
@@ -108,9 +128,46 @@ def with_database_session(command=None, *, pass_action: bool = False):
             flag_value=DatabaseSessionAction("commit"),
             type=DatabaseSessionAction,
         )
+        @click.option(
+            "--profile-queries",
+            metavar="[<n>]",
+            type=click.IntRange(min=1),
+            is_flag=False,
+            flag_value=20,
+            help="Time database statements and print the <n> (default 20) "
+            "slowest by total time when finished",
+        )
+        @click.option(
+            "--profile-queries-output",
+            metavar="<file.json>",
+            type=click.File("w"),
+            help="Time database statements and write all of them to <file.json> "
+            "when finished",
+        )
         @wraps(command)
-        def decorated(*args, action, **kwargs):
-            db = DatabaseSession()
+        def decorated(
+            *args, action, profile_queries, profile_queries_output, **kwargs
+        ):
+            commit_every = kwargs.pop("commit_every", None)
+            commit_interval = kwargs.pop("commit_interval", None)
+
+            if (commit_every or commit_interval) and action is DatabaseSessionAction.PROMPT:
+                raise click.UsageError(
+                    "--commit-every and --commit-interval can't be used with --prompt"
+                )
+
+            db = click.get_current_context().find_object(DatabaseSession)
+
+            if db is None:
+                db = DatabaseSession(
+                    profile=bool(profile_queries or profile_queries_output)
+                )
+
+            if action is DatabaseSessionAction.COMMIT:
+                db.commit_every = commit_every
+                db.commit_interval = commit_interval
+            else:
+                db.commit_every = db.commit_interval = None
 
             kwargs["db"] = db
 
@@ -157,6 +214,31 @@ def with_database_session(command=None, *, pass_action: bool = False):
                     )
                     db.rollback()
 
+                if db.profile:
+                    if profile_queries:
+                        click.echo(db.profile.report(profile_queries), err=True)
+
+                    if profile_queries_output:
+                        db.profile.dump(profile_queries_output)
+
+        if periodic_commits:
+            decorated = click.option(
+                "--commit-interval",
+                metavar="<seconds>",
+                type=click.FloatRange(min=0, min_open=True),
+                help="With --commit, also commit once <seconds> have passed "
+                "since the last commit, at the next record boundary",
+            )(decorated)
+
+            decorated = click.option(
+                "--commit-every",
+                metavar="<n>",
+                type=click.IntRange(min=1),
+                help="With --commit, commit after every <n> records instead of "
+                "only at the end, so locks are released and work is kept if "
+                "the run fails later",
+            )(decorated)
+
         return decorated
 
     return decorator(command) if command else decorator
@@ -277,3 +359,109 @@ def pickled_cache(
         if filename:
             with open(filename, "wb") as file:
                 pickle.dump(cache, file)
+
+
+def with_ndjson_upload_options(command):
+    """
+    Decorator to add options controlling :py:func:`.upload_ndjson` to a
+    *command*.
+
+    The *command* callable must be a :py:class:`click.Command` instance.  It's
+    called with ``chunk_size``, ``checkpoint``, and ``jobs`` keyword arguments,
+    which should be passed along to :py:func:`.upload_ndjson`.
+
+    >>> @click.command
+    ... @with_ndjson_upload_options
+    ... def cmd(chunk_size, checkpoint, jobs):
+    ...     pass
+    """
+
+    @click.option(
+        "--chunk-size",
+        metavar="<rows>",
+        type=click.IntRange(min=1),
+        help="Commit after every <rows> documents instead of once at the end.  "
+        "An interrupted upload then only loses the chunk in progress.",
+    )
+    @click.option(
+        "--checkpoint",
+        metavar="<file>",
+        type=click.Path(dir_okay=False),
+        help="Record the byte offsets of committed chunks in <file> and skip "
+        "them when resuming an interrupted upload.  Requires --chunk-size.",
+    )
+    @click.option(
+        "--jobs",
+        metavar="<n>",
+        type=click.IntRange(min=1),
+        default=1,
+        show_default=True,
+        help="Copy up to <n> chunks concurrently using separate database "
+        "sessions.  Documents may then be received out of file order.  "
+        "Requires --chunk-size.",
+    )
+    @wraps(command)
+    def decorated(*args, chunk_size, checkpoint, jobs, **kwargs):
+        if not chunk_size and (checkpoint or jobs > 1):
+            raise click.UsageError("--checkpoint and --jobs require --chunk-size")
+
+        return command(
+            *args, chunk_size=chunk_size, checkpoint=checkpoint, jobs=jobs, **kwargs
+        )
+
+    return decorated
+
+
+def upload_ndjson(
+    qualified_column: tuple,
+    document_file,
+    *,
+    chunk_size: Optional[int] = None,
+    checkpoint: Optional[str] = None,
+    jobs: int = 1,
+) -> int:
+    """
+    Upload newline-delimited JSON documents from the binary *document_file*
+    into *qualified_column* (see
+    :py:meth:`~id3c.db.session.DatabaseSession.copy_from_ndjson`).
+
+    Without a *chunk_size*, all documents are copied and committed in a single
+    transaction.  Otherwise, documents are committed in chunks as described by
+    :py:func:`.with_ndjson_upload_options`.
+
+    Returns the number of documents uploaded.
+    """
+    source = getattr(document_file, "path", document_file.name)
+
+    LOG.info(f"Copying documents from {source}")
+
+    if chunk_size:
+        resume = Checkpoint(checkpoint, str(source))
+
+        return copy_ndjson_chunks(
+            qualified_column,
+            ndjson_chunks(document_file, chunk_size, resume),
+            resume,
+            jobs=jobs,
+        )
+
+    db = DatabaseSession()
+    started = monotonic()
+
+    try:
+        row_count = db.copy_from_ndjson(qualified_column, document_file)
+
+        elapsed = monotonic() - started
+        LOG.info(
+            f"Copied {row_count:,} documents in {elapsed:,.0f}s, "
+            f"{row_count / max(elapsed, 1e-3):,.0f} documents/s"
+        )
+        LOG.info("Committing all changes")
+        db.commit()
+
+    except:
+        LOG.info("Rolling back all changes; the database will not be modified")
+        db.rollback()
+        raise
+
+    return row_count
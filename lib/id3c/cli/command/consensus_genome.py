@@ -5,7 +5,8 @@ import click
 import logging
 import json
 from id3c.cli import cli
-from id3c.db.session import DatabaseSession
+from id3c.cli.command import upload_ndjson, with_ndjson_upload_options
+from id3c.cli.io import LocalOrRemoteFile
 
 
 LOG = logging.getLogger(__name__)
@@ -17,27 +18,18 @@ def consensus_genome():
 @consensus_genome.command("upload")
 @click.argument("consensus_genome-file",
     metavar = "<consensus_genome.ndjson>",
-    type = click.File("r"))
+    type = LocalOrRemoteFile("rb", compression = "infer"))
 
-def upload(consensus_genome_file):
+@with_ndjson_upload_options
+
+def upload(consensus_genome_file, **options):
     """
     Upload consensus genomes and summary statistics to the warehouse receiving area.
 
     Consensus genomes and summary statistics should be in newline-delimited JSON
-    format that matches those generated by the assembly pipeline.
+    format that matches those generated by the assembly pipeline, optionally
+    compressed.
     """
-    db = DatabaseSession()
-
-    try:
-        LOG.info(f"Copying consensus genome records from {consensus_genome_file.name}")
-
-        row_count = db.copy_from_ndjson(("receiving", "consensus_genome", "document"), consensus_genome_file)
-
-        LOG.info(f"Received {row_count:,} consensus genome records")
-        LOG.info("Committing all changes")
-        db.commit()
+    row_count = upload_ndjson(("receiving", "consensus_genome", "document"), consensus_genome_file, **options)
 
-    except:
-        LOG.info("Rolling back all changes; the database will not be modified")
-        db.rollback()
-        raise
+    LOG.info(f"Received {row_count:,} consensus genome records")
@@ -3,16 +3,32 @@ Run ETL routines
 """
 import click
 import logging
+import multiprocessing
+import re
+from collections import Counter
+from contextlib import contextmanager
 from math import ceil
-from typing import Any, Dict, Optional
+from queue import Empty as QueueEmpty
+from more_itertools import chunked
+from psycopg2.extensions import TRANSACTION_STATUS_INTRANS
+from psycopg2.sql import SQL, Identifier, Literal
+from typing import Any, Callable, Collection, ContextManager, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple, TypeVar
+from weakref import WeakKeyDictionary
+from id3c.db import content_digest, find_identifiers, update_content_digest
+from id3c.db.copy import Checkpoint
 from id3c.db.session import DatabaseSession
-from id3c.db.datatypes import Json
+from id3c.db.datatypes import Json, as_json
 from id3c.cli import cli
+from id3c.cli.command import DatabaseSessionAction
 from id3c.db.types import MinimalSampleRecord
+from . import ledger
+from .ledger import with_run_ledger
 
 
 LOG = logging.getLogger(__name__)
 
+T = TypeVar("T")
+
 
 @cli.group("etl", help = __doc__)
 def etl():
@@ -28,14 +44,1213 @@ __all__ = [
     "consensus_genome",
     "redcap_det",
     "fhir",
+    "run",
 ]
 
+
+#: Approximate bytes of documents fetched at once by :func:`receiving_records`.
+RECEIVING_FETCH_BUDGET = 16 * 1024**2
+
+#: Maximum number of records fetched at once by :func:`receiving_records`.
+RECEIVING_FETCH_MAX = 1000
+
+
+def receiving_records(db: DatabaseSession,
+                      table: str,
+                      log_entry: dict,
+                      *,
+                      columns: Sequence[str] = (),
+                      contains: dict = None,
+                      limit: int = None,
+                      after: int = None,
+                      before: int = None,
+                      skip_locked: bool = False,
+                      partition: Tuple[str, int, int] = None,
+                      keys: Tuple[str, Collection[str]] = None,
+                      exclude: Collection[int] = None,
+                      queue: int = None,
+                      raw_documents: bool = False,
+                      budget: int = RECEIVING_FETCH_BUDGET) -> Iterator[Any]:
+    """
+    Yields records from the table *table* in the receiving schema which
+    haven't been processed, i.e. whose ``processing_log`` doesn't contain
+    *log_entry*, in order of id.
+
+    Rows are locked for update as they're fetched so that two instances of the
+    same ETL routine don't try to process the same records.  If *skip_locked*
+    is true, rows locked by another instance are skipped instead of waited
+    for.
+
+    Each record has the fields ``id``, ``document``, and ``document_size`` (in
+    bytes), plus any additional *columns*, which are SQL expressions (e.g.
+    ``"received::date as received_date"``) and must not contain user input.
+    If *contains* is given, only records whose document contains it are
+    yielded, if *after* or *before* are given, only records with a greater or
+    lesser id, respectively, are yielded, and if *limit* is given, at most
+    that many records are yielded.
+
+    A *partition* of ``(key, index, count)`` yields only the records whose
+    *key*, an SQL expression like *columns*, hashes to *index* out of *count*
+    partitions.  Similarly, *keys* of ``(key, values)`` yields only the
+    records whose *key* is one of *values*, compared as text, and *exclude*
+    skips the records with the given ids.
+
+    If *queue* is given, the id returned by :func:`register_etl` for
+    *log_entry* and *contains*, candidate records are found by their entries
+    in ``receiving.pending`` instead of by scanning the processing logs of the
+    whole table.
+
+    If *raw_documents* is true, each record's ``document`` is its JSON text
+    instead of the decoded document, so that routines can decode large
+    documents incrementally (e.g. with :func:`~id3c.json.load_json_items`).
+
+    Records are fetched from a server-side cursor in blocks sized so that
+    each block's documents total roughly *budget* bytes, based on the sizes
+    of the documents fetched so far.
+    """
+    relation = SQL(".").join(map(Identifier, ["receiving", table]))
+
+    query = SQL("""
+        select {id} as id,
+               {document},
+               {columns}
+               octet_length(document::text) as document_size
+          from {source}
+         where not processing_log @> %s
+           {contains}
+           {after}
+           {before}
+           {partition}
+           {keys}
+           {exclude}
+         order by id
+         limit {limit}
+           for update of {table} {skip_locked}
+        """).format(
+            id          = Identifier(f"{table}_id"),
+            document    = SQL("document::text as document") if raw_documents else SQL("document"),
+            source      = SQL("receiving.pending join {} on (record_id = {} and etl_id = %s)").format(relation, Identifier(f"{table}_id"))
+                              if queue is not None else relation,
+            table       = Identifier(table),
+            columns     = SQL("").join(SQL("{}, ").format(SQL(column)) for column in columns),
+            contains    = SQL("and document::jsonb @> %s") if contains is not None else SQL(""),
+            after       = SQL("and {} > %s").format(Identifier(f"{table}_id")) if after is not None else SQL(""),
+            before      = SQL("and {} < %s").format(Identifier(f"{table}_id")) if before is not None else SQL(""),
+            partition   = SQL("and mod(hashtext(coalesce(({})::text, '')) & 2147483647, %s) = %s").format(SQL(partition[0])) if partition else SQL(""),
+            keys        = SQL("and ({})::text = any(%s)").format(SQL(keys[0])) if keys else SQL(""),
+            exclude     = SQL("and {} <> all(%s)").format(Identifier(f"{table}_id")) if exclude else SQL(""),
+            limit       = Literal(limit) if limit is not None else SQL("all"),
+            skip_locked = SQL("skip locked") if skip_locked else SQL(""))
+
+    values: List[Any] = [Json([log_entry])]
+
+    if queue is not None:
+        values.insert(0, queue)
+
+    if contains is not None:
+        values.append(Json(contains))
+
+    if after is not None:
+        values.append(after)
+
+    if before is not None:
+        values.append(before)
+
+    if partition:
+        values.extend([partition[2], partition[1]])
+
+    if keys:
+        values.append(list(keys[1]))
+
+    if exclude:
+        values.append(list(exclude))
+
+    records = db.cursor(f"receiving {table}")
+
+    try:
+        with ledger.stage("fetch"):
+            records.execute(query, values)
+
+        fetched_rows = fetched_bytes = 0
+        size = 1
+
+        while True:
+            with ledger.stage("fetch"):
+                block = records.fetchmany(size)
+
+            if not block:
+                return
+
+            yield from block
+
+            block_bytes = sum(record.document_size for record in block)
+
+            fetched_rows  += len(block)
+            fetched_bytes += block_bytes
+
+            # Favor the recent documents if they're larger than average.
+            document_size = max(fetched_bytes / fetched_rows, block_bytes / len(block))
+            size = fetch_block_size(document_size, budget)
+
+            LOG.debug(f"Fetching {table} records in blocks of {size:,}")
+
+    finally:
+        # A named cursor lasts until it's closed or its transaction ends, and
+        # another with the same name can't be declared until then.  If the
+        # transaction already ended (or failed), there's nothing to close.
+        if not records.closed and db.connection.get_transaction_status() == TRANSACTION_STATUS_INTRANS:
+            records.close()
+
+
+def fetch_block_size(document_size: float, budget: int, maximum: int = RECEIVING_FETCH_MAX) -> int:
+    """
+    Number of records of *document_size* bytes which fit in *budget* bytes,
+    between 1 and *maximum*.
+
+    >>> fetch_block_size(4096, 1024**2)
+    256
+    >>> fetch_block_size(2 * 1024**2, 1024**2)
+    1
+    >>> fetch_block_size(10, 1024**2)
+    1000
+    """
+    return max(1, min(maximum, int(budget // max(document_size, 1))))
+
+
+def complete_groups(db: DatabaseSession,
+                    table: str,
+                    log_entry: dict,
+                    records: List[Any],
+                    ordered_by: str,
+                    claimed: Set[int],
+                    **kwargs) -> List[Any]:
+    """
+    Returns *records*, a batch claimed with :func:`receiving_records`, plus
+    the other unprocessed records of receiving *table* which share an
+    *ordered_by* value with one of them, in order of id.
+
+    Routines which process related records together (e.g. the DETs of a
+    REDCap record) then see all of a group's pending records in the same
+    batch, rather than some in the next.  Only records after the first of the
+    batch are added, and none of the *claimed* ids, to which the ids of the
+    added records are added.  A caller which claims its next batch after the
+    last id of *records* passes *claimed* as its ``exclude``, so that added
+    records aren't claimed again if the batch is rolled back.
+
+    *records* must have been fetched with *ordered_by* among their
+    ``columns`` as ``ordering_key`` (see :func:`ordering_key`).  Other
+    keyword arguments are passed through to :func:`receiving_records`.
+    """
+    keys = { record.ordering_key for record in records if record.ordering_key is not None }
+
+    if not keys:
+        return records
+
+    added = list(receiving_records(db, table, log_entry,
+        after   = records[0].id,
+        keys    = (ordered_by, keys),
+        exclude = claimed | { record.id for record in records },
+        **kwargs))
+
+    if not added:
+        return records
+
+    LOG.debug(f"Adding {len(added):,} {table} records related to the batch claimed")
+
+    claimed.update(record.id for record in added)
+
+    return sorted(records + added, key = lambda record: record.id)
+
+
+def ordering_key(ordered_by: str) -> str:
+    """
+    Column expression for :func:`receiving_records` which selects the
+    *ordered_by* value of each record as text, for :func:`complete_groups`.
+
+    >>> ordering_key("document->>'record'")
+    "(document->>'record')::text as ordering_key"
+    """
+    return f"({ordered_by})::text as ordering_key"
+
+
+def register_etl(table: str, log_entry: dict, contains: dict = None) -> Optional[int]:
+    """
+    Registers the ETL routine identified by *log_entry* (and *contains*, as
+    for :func:`receiving_records`) for receiving *table* and returns the id of
+    its queue of pending records.
+
+    Receiving tables maintain a queue for each registered routine: new records
+    are queued when inserted and dequeued once *log_entry* is added to their
+    processing log.  Registering a new revision of a routine rebuilds its queue
+    with one scan of *table*, so the first run after a revision bump takes a
+    little longer.  That's done in a separate, immediately committed
+    transaction so that the lock it takes on *table* is held only briefly.
+    Only runs which commit should register; others use :func:`find_etl_queue`.
+
+    Returns ``None`` if a newer revision of the routine is already registered,
+    in which case the caller should fall back to scanning processing logs.
+    """
+    name = log_entry.get("etl", table)
+
+    LOG.debug(f"Registering ETL routine {name} for receiving.{table}")
+
+    db = DatabaseSession()
+
+    try:
+        queue = db.fetch_row(
+            "select receiving.register_etl(%s, %s, %s, %s) as id",
+            (table, name, Json(log_entry), Json(contains) if contains is not None else None)).id
+
+        db.commit()
+    finally:
+        db.close()
+
+    if queue is None:
+        LOG.warning(f"A newer revision of ETL routine {name} is registered for receiving.{table}; scanning for unprocessed records instead")
+
+    return queue
+
+
+def find_etl_queue(db: DatabaseSession, table: str, log_entry: dict, contains: dict = None) -> Optional[int]:
+    """
+    Returns the id of the queue of pending records of the ETL routine
+    identified by *log_entry* (and *contains*) for receiving *table*, if
+    exactly that revision of it is registered, without registering it.
+
+    Returns ``None`` otherwise, in which case the caller should fall back to
+    scanning processing logs.
+    """
+    name = log_entry.get("etl", table)
+
+    etl = db.fetch_row("""
+        select etl_id as id
+          from receiving.etl
+         where relation = %s
+           and name = %s
+           and log_entry = %s
+           and filter is not distinct from %s
+        """, (table, name, Json(log_entry), Json(contains) if contains is not None else None))
+
+    if etl is None:
+        LOG.debug(f"ETL routine {name} isn't registered for receiving.{table} as of this revision")
+        return None
+
+    return etl.id
+
+
+def with_workers(command):
+    """
+    Decorator to add ``--workers`` and ``--claim-size`` options to an ETL
+    *command*, which is called with ``workers`` and ``claim_size`` keyword
+    arguments for :func:`process_receiving_records`.
+    """
+    command = click.option("--claim-size",
+        metavar = "<n>",
+        type = click.IntRange(min = 1),
+        default = 100,
+        show_default = True,
+        help = "Number of records claimed and committed at a time by each "
+               "worker with --workers")(command)
+
+    return click.option("--workers",
+        metavar = "<n>",
+        type = click.IntRange(min = 1),
+        help = "Process records in <n> worker processes, each with its own "
+               "database connection.  Workers repeatedly claim a batch of "
+               "records not locked by another worker or ETL run, process it, "
+               "and commit it (or roll it back with --dry-run), so runs on "
+               "other hosts can work alongside them.  By default, all records "
+               "are processed by this process in a single transaction.")(command)
+
+
+def with_backfill(command):
+    """
+    Decorator to add ``--backfill`` and ``--range-size`` options to an ETL
+    *command*, which is called with ``backfill`` and ``range_size`` keyword
+    arguments for :func:`process_receiving_records`.
+    """
+    command = click.option("--range-size",
+        metavar = "<n>",
+        type = click.IntRange(min = 1),
+        default = 10_000,
+        show_default = True,
+        help = "Number of record ids in each range processed and committed "
+               "at a time with --backfill")(command)
+
+    return click.option("--backfill",
+        metavar = "[<checkpoint.json>]",
+        is_flag = False,
+        flag_value = "",
+        help = "Reprocess a large backlog, such as all records after a "
+               "revision bump, by splitting record ids into ranges of "
+               "--range-size, processing them in --workers (default 4) worker "
+               "processes, and committing each range.  Committed ranges are "
+               "recorded in <checkpoint.json>, if given, so that a restarted "
+               "backfill skips them.")(command)
+
+
+def process_receiving_records(db: DatabaseSession,
+                              action: DatabaseSessionAction,
+                              process: Callable[[DatabaseSession, Iterable[Any]], None],
+                              table: str,
+                              log_entry: dict,
+                              *,
+                              workers: Optional[int],
+                              claim_size: int,
+                              ordered_by: str = None,
+                              columns: Sequence[str] = (),
+                              contains: dict = None,
+                              limit: int = None,
+                              raw_documents: bool = False,
+                              backfill: str = None,
+                              range_size: int = 10_000) -> None:
+    """
+    Calls *process* with a session and an iterable of unprocessed records of
+    receiving *table*, as selected by :func:`receiving_records` with
+    *log_entry* and the other keyword arguments.
+
+    Without *workers*, *process* is called once with *db* and all of the
+    records, leaving the transaction to the caller, unless *db* commits
+    periodically, in which case records are processed and committed in
+    batches by :func:`commit_receiving_records`.
+
+    Otherwise, that many worker processes are started, each with its own
+    session.  A worker claims up to *claim_size* records not locked by any
+    other session (``for update skip locked``), calls *process* with them,
+    and commits or rolls back according to *action*, repeating until no
+    records are left.  *limit* applies to the total across workers.  If a
+    worker fails, the others stop after their current batch and an exception
+    is raised once all have stopped; batches already committed stay
+    committed.
+
+    Unprocessed records are found through the routine's queue if it's
+    already registered as of this revision (see :func:`find_etl_queue`).
+    Otherwise, it's first registered with :func:`register_etl` if *action* is
+    to commit, but not for a dry run, so that a dry run of a new revision
+    doesn't rebuild the queue out from under the revision in production.
+
+    Records are processed in order of id within each batch, but batches are
+    processed concurrently.  Routines which must process related records in
+    order pass *ordered_by*, an SQL expression (like *columns*) whose value
+    relates records.  Records with the same value are then claimed only by
+    the same worker, and only one such run of the routine may proceed at a
+    time; others wait for it to finish.  Each claim also includes all the
+    pending records related to those claimed (see :func:`complete_groups`),
+    even beyond *claim_size* or *limit*, so that routines which process a
+    group of related records together never see only part of it.
+
+    If *backfill* is given, even if empty, records are instead processed by
+    :func:`backfill_receiving_records` in ranges of *range_size* ids, with
+    *backfill* as the path of its checkpoint file.
+    """
+    queue = find_etl_queue(db, table, log_entry, contains)
+
+    if queue is None:
+        if action is DatabaseSessionAction.COMMIT:
+            queue = register_etl(table, log_entry, contains)
+        else:
+            LOG.info(f"ETL routine {log_entry.get('etl', table)} isn't registered for receiving.{table} as of this revision; scanning for unprocessed records instead")
+
+    if backfill is None and not workers and db.commits_periodically:
+        commit_receiving_records(db, process, table, log_entry,
+            queue       = queue,
+            claim_size  = claim_size,
+            ordered_by  = ordered_by,
+            columns     = columns,
+            contains    = contains,
+            raw_documents = raw_documents,
+            limit       = limit)
+        return
+
+    if ordered_by:
+        LOG.debug(f"Waiting for any other run processing {table} records in order of {ordered_by}")
+        db.fetch_row("select pg_advisory_xact_lock(hashtext(%s))", (f"receiving.{table} {as_json(log_entry)}",))
+
+    if backfill is None and not workers:
+        process(db, receiving_records(db, table, log_entry, columns = columns, contains = contains, limit = limit, queue = queue, raw_documents = raw_documents))
+        return
+
+    if action is DatabaseSessionAction.PROMPT:
+        raise click.UsageError("--prompt can't be used with --workers or --backfill, since workers commit as they go")
+
+    if backfill is not None:
+        if limit is not None:
+            raise click.UsageError("A limit on the number of records can't be used with --backfill")
+
+        backfill_receiving_records(action, process, table, log_entry,
+            queue       = queue,
+            workers     = workers or 4,
+            range_size  = range_size,
+            checkpoint  = backfill or None,
+            ordered_by  = ordered_by,
+            columns     = columns,
+            contains    = contains,
+            raw_documents = raw_documents)
+        return
+
+    commit = action is DatabaseSessionAction.COMMIT
+
+    LOG.info(f"Processing {table} records with {workers} workers, {claim_size} records at a time")
+
+    # Workers are forked, not spawned, so that *process* needn't be picklable.
+    # Each opens its own connection, as connections can't be shared.
+    context = multiprocessing.get_context("fork")
+    stop = context.Event()
+    remaining = context.Value("q", limit if limit is not None else -1)
+
+    def work(index: int) -> None:
+        with ledger.worker():
+            work_batches(index)
+
+    claim_columns = [*columns, ordering_key(ordered_by)] if ordered_by else columns
+
+    def work_batches(index: int) -> None:
+        worker_db = DatabaseSession()
+        after = None
+        claimed = 0
+        grouped: Set[int] = set()
+
+        try:
+            while not stop.is_set():
+                size = claim_size
+
+                if limit is not None:
+                    with remaining.get_lock():
+                        size = min(size, remaining.value)
+                        remaining.value -= size
+
+                if size <= 0:
+                    break
+
+                records = list(receiving_records(worker_db, table, log_entry,
+                    columns     = claim_columns,
+                    contains    = contains,
+                    limit       = size,
+                    after       = after,
+                    skip_locked = True,
+                    partition   = (ordered_by, index, workers) if ordered_by else None,
+                    exclude     = grouped,
+                    queue       = queue,
+                    raw_documents = raw_documents))
+
+                if limit is not None and len(records) < size:
+                    with remaining.get_lock():
+                        remaining.value += size - len(records)
+
+                if not records:
+                    break
+
+                # Continue after the batch, which matters when rolling back,
+                # as the batch is still unprocessed.
+                first, after = records[0].id, records[-1].id
+
+                if ordered_by:
+                    records = complete_groups(worker_db, table, log_entry, records, ordered_by, grouped,
+                        columns     = claim_columns,
+                        contains    = contains,
+                        queue       = queue,
+                        raw_documents = raw_documents)
+
+                process(worker_db, records)
+
+                with ledger.stage("commit"):
+                    if commit:
+                        worker_db.commit()
+                    else:
+                        worker_db.rollback()
+
+                claimed += len(records)
+
+                LOG.info(f"Worker {index} {'committed' if commit else 'rolled back'} {table} records {first} to {after} ({claimed:,} so far)")
+
+        except:
+            stop.set()
+            worker_db.rollback()
+            raise
+
+        finally:
+            worker_db.close()
+
+    processes = [ context.Process(target = work, args = (index,), name = f"{table} worker {index}") for index in range(workers) ]
+
+    for worker in processes:
+        worker.start()
+
+    for worker in processes:
+        worker.join()
+
+    failed = [ worker.name for worker in processes if worker.exitcode != 0 ]
+
+    if failed:
+        raise Exception(f"{len(failed)} of {workers} workers failed: {', '.join(failed)}")
+
+
+def commit_receiving_records(db: DatabaseSession,
+                             process: Callable[[DatabaseSession, Iterable[Any]], None],
+                             table: str,
+                             log_entry: dict,
+                             *,
+                             queue: Optional[int],
+                             claim_size: int,
+                             ordered_by: str = None,
+                             columns: Sequence[str] = (),
+                             contains: dict = None,
+                             limit: int = None,
+                             raw_documents: bool = False) -> None:
+    """
+    Calls *process* with *db* and successive batches of unprocessed records of
+    receiving *table*, committing with
+    :meth:`~id3c.db.session.DatabaseSession.commit_if_due` after each batch
+    and once more at the end.
+
+    Batches are of :attr:`~id3c.db.session.DatabaseSession.commit_every`
+    records, or of *claim_size* records if only a commit interval is set, so
+    that commits fall on record boundaries.  Each batch is fetched and locked
+    separately, as committing releases the locks of, and closes, the cursor
+    it was fetched with.
+
+    With *ordered_by*, only one such run of the routine may proceed at a time,
+    as in :func:`process_receiving_records`, but the lock is held by the
+    session across commits instead of by the transaction.  Each batch is
+    completed with its records' related records (see
+    :func:`complete_groups`), so a batch may exceed its size.
+    """
+    lock = f"receiving.{table} {as_json(log_entry)}"
+
+    if ordered_by:
+        LOG.debug(f"Waiting for any other run processing {table} records in order of {ordered_by}")
+        db.fetch_row("select pg_advisory_lock(hashtext(%s))", (lock,))
+
+    LOG.info(f"Processing {table} records, committing "
+             + " or ".join(filter(None, [
+                 f"every {db.commit_every:,} records" if db.commit_every else None,
+                 f"every {db.commit_interval:g}s" if db.commit_interval else None])))
+
+    claim_columns = [*columns, ordering_key(ordered_by)] if ordered_by else columns
+    grouped: Set[int] = set()
+
+    after = None
+    uncommitted_from = None
+    processed = 0
+
+    try:
+        while limit is None or processed < limit:
+            size = db.commit_every or claim_size
+
+            if limit is not None:
+                size = min(size, limit - processed)
+
+            records = list(receiving_records(db, table, log_entry,
+                columns     = claim_columns,
+                contains    = contains,
+                limit       = size,
+                after       = after,
+                exclude     = grouped,
+                queue       = queue,
+                raw_documents = raw_documents))
+
+            if not records:
+                break
+
+            after = records[-1].id
+            exhausted = len(records) < size
+
+            if ordered_by:
+                records = complete_groups(db, table, log_entry, records, ordered_by, grouped,
+                    columns     = claim_columns,
+                    contains    = contains,
+                    queue       = queue,
+                    raw_documents = raw_documents)
+
+            process(db, records)
+
+            processed += len(records)
+
+            if uncommitted_from is None:
+                uncommitted_from = records[0].id
+
+            with ledger.stage("commit"):
+                if db.commit_if_due(len(records)):
+                    LOG.info(f"Committed {table} records {uncommitted_from} to {after} ({processed:,} so far)")
+                    uncommitted_from = None
+
+            # A short batch means there are no more records to claim.
+            if exhausted:
+                break
+
+        if uncommitted_from is not None:
+            with ledger.stage("commit"):
+                db.commit()
+
+            LOG.info(f"Committed {table} records {uncommitted_from} to {after} ({processed:,} in total)")
+
+    except:
+        db.rollback()
+        raise
+
+    finally:
+        # Session-level locks outlive transactions, so release it explicitly.
+        if ordered_by:
+            db.fetch_row("select pg_advisory_unlock(hashtext(%s))", (lock,))
+
+
+def backfill_receiving_records(action: DatabaseSessionAction,
+                               process: Callable[[DatabaseSession, Iterable[Any]], None],
+                               table: str,
+                               log_entry: dict,
+                               *,
+                               queue: Optional[int],
+                               workers: int,
+                               range_size: int,
+                               checkpoint: str = None,
+                               ordered_by: str = None,
+                               columns: Sequence[str] = (),
+                               contains: dict = None,
+                               raw_documents: bool = False) -> None:
+    """
+    Calls *process* with a session and the unprocessed records of receiving
+    *table* in each range of *range_size* ids, like
+    :func:`process_receiving_records` with *workers*, but with each worker
+    committing (or rolling back) a whole range at a time.
+
+    Ranges are aligned to multiples of *range_size*, so they're the same
+    from one run to the next.  Workers take the next range as they finish
+    one, in order of id.  If *ordered_by* is given, each worker instead
+    walks every range in order but only processes the records whose
+    *ordered_by* value hashes to it, as with :func:`receiving_records`'s
+    *partition*, so related records are still processed in order.  Related
+    records in later ranges are processed along with the first range which
+    has one of them (see :func:`complete_groups`).
+
+    Unlike with :func:`process_receiving_records`, records locked by another
+    run aren't skipped, but waited for.
+
+    If *checkpoint* is given, committed ranges are recorded there as a
+    :class:`~id3c.db.copy.Checkpoint` (one file per worker if *ordered_by*
+    is given) and skipped by later backfills with the same routine, worker
+    count, and checkpoint.
+    """
+    commit = action is DatabaseSessionAction.COMMIT
+    shards = workers if ordered_by else 1
+
+    db = DatabaseSession()
+
+    try:
+        if queue is not None:
+            bounds = db.fetch_row("""
+                select min(record_id) as first, max(record_id) as last
+                  from receiving.pending
+                 where etl_id = %s
+                """, (queue,))
+        else:
+            bounds = db.fetch_row(SQL("select min({id}) as first, max({id}) as last from {table}").format(
+                id    = Identifier(f"{table}_id"),
+                table = SQL(".").join(map(Identifier, ["receiving", table]))))
+    finally:
+        db.close()
+
+    if bounds.first is None:
+        LOG.info(f"No {table} records to backfill")
+        return
+
+    ranges = [ (start, start + range_size) for start in range(bounds.first - bounds.first % range_size, bounds.last + 1, range_size) ]
+
+    checkpoints = [
+        Checkpoint(
+            f"{checkpoint}.{shard}" if checkpoint and shards > 1 else checkpoint,
+            f"receiving.{table} {as_json(log_entry)} {as_json(contains)} shard {shard} of {shards}")
+        for shard in range(shards)
+    ]
+
+    # Work is handed out through queues: a shared one if any worker may take
+    # any range, or one per worker if each must walk every range for its
+    # shard.  Committed ranges are reported back to this process, the only
+    # one which writes the checkpoints.
+    context = multiprocessing.get_context("fork")
+    stop = context.Event()
+    tasks = [ context.SimpleQueue() for _ in range(shards) ]
+    done = context.Queue()
+
+    remaining = 0
+
+    for shard, task_queue in enumerate(tasks):
+        for start, end in ranges:
+            if not checkpoints[shard].covers(start, end):
+                task_queue.put((start, end))
+                remaining += 1
+
+    if not remaining:
+        LOG.info(f"All {len(ranges):,} ranges of {table} records are already backfilled")
+        return
+
+    for task_queue in tasks:
+        for _ in range(workers if shards == 1 else 1):
+            task_queue.put(None)
+
+    LOG.info(f"Backfilling {remaining:,} ranges of {range_size:,} {table} record ids with {workers} workers")
+
+    def work(index: int) -> None:
+        with ledger.worker():
+            work_ranges(index)
+
+    claim_columns = [*columns, ordering_key(ordered_by)] if ordered_by else columns
+
+    def work_ranges(index: int) -> None:
+        shard = index if shards > 1 else 0
+        worker_db = DatabaseSession()
+        grouped: Set[int] = set()
+
+        try:
+            while not stop.is_set():
+                task = tasks[shard].get()
+
+                if task is None:
+                    break
+
+                start, end = task
+                processed = 0
+
+                def count(records: Iterable[Any]) -> Iterator[Any]:
+                    nonlocal processed
+
+                    for record in records:
+                        processed += 1
+                        yield record
+
+                # Records locked by another run are waited for rather than
+                # skipped, so a committed range is complete and can be
+                # checkpointed.
+                records: Iterable[Any] = receiving_records(worker_db, table, log_entry,
+                    columns     = claim_columns,
+                    contains    = contains,
+                    after       = start - 1,
+                    before      = end,
+                    partition   = (ordered_by, shard, shards) if ordered_by else None,
+                    exclude     = grouped,
+                    queue       = queue,
+                    raw_documents = raw_documents)
+
+                # Related records in later ranges are processed along with
+                # this one, which means holding the range in memory.
+                if ordered_by:
+                    records = list(records)
+
+                    if records:
+                        records = complete_groups(worker_db, table, log_entry, records, ordered_by, grouped,
+                            columns     = claim_columns,
+                            contains    = contains,
+                            queue       = queue,
+                            raw_documents = raw_documents)
+
+                process(worker_db, count(records))
+
+                with ledger.stage("commit"):
+                    if commit:
+                        worker_db.commit()
+                    else:
+                        worker_db.rollback()
+
+                done.put((shard, start, end, processed))
+
+        except:
+            stop.set()
+            worker_db.rollback()
+            raise
+
+        finally:
+            worker_db.close()
+
+    processes = [ context.Process(target = work, args = (index,), name = f"{table} backfill worker {index}") for index in range(workers) ]
+
+    for worker in processes:
+        worker.start()
+
+    completed = 0
+
+    while remaining and (any(worker.is_alive() for worker in processes) or not done.empty()):
+        try:
+            shard, start, end, processed = done.get(timeout = 1)
+        except QueueEmpty:
+            continue
+
+        remaining -= 1
+        completed += 1
+
+        if commit:
+            checkpoints[shard].add(start, end, processed)
+
+        LOG.info(f"{'Committed' if commit else 'Rolled back'} {processed:,} {table} records with ids in [{start}, {end})"
+                 + (f" for shard {shard}" if shards > 1 else "")
+                 + f" ({completed:,} ranges done, {remaining:,} to go)")
+
+    for worker in processes:
+        worker.join()
+
+    failed = [ worker.name for worker in processes if worker.exitcode != 0 ]
+
+    if failed:
+        raise Exception(f"{len(failed)} of {workers} backfill workers failed: {', '.join(failed)}"
+                        + (f"; rerun with --backfill {checkpoint} to resume" if checkpoint else ""))
+
+
+def with_savepoint_batch_size(command):
+    """
+    Decorator to add a ``--savepoint-batch-size`` option to an ETL *command*,
+    which is called with a ``savepoint_batch_size`` keyword argument for
+    :func:`savepoint_batches`.
+    """
+    return click.option("--savepoint-batch-size",
+        metavar = "<n>",
+        type = click.IntRange(min = 1),
+        default = 1,
+        show_default = True,
+        help = "Process up to <n> records within a single database savepoint.  "
+               "Fewer savepoints are faster, but if a record fails the batch is "
+               "rolled back and retried to isolate the failure.")(command)
+
+
+def savepoint_batches(db: DatabaseSession,
+                      records: Iterable[T],
+                      name: Callable[[T], str],
+                      batch_size: int = 1) -> Iterator[Tuple[T, ContextManager]]:
+    """
+    Yields each of *records* paired with a context manager which isolates the
+    changes made while processing it, like a per-record savepoint.
+
+    Use it in place of a per-record :meth:`DatabaseSession.savepoint`:
+
+    >>> for record, savepoint in savepoint_batches(db, records, name, 100): # doctest: +SKIP
+    ...     with savepoint:
+    ...         ... # process the record
+
+    With a *batch_size* of 1, each record gets its own savepoint named by
+    *name*.  Otherwise, up to *batch_size* records are processed under a single
+    savepoint.  If processing a record raises an exception, the batch is rolled
+    back and split into the records before the failure, which are processed
+    again as a batch, and the failed record, which is processed again under its
+    own savepoint so that its exception propagates exactly as it would have
+    without batching.  Records are thus yielded more than once in that case and
+    processing must not depend on previous attempts (e.g. by mutating the
+    record).
+
+    >>> from contextlib import contextmanager
+    >>> class Session:
+    ...     @contextmanager
+    ...     def savepoint(self, name):
+    ...         print("savepoint", name)
+    ...         try:
+    ...             yield
+    ...         except Exception:
+    ...             print("rollback", name)
+    ...             raise
+    >>> try:
+    ...     for n, savepoint in savepoint_batches(Session(), [1, 2, 3, 4, 5], str, 10):
+    ...         with savepoint:
+    ...             print("process", n)
+    ...             assert n != 3, "bad record"
+    ... except AssertionError as error:
+    ...     print(error)
+    savepoint 1 and 4 more
+    process 1
+    process 2
+    process 3
+    rollback 1 and 4 more
+    savepoint 1 and 1 more
+    process 1
+    process 2
+    savepoint 3
+    process 3
+    rollback 3
+    bad record
+    """
+    if batch_size <= 1:
+        for record in records:
+            yield record, _processing(db.savepoint(name(record)))
+    else:
+        for batch in chunked(records, batch_size):
+            yield from _savepoint_batch(db, batch, name)
+
+
+def _savepoint_batch(db: DatabaseSession, batch: List[T], name: Callable[[T], str]) -> Iterator[Tuple[T, ContextManager]]:
+    if len(batch) == 1:
+        yield batch[0], _processing(db.savepoint(name(batch[0])))
+        return
+
+    savepoint = db.savepoint(f"{name(batch[0])} and {len(batch) - 1} more")
+    savepoint.__enter__()
+
+    for failed, record in enumerate(batch):
+        attempt = _BatchedRecord()
+        yield record, _processing(attempt)
+
+        if attempt.error:
+            break
+    else:
+        savepoint.__exit__(None, None, None)
+        return
+
+    LOG.debug(f"Rolling back batch of {len(batch)} records after error in {name(batch[failed])}: {attempt.error}")
+
+    try:
+        savepoint.__exit__(type(attempt.error), attempt.error, attempt.error.__traceback__)
+    except Exception:
+        pass
+
+    if failed:
+        yield from _savepoint_batch(db, batch[:failed], name)
+
+    yield batch[failed], _processing(db.savepoint(name(batch[failed])))
+
+    if failed + 1 < len(batch):
+        yield from _savepoint_batch(db, batch[failed + 1:], name)
+
+
+@contextmanager
+def _processing(savepoint: ContextManager) -> Iterator[None]:
+    """
+    Enters *savepoint* for the ``with`` block, which is timed as the
+    "transform" stage of the ETL run, apart from the time spent in nested
+    stages such as "write", and counted as a failed record if it raises an
+    exception that *savepoint* doesn't suppress.
+    """
+    with ledger.stage("transform"):
+        try:
+            with savepoint:
+                yield
+        except Exception:
+            ledger.count("failed")
+            raise
+
+
+class _BatchedRecord:
+    """
+    Context manager for a record processed within a batch savepoint, which
+    suppresses and keeps any exception so :func:`_savepoint_batch` can roll
+    back the batch and retry.
+    """
+    error: Optional[Exception] = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if isinstance(exc_value, Exception):
+            self.error = exc_value
+            return True
+        return False
+
+def prefetch_identifiers(db: DatabaseSession,
+                         records: Iterable[T],
+                         barcodes: Callable[[T], Iterable[Any]],
+                         size: int = 500,
+                         budget: int = RECEIVING_FETCH_BUDGET) -> Iterator[T]:
+    """
+    Yields each of *records*, after resolving the *barcodes* of every *size*
+    barcodes' worth of records with one :func:`~id3c.db.find_identifiers`
+    query.
+
+    Calls to :func:`~id3c.db.find_identifier` while processing the records
+    are then served from the session's identifier cache instead of making a
+    round trip per barcode.  Values returned by *barcodes* which aren't
+    non-empty strings are ignored.
+
+    Records are held back until they're resolved, so a query is also made
+    once the held back records' documents total *budget* bytes, as for
+    :func:`receiving_records`, whose records have a ``document_size``.
+
+    >>> from unittest.mock import MagicMock, patch
+    >>> records = [("a", "b"), ("c",), (), ("d", "e", "f"), ("g",)]
+    >>> with patch(f"{__name__}.find_identifiers") as find_identifiers:
+    ...     list(prefetch_identifiers(MagicMock(), records, lambda record: record, size = 3))
+    ...     [ list(call.args[1]) for call in find_identifiers.call_args_list ]
+    [('a', 'b'), ('c',), (), ('d', 'e', 'f'), ('g',)]
+    [['a', 'b', 'c'], ['d', 'e', 'f'], ['g']]
+    """
+    chunk: List[T] = []
+    chunk_barcodes: List[str] = []
+    chunk_bytes = 0
+
+    for record in records:
+        chunk.append(record)
+        chunk_barcodes += [ barcode for barcode in barcodes(record) if barcode and isinstance(barcode, str) ]
+        chunk_bytes += getattr(record, "document_size", 0)
+
+        if len(chunk_barcodes) >= size or chunk_bytes >= budget:
+            find_identifiers(db, chunk_barcodes)
+            yield from chunk
+
+            chunk, chunk_barcodes, chunk_bytes = [], [], 0
+
+    if chunk:
+        find_identifiers(db, chunk_barcodes)
+        yield from chunk
+
+
+#: Maximum number of rows loaded to warm a :class:`DimensionCache`.  Larger
+#: dimensions are instead cached row by row as they're looked up.
+DIMENSION_CACHE_MAX_WARM = 50_000
+
+
+class DimensionCache:
+    """
+    In-memory cache of the rows of a small dimension table, such as targets
+    or sites, keyed by identifier and scoped to a single ETL run's
+    :class:`DatabaseSession`.  Get the cache for a session with
+    :func:`dimension_cache`.
+
+    The cache is warmed by one select of *query* (with *values*), either
+    explicitly by :meth:`warm` at the start of an ETL run or else on first
+    use.  Rows added later by :meth:`add` are evicted if the savepoint or
+    transaction they were added in is rolled back, and a warm-up done within
+    a savepoint is discarded if it is rolled back, so the cache never holds
+    rows the database doesn't.
+
+    Rows are never removed from dimension tables by ETLs, so a cached row
+    remains valid even if other sessions make changes.  A miss must still be
+    looked up in the database, however, since another session may have added
+    the row.
+
+    >>> from unittest.mock import MagicMock
+    >>> db = MagicMock()
+    >>> db.cursor().__enter__().fetchall.return_value = [("a", 1), ("b", 2)]
+    >>> cache = DimensionCache(db, "target", "select ...", key = lambda row: row[0])
+    >>> cache.get("a")
+    ('a', 1)
+    >>> cache.get("c") is None
+    True
+    >>> cache.add(("c", 3))
+    >>> cache.get("c")
+    ('c', 3)
+    >>> undo, = db.on_rollback.call_args.args
+    >>> undo()
+    >>> cache.get("c") is None
+    True
+    """
+    def __init__(self, db: DatabaseSession, name: str, query: str, values: tuple = (), *, key: Callable[[Any], Any]) -> None:
+        self.db = db
+        self.name = name
+        self.query = query
+        self.values = values
+        self.key = key
+        self.rows: Dict[Any, Any] = {}
+        self.warmed = False
+
+
+    def warm(self) -> None:
+        """
+        Loads all rows of the dimension, unless there are more than
+        :data:`DIMENSION_CACHE_MAX_WARM`.
+        """
+        self.warmed = True
+        self.db.on_rollback(self.clear)
+
+        with self.db.cursor() as cursor:
+            cursor.execute(f"{self.query} limit %s", (*self.values, DIMENSION_CACHE_MAX_WARM + 1))
+            rows = cursor.fetchall()
+
+        if len(rows) > DIMENSION_CACHE_MAX_WARM:
+            LOG.debug(f"Not warming {self.name} cache with more than {DIMENSION_CACHE_MAX_WARM:,} rows")
+            return
+
+        self.rows.update((self.key(row), row) for row in rows)
+
+        LOG.debug(f"Warmed {self.name} cache with {len(rows):,} rows")
+
+
+    def clear(self) -> None:
+        """
+        Empties the cache so it's warmed again on next use.
+        """
+        self.rows.clear()
+        self.warmed = False
+
+
+    def get(self, key: Any) -> Any:
+        """
+        Returns the cached row for *key*, or ``None`` if it isn't cached.
+        """
+        if not self.warmed:
+            self.warm()
+
+        return self.rows.get(key)
+
+
+    def add(self, row: Any) -> None:
+        """
+        Caches *row*, which was just selected or inserted by the session,
+        until the current savepoint or transaction is rolled back.
+        """
+        key = self.key(row)
+        self.rows[key] = row
+        self.db.on_rollback(lambda: self.discard(key))
+
+
+    def discard(self, key: Any) -> None:
+        """
+        Removes the row for *key* from the cache, if present.
+        """
+        self.rows.pop(key, None)
+
+
+_dimension_caches: "WeakKeyDictionary[DatabaseSession, Dict[Tuple, DimensionCache]]" = WeakKeyDictionary()
+
+
+def dimension_cache(db: DatabaseSession, dimension: str, scale: str = None) -> DimensionCache:
+    """
+    Returns the :class:`DimensionCache` of *db* for *dimension*, one of
+    ``target``, ``site``, or ``location``.  Locations are cached separately
+    for each *scale*.
+
+    ETLs may call :meth:`DimensionCache.warm` on the caches they use before
+    processing records, so that the warm-up isn't repeated if the first
+    record's savepoint is rolled back.
+    """
+    caches = _dimension_caches.setdefault(db, {})
+    cache_key = (dimension, scale)
+
+    if cache_key not in caches:
+        if dimension == "target":
+            caches[cache_key] = DimensionCache(db, "target", """
+                select target_id as id, identifier
+                  from warehouse.target
+                """, key = lambda row: row.identifier)
+
+        elif dimension == "site":
+            caches[cache_key] = DimensionCache(db, "site", """
+                select site_id as id, identifier
+                  from warehouse.site
+                """, key = lambda row: row.identifier)
+
+        elif dimension == "location":
+            assert scale, "A scale is required for the location cache"
+
+            caches[cache_key] = DimensionCache(db, f"{scale} location", """
+                select location_id as id, scale, identifier, hierarchy
+                  from warehouse.location
+                 where scale = %s
+                """, (scale,), key = lambda row: row.identifier)
+
+        else:
+            raise ValueError(f"Unknown dimension «{dimension}»")
+
+    return caches[cache_key]
+
+
 def find_or_create_site(db: DatabaseSession, identifier: str, details: dict) -> Any:
     """
     Select encounter site by *identifier*, or insert it if it doesn't exist.
+
+    Sites are served from the session's :func:`dimension_cache` when possible.
     """
     LOG.debug(f"Looking up site «{identifier}»")
 
+    cache = dimension_cache(db, "site")
+    site = cache.get(identifier)
+
+    if site:
+        LOG.info(f"Found site {site.id} «{site.identifier}»")
+        return site
+
     site = db.fetch_row("""
         select site_id as id, identifier
           from warehouse.site
@@ -60,9 +1275,12 @@ def find_or_create_site(db: DatabaseSession, identifier: str, details: dict) ->
 
         LOG.info(f"Created site {site.id} «{site.identifier}»")
 
+    cache.add(site)
+
     return site
 
 
+@ledger.timed("write")
 def upsert_individual(db: DatabaseSession, identifier: str, sex: str = None, details: dict = None) -> Any:
     """
     Upsert individual by their *identifier*.
@@ -75,21 +1293,25 @@ def upsert_individual(db: DatabaseSession, identifier: str, sex: str = None, det
 
     LOG.debug(f"Upserting individual «{identifier}»")
 
+    digest = content_digest(sex, details or None)
+
     data = {
         "identifier": identifier,
         "sex": sex,
         "details": Json(details) if details else None,
+        "content_digest": digest,
     }
 
     with db.cursor() as cursor:
         cursor.execute("""
             select individual_id as id,
                 identifier,
-                (
+                content_digest = %(content_digest)s as digest_matched,
+                case when content_digest = %(content_digest)s then false else (
                     individual.sex != %(sex)s
                     or
                     (coalesce(individual.details,'{}'::jsonb) != (coalesce(individual.details, '{}'::jsonb) || coalesce(%(details)s, '{}')::jsonb))
-                ) as data_changed
+                ) end as data_changed
             from warehouse.individual
             where identifier = %(identifier)s
             for update
@@ -104,11 +1326,13 @@ def upsert_individual(db: DatabaseSession, identifier: str, sex: str = None, det
             insert into warehouse.individual (
                     identifier,
                     sex,
-                    details)
+                    details,
+                    content_digest)
                 values (
                     %(identifier)s,
                     %(sex)s,
-                    %(details)s)
+                    %(details)s,
+                    %(content_digest)s)
         returning individual_id as id, identifier
         """, data)
 
@@ -120,12 +1344,17 @@ def upsert_individual(db: DatabaseSession, identifier: str, sex: str = None, det
 
         if individual.data_changed==False:
             LOG.info(f"Skipping upsert for individual {individual.id} «{identifier}» (no change).")
+
+            if not individual.digest_matched:
+                update_content_digest(db, "individual", individual.id, digest)
+
             return individual
 
         individual = db.fetch_row("""
             update warehouse.individual
                 set sex = %(sex)s,
-                    details = coalesce(individual.details, '{}'::jsonb) || coalesce(%(details)s, '{}')::jsonb
+                    details = coalesce(individual.details, '{}'::jsonb) || coalesce(%(details)s, '{}')::jsonb,
+                    content_digest = %(content_digest)s
             where individual_id = %(individual_id)s
                 returning individual_id as id, identifier
         """, { **data, "individual_id": individual.id })
@@ -140,6 +1369,7 @@ def upsert_individual(db: DatabaseSession, identifier: str, sex: str = None, det
     return individual
 
 
+@ledger.timed("write")
 def upsert_encounter(db: DatabaseSession,
                      identifier: str,
                      encountered: str,
@@ -152,6 +1382,8 @@ def upsert_encounter(db: DatabaseSession,
     """
     LOG.debug(f"Upserting encounter «{identifier}»")
 
+    digest = content_digest(individual_id, site_id, encountered, age, without_uuid_references(details))
+
     data = {
         "identifier": identifier,
         "encountered": encountered,
@@ -159,6 +1391,7 @@ def upsert_encounter(db: DatabaseSession,
         "site_id": site_id,
         "age": age,
         "details": Json(details),
+        "content_digest": digest,
     }
 
     # Select on identifier to determine if the encounter record already exists.
@@ -167,34 +1400,33 @@ def upsert_encounter(db: DatabaseSession,
     # is necessary. If a record is found with the given identifier, the columns that would be
     # set on update are compared to the incoming values, ignoring any values in details starting
     # with `urn:uuid:` (FHIR resource reference IDs that are randomly generated each time a FHIR
-    # bundle is constructed, and are not indicitive of data having changed).
+    # bundle is constructed, and are not indicitive of data having changed).  The comparison is
+    # skipped if the stored content digest matches, which was computed the same way.
     #
     # Note: if there are schema changes to `warehouse.encounter` resulting in changes to the columns
     # that are set on update, the list of columns being compared should be updated to match.
 
-    with db.cursor() as cursor:
-        cursor.execute("""
-            select encounter_id as id,
-                identifier,
-                (
-                    row (encounter.individual_id,
-                        encounter.site_id,
-                        encounter.encountered,
-                        encounter.age,
-                        regexp_replace(encounter.details::text, '"urn:uuid:[a-f0-9-]{36}"', '""', 'g'))::text
-                    !=
-                    row (%(individual_id)s::integer,
-                            %(site_id)s::integer,
-                            %(encountered)s::timestamp with time zone,
-                            %(age)s::interval,
-                            regexp_replace(%(details)s::jsonb::text, '"urn:uuid:[a-f0-9-]{36}"', '""', 'g'))::text
-                ) as data_changed
-            from warehouse.encounter
-            where identifier = %(identifier)s
-            for update
-            """, data)
-
-        encounters = list(cursor)
+    encounters = db.fetch_all("""
+        select encounter_id as id,
+            identifier,
+            content_digest = %(content_digest)s as digest_matched,
+            case when content_digest = %(content_digest)s then false else (
+                row (encounter.individual_id,
+                    encounter.site_id,
+                    encounter.encountered,
+                    encounter.age,
+                    regexp_replace(encounter.details::text, '"urn:uuid:[a-f0-9-]{36}"', '""', 'g'))::text
+                !=
+                row (%(individual_id)s::integer,
+                        %(site_id)s::integer,
+                        %(encountered)s::timestamp with time zone,
+                        %(age)s::interval,
+                        regexp_replace(%(details)s::jsonb::text, '"urn:uuid:[a-f0-9-]{36}"', '""', 'g'))::text
+            ) end as data_changed
+        from warehouse.encounter
+        where identifier = %(identifier)s
+        for update
+        """, data, prepare = True)
 
     # Nothing found → create
     if not encounters:
@@ -207,14 +1439,16 @@ def upsert_encounter(db: DatabaseSession,
                     site_id,
                     encountered,
                     age,
-                    details)
+                    details,
+                    content_digest)
                 values (
                     %(identifier)s,
                     %(individual_id)s,
                     %(site_id)s,
                     %(encountered)s::timestamp with time zone,
                     %(age)s,
-                    %(details)s)
+                    %(details)s,
+                    %(content_digest)s)
         returning encounter_id as id, identifier
         """, data)
 
@@ -226,6 +1460,10 @@ def upsert_encounter(db: DatabaseSession,
 
         if encounter.data_changed==False:
             LOG.info(f"Skipping upsert for encounter {encounter.id} «{identifier}» (no change).")
+
+            if not encounter.digest_matched:
+                update_content_digest(db, "encounter", encounter.id, digest)
+
             return encounter
 
         encounter = db.fetch_row("""
@@ -234,7 +1472,8 @@ def upsert_encounter(db: DatabaseSession,
                     site_id = %(site_id)s,
                     encountered = %(encountered)s,
                     age = %(age)s,
-                    details = %(details)s
+                    details = %(details)s,
+                    content_digest = %(content_digest)s
             where encounter_id = %(encounter_id)s
                 returning encounter_id as id, identifier
         """, { **data, "encounter_id": encounter.id })
@@ -249,6 +1488,27 @@ def upsert_encounter(db: DatabaseSession,
     return encounter
 
 
+UUID_REFERENCE = re.compile(r"urn:uuid:[a-f0-9-]{36}")
+
+
+def without_uuid_references(value: Any) -> Any:
+    """
+    Returns a copy of the JSON *value* with ``urn:uuid:`` strings emptied, as
+    :func:`upsert_encounter` ignores them when comparing details.
+
+    >>> without_uuid_references({"a": ["urn:uuid:0d2c1d3c-1b5e-4b8a-9a4c-6f0e2a1b3c4d", "b"], "c": 1})
+    {'a': ['', 'b'], 'c': 1}
+    """
+    if isinstance(value, dict):
+        return { key: without_uuid_references(item) for key, item in value.items() }
+    elif isinstance(value, list):
+        return [ without_uuid_references(item) for item in value ]
+    elif isinstance(value, str) and UUID_REFERENCE.fullmatch(value):
+        return ""
+    else:
+        return value
+
+
 def find_sample_by_id(db: DatabaseSession, sample_id: int) -> Any:
     """
     Find sample by *sample_id* and return sample.
@@ -260,7 +1520,7 @@ def find_sample_by_id(db: DatabaseSession, sample_id: int) -> Any:
           from warehouse.sample
          where sample_id = %s
             for update
-        """, (sample_id,))
+        """, (sample_id,), prepare = True)
 
     if not sample:
         LOG.error(f"No sample with id «{sample_id}» found")
@@ -270,6 +1530,7 @@ def find_sample_by_id(db: DatabaseSession, sample_id: int) -> Any:
     return sample
 
 
+@ledger.timed("write")
 def update_sample(db: DatabaseSession,
                   sample,
                   encounter_id: Optional[int]=None) -> Optional[MinimalSampleRecord]:
@@ -345,7 +1606,7 @@ def find_sample(db: DatabaseSession, identifier: str, for_update = True) -> Any:
           from warehouse.sample
          where identifier = %s or
                collection_identifier = %s
-        """ + query_ending, (identifier,identifier,))
+        """ + query_ending, (identifier,identifier,), prepare = True)
 
     if not sample:
         LOG.info(f"No sample with identifier «{identifier}» found")
@@ -358,9 +1619,19 @@ def find_sample(db: DatabaseSession, identifier: str, for_update = True) -> Any:
 def find_location(db: DatabaseSession, scale: str, identifier: str) -> Any:
     """
     Find a location by *scale* and *identifier*.
+
+    Locations are served from the session's :func:`dimension_cache` when
+    possible.
     """
     LOG.debug(f"Looking up location {(scale, identifier)}")
 
+    cache = dimension_cache(db, "location", scale)
+    location = cache.get(identifier)
+
+    if location:
+        LOG.info(f"Found location {location.id} as {(scale, identifier)}")
+        return location
+
     location = db.fetch_row("""
         select location_id as id, scale, identifier, hierarchy
           from warehouse.location
@@ -371,10 +1642,13 @@ def find_location(db: DatabaseSession, scale: str, identifier: str) -> Any:
         LOG.error(f"No location for {(scale, identifier)}")
         return None
 
+    cache.add(location)
+
     LOG.info(f"Found location {location.id} as {(scale, identifier)}")
     return location
 
 
+@ledger.timed("write")
 def upsert_location(db: DatabaseSession,
                     scale: str,
                     identifier: str,
@@ -466,6 +1740,7 @@ def upsert_location(db: DatabaseSession,
     return location
 
 
+@ledger.timed("write")
 def upsert_encounter_location(db: DatabaseSession,
                               encounter_id: int,
                               relation: str,
@@ -545,6 +1820,7 @@ def upsert_encounter_location(db: DatabaseSession,
     assert encounter_loc, "Upsert affected no rows!"
 
 
+@ledger.timed("write")
 def upsert_presence_absence(db: DatabaseSession,
                             identifier: str,
                             sample_id: int,
@@ -559,12 +1835,15 @@ def upsert_presence_absence(db: DatabaseSession,
     """
     LOG.debug(f"Upserting presence_absence «{identifier}»")
 
+    digest = content_digest(sample_id, target_id, present, details or None)
+
     data = {
         "identifier": identifier,
         "sample_id": sample_id,
         "target_id": target_id,
         "present": present,
-        "details": Json(details) if details else None
+        "details": Json(details) if details else None,
+        "content_digest": digest,
     }
 
     with db.cursor() as cursor:
@@ -574,7 +1853,8 @@ def upsert_presence_absence(db: DatabaseSession,
                 sample_id,
                 target_id,
                 present,
-                (
+                content_digest = %(content_digest)s as digest_matched,
+                case when content_digest = %(content_digest)s then false else (
                     row (sample_id,
                         target_id,
                         present,
@@ -584,7 +1864,7 @@ def upsert_presence_absence(db: DatabaseSession,
                     %(target_id)s::integer,
                     %(present)s::boolean,
                     coalesce(details, '{}'::jsonb) || coalesce(%(details)s, '{}')::jsonb)::text
-                ) as data_changed
+                ) end as data_changed
             from warehouse.presence_absence
             where identifier = %(identifier)s
             for update
@@ -601,13 +1881,15 @@ def upsert_presence_absence(db: DatabaseSession,
                     sample_id,
                     target_id,
                     present,
-                    details)
+                    details,
+                    content_digest)
                 values (
                     %(identifier)s,
                     %(sample_id)s,
                     %(target_id)s,
                     %(present)s,
-                    %(details)s)
+                    %(details)s,
+                    %(content_digest)s)
             returning presence_absence_id as id, identifier
             """, data)
 
@@ -619,6 +1901,10 @@ def upsert_presence_absence(db: DatabaseSession,
 
         if presence_absence.data_changed==False:
             LOG.info(f"Skipping upsert for presence_absence {presence_absence.id} «{identifier}» (no change).")
+
+            if not presence_absence.digest_matched:
+                update_content_digest(db, "presence_absence", presence_absence.id, digest)
+
             return presence_absence
         else:
             if presence_absence.present != present:
@@ -633,7 +1919,8 @@ def upsert_presence_absence(db: DatabaseSession,
                 set sample_id = %(sample_id)s,
                     target_id = %(target_id)s,
                     present = %(present)s,
-                    details = coalesce(presence_absence.details, '{}'::jsonb) || coalesce(%(details)s, '{}')::jsonb
+                    details = coalesce(presence_absence.details, '{}'::jsonb) || coalesce(%(details)s, '{}')::jsonb,
+                    content_digest = %(content_digest)s
             where presence_absence_id = %(presence_absence_id)s
                 returning presence_absence_id as id, identifier
         """, { **data, "presence_absence_id": presence_absence.id })
@@ -649,12 +1936,126 @@ def upsert_presence_absence(db: DatabaseSession,
     return presence_absence
 
 
+@ledger.timed("write")
+def upsert_presence_absences(db: DatabaseSession, results: Sequence[Mapping[str, Any]], page_size: int = 1000) -> List[Any]:
+    """
+    Upsert many presence_absence *results* by their identifiers, using one
+    statement per *page_size* results instead of several per result.
+
+    Each item of *results* is a mapping with the keys ``identifier``,
+    ``sample_id``, ``target_id``, ``present``, and ``details``, as for the
+    parameters of :func:`upsert_presence_absence`, and is applied the same
+    way: existing results are updated only if something changed, merging in
+    the new *details*, and a warning is logged if ``present``, ``sample_id``,
+    or ``target_id`` change.  Results repeating an earlier identifier are
+    combined with it, as if applied in order.
+
+    Results whose content digest matches the one stored for their identifier
+    are found with a cheap lookup first and not sent in the upsert at all.
+
+    Returns one row per item of *results*, in the same order, with
+    ``presence_absence_id``, ``identifier``, and ``status`` (``created``,
+    ``updated``, or ``unchanged``) attributes.
+    """
+    if not results:
+        return []
+
+    combined: Dict[str, Dict[str, Any]] = {}
+
+    for result in results:
+        previous = combined.get(result["identifier"])
+
+        if previous:
+            combined[result["identifier"]] = {
+                **result,
+                "details": { **(previous["details"] or {}), **(result["details"] or {}) } or None,
+            }
+        else:
+            combined[result["identifier"]] = dict(result)
+
+    LOG.debug(f"Upserting {len(combined):,} presence_absence results")
+
+    for result in combined.values():
+        result["content_digest"] = content_digest(
+            result["sample_id"], result["target_id"], result["present"], result["details"] or None)
+
+    upserted: Dict[str, Any] = {
+        row.identifier: row
+            for row in db.fetch_values(FIND_UNCHANGED_PRESENCE_ABSENCES,
+                [ (result["identifier"], result["content_digest"]) for result in combined.values() ],
+                page_size = page_size) }
+
+    changed = [ result for result in combined.values() if result["identifier"] not in upserted ]
+
+    rows = db.upsert_unnest(("warehouse", "presence_absence"),
+        {
+            "identifier": "text",
+            "sample_id": "integer",
+            "target_id": "integer",
+            "present": "boolean",
+            "details": "jsonb",
+            "content_digest": "bytea",
+        },
+        [ { **result, "details": Json(result["details"]) if result["details"] else None } for result in changed ],
+        conflict  = ["identifier"],
+        merge     = ["details"],
+        digest    = "content_digest",
+        returning = ["presence_absence_id", "identifier"],
+        previous  = ["sample_id", "target_id", "present"],
+        page_size = page_size)
+
+    for row, result in zip(rows, changed):
+        upserted[row.identifier] = row
+
+        if row.status == "updated":
+            for field in ["present", "sample_id", "target_id"]:
+                previous_value = getattr(row, f"previous_{field}")
+
+                if previous_value != result[field]:
+                    LOG.warning(f"upsert_presence_absence: {field} is changing on presence_absence {row.presence_absence_id} «{row.identifier}» from {previous_value} to {result[field]}")
+
+        LOG.debug(f"Upserted presence_absence {row.presence_absence_id} «{row.identifier}» ({row.status})")
+
+    statuses = Counter(row.status for row in upserted.values())
+
+    LOG.info(
+        f"Upserted {len(upserted):,} presence_absence results: "
+        + ", ".join(f"{statuses[status]:,} {status}" for status in ["created", "updated", "unchanged"]))
+
+    return [ upserted[result["identifier"]] for result in results ]
+
+
+# Finds the results whose stored digest matches, which are unchanged.  The
+# columns match those returned by DatabaseSession.upsert_unnest() in
+# upsert_presence_absences().
+FIND_UNCHANGED_PRESENCE_ABSENCES = """
+    select presence_absence_id,
+           identifier,
+           sample_id as previous_sample_id,
+           target_id as previous_target_id,
+           present as previous_present,
+           'unchanged' as status
+      from warehouse.presence_absence
+      join (values %s) as input (identifier, content_digest)
+           using (identifier, content_digest)
+    """
+
+
 def find_or_create_target(db: DatabaseSession, identifier: str, control: bool) -> Any:
     """
     Select presence_absence test target by *identifier*, or insert it if it doesn't exist.
+
+    Targets are served from the session's :func:`dimension_cache` when possible.
     """
     LOG.debug(f"Looking up target «{identifier}»")
 
+    cache = dimension_cache(db, "target")
+    target = cache.get(identifier)
+
+    if target:
+        LOG.info(f"Found target {target.id} «{target.identifier}»")
+        return target
+
     target = db.fetch_row("""
         select target_id as id, identifier
           from warehouse.target
@@ -679,6 +2080,8 @@ def find_or_create_target(db: DatabaseSession, identifier: str, control: bool) -
 
         LOG.info(f"Created target {target.id} «{target.identifier}»")
 
+    cache.add(target)
+
     return target
 
 
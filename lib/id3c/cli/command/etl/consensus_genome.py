@@ -35,7 +35,7 @@ from id3c.cli.command import with_database_session
 from id3c.db.session import DatabaseSession
 from id3c.db.datatypes import Json
 from id3c.db.types import GenomeRecord, MinimalSampleRecord, OrganismRecord, SequenceReadSetRecord
-from . import etl, find_sample
+from . import etl, find_sample, ledger, receiving_records, with_run_ledger
 
 
 LOG = logging.getLogger(__name__)
@@ -51,6 +51,7 @@ REVISION = 1
 
 
 @etl.command("consensus-genome", help = __doc__)
+@with_run_ledger
 @with_database_session
 
 def etl_consensus_genome(*, db: DatabaseSession):
@@ -62,14 +63,8 @@ def etl_consensus_genome(*, db: DatabaseSession):
     # command don't try to process the same consensus genome records.
     LOG.debug("Fetching unprocessed consensus genome records")
 
-    consensus_genome = db.cursor("consensus genome")
-    consensus_genome.execute("""
-        select consensus_genome_id as id, document, received
-          from receiving.consensus_genome
-         where not processing_log @> %s
-         order by id
-           for update
-        """, (Json([{ "revision": REVISION }]),))
+    consensus_genome = receiving_records(db, "consensus_genome", { "revision": REVISION },
+        columns = ["received"])
 
     for record in consensus_genome:
         with db.savepoint(f"consensus genome record {record.id}"):
@@ -168,6 +163,7 @@ def find_or_create_sequence_read_set(db: DatabaseSession, document: dict, sample
     return sequence_read_set
 
 
+@ledger.timed("write")
 def update_sequence_read_set_details(db, sequence_read_set_id: int,
                                      organism: OrganismRecord, status: str) -> None:
     """
@@ -240,6 +236,7 @@ def find_organism(db: DatabaseSession, lineage: str) -> Optional[OrganismRecord]
     return organism
 
 
+@ledger.timed("write")
 def upsert_genome(db: DatabaseSession, sequence_read_set: SequenceReadSetRecord,
                   organism: OrganismRecord, document: dict) -> GenomeRecord:
     """
@@ -279,6 +276,7 @@ def upsert_genome(db: DatabaseSession, sequence_read_set: SequenceReadSetRecord,
     return genome
 
 
+@ledger.timed("write")
 def upsert_genomic_sequence(db: DatabaseSession, genome: GenomeRecord, masked_consensus: dict) -> Any:
     """
     Upsert genomic sequence given a *genome* record and some information from a
@@ -315,6 +313,7 @@ def upsert_genomic_sequence(db: DatabaseSession, genome: GenomeRecord, masked_co
     return genomic_sequence
 
 
+@ledger.timed("write")
 def mark_processed(db, consensus_genome_id: int, entry: Mapping) -> None:
     LOG.debug(f"Marking consensus genome document {consensus_genome_id} as processed")
 
@@ -334,6 +333,8 @@ def mark_processed(db, consensus_genome_id: int, entry: Mapping) -> None:
              where consensus_genome_id = %(consensus_genome_id)s
             """, data)
 
+    ledger.count(entry.get("status", "processed"), db = db)
+
 
 class UnknownOrganismError(ValueError):
     """
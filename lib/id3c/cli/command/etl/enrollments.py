@@ -15,6 +15,10 @@ from id3c.db.session import DatabaseSession
 from id3c.db.datatypes import Json
 from . import (
     etl,
+    ledger,
+    with_run_ledger,
+    dimension_cache,
+    receiving_records,
     find_or_create_site,
     find_location,
     upsert_individual,
@@ -52,6 +56,7 @@ EXPECTED_COLLECTION_IDENTIFIER_SETS = {
 
 
 @etl.command("enrollments", help = __doc__)
+@with_run_ledger
 @with_database_session
 
 def etl_enrollments(*, db: DatabaseSession):
@@ -68,14 +73,10 @@ def etl_enrollments(*, db: DatabaseSession):
     # command don't try to process the same enrollments.
     LOG.debug("Fetching unprocessed enrollments")
 
-    enrollments = db.cursor("enrollments")
-    enrollments.execute("""
-        select enrollment_id as id, document
-          from receiving.enrollment
-         where not processing_log @> %s
-         order by id
-           for update
-        """, (Json([{ "etl": ETL_NAME, "revision": REVISION }]),))
+    dimension_cache(db, "site").warm()
+    dimension_cache(db, "location", "tract").warm()
+
+    enrollments = receiving_records(db, "enrollment", { "etl": ETL_NAME, "revision": REVISION })
 
     for enrollment in enrollments:
         with db.savepoint(f"enrollment {enrollment.id}"):
@@ -167,14 +168,15 @@ def process_samples(db: DatabaseSession,
             "type": sample["type"],
         }
 
-        upsert_sample(db,
-            update_identifiers          = False,
-            overwrite_collection_date   = False,
-            identifier                  = None,
-            collection_identifier       = identifier.uuid,
-            collection_date             = None,
-            encounter_id                = encounter_id,
-            additional_details          = details)
+        with ledger.stage("write"):
+            upsert_sample(db,
+                update_identifiers          = False,
+                overwrite_collection_date   = False,
+                identifier                  = None,
+                collection_identifier       = identifier.uuid,
+                collection_date             = None,
+                encounter_id                = encounter_id,
+                additional_details          = details)
 
     # XXX TODO: Should this delete existing linked samples which
     # weren't mentioned in this enrollment document?  This would
@@ -306,6 +308,7 @@ def encounter_locations(document: dict) -> dict:
     }
 
 
+@ledger.timed("write")
 def mark_processed(db, enrollment_id: int) -> None:
     LOG.debug(f"Marking enrollment {enrollment_id} as processed")
 
@@ -325,6 +328,8 @@ def mark_processed(db, enrollment_id: int) -> None:
              where enrollment_id = %(enrollment_id)s
             """, data)
 
+    ledger.count("processed", db = db)
+
 
 def assigned_sex(document: dict) -> Any:
     """
@@ -7,7 +7,7 @@ import click
 import logging
 from collections import defaultdict
 from datetime import datetime, timezone
-from typing import Any, List, Dict, Optional, Tuple
+from typing import Any, Iterable, List, Dict, Optional, Tuple
 from urllib.parse import urlparse
 from urllib.request import urlopen
 from fhir.resources.bundle import Bundle, BundleEntry
@@ -22,13 +22,22 @@ from fhir.resources.observation import Observation
 from fhir.resources.patient import Patient
 from fhir.resources.questionnaireresponse import QuestionnaireResponse
 from fhir.resources.specimen import Specimen
-from id3c.cli.command import with_database_session
-from id3c.db import find_identifier, upsert_sample
+from id3c.cli.command import DatabaseSessionAction, with_database_session
+from id3c.db import find_identifier, find_identifiers, upsert_sample
 from id3c.db.session import DatabaseSession
 from id3c.db.datatypes import Json
 from id3c.utils import getattrpath
+from . import fhir_fast
 from . import (
     etl,
+    ledger,
+    dimension_cache,
+    process_receiving_records,
+    savepoint_batches,
+    with_backfill,
+    with_run_ledger,
+    with_savepoint_batch_size,
+    with_workers,
 
     find_or_create_site,
     find_or_create_target,
@@ -87,44 +96,80 @@ EXPECTED_COLLECTION_IDENTIFIER_SETS = [
 ]
 EXPECTED_SAMPLE_IDENTIFIER_SETS = ['samples']
 
+# Documents about the same encounter must be processed in order, as the last
+# one processed wins.  Documents without an Encounter, like those with only a
+# DiagnosticReport, are unrelated.
+ENCOUNTER_KEY = """
+    coalesce(
+        jsonb_path_query_first(document::jsonb, '$.entry[*].resource ? (@.resourceType == "Encounter").identifier[0].value') #>> '{}',
+        document->>'id')
+    """
+
 @etl.command("fhir", help = __doc__)
 
-@with_database_session
-def etl_fhir(*, db: DatabaseSession):
+@click.option("--strict",
+    is_flag = True,
+    help = "Build and validate the full FHIR models of every bundle, instead "
+           "of only those the fast path can't decode")
+
+@with_run_ledger
+@with_database_session(pass_action = True, periodic_commits = True)
+@with_savepoint_batch_size
+@with_workers
+@with_backfill
+def etl_fhir(*, db: DatabaseSession, action: DatabaseSessionAction, savepoint_batch_size: int, workers: Optional[int], claim_size: int, backfill: Optional[str], range_size: int, strict: bool):
     LOG.debug(f"Starting the FHIR ETL routine, revision {REVISION}")
 
     # Fetch and iterate over FHIR documents that aren't processed
     #
-    # Use a server-side cursor by providing a name and limit to one fetched
-    # record at a time, to limit local process size.
-    #
     # Rows we fetch are locked for update so that two instances of this
     # command don't try to process the same FHIR documents.
     LOG.debug("Fetching unprocessed FHIR documents")
 
-    fhir_documents = db.cursor("fhir")
-    fhir_documents.itersize = 1
-    fhir_documents.execute("""
-        select fhir_id as id, document
-          from receiving.fhir
-         where not processing_log @> %s
-         order by id
-           for update
-        """, (Json([{ "etl": ETL_NAME, "revision": REVISION }]),))
-
-    for record in fhir_documents:
-        with db.savepoint(f"FHIR document {record.id}"):
+    process_receiving_records(db, action,
+        lambda db, fhir_documents: process_fhir_documents(db, fhir_documents, savepoint_batch_size, strict),
+        "fhir", { "etl": ETL_NAME, "revision": REVISION },
+        ordered_by = ENCOUNTER_KEY,
+        workers = workers,
+        claim_size = claim_size,
+        backfill = backfill,
+        range_size = range_size)
+
+
+def process_fhir_documents(db: DatabaseSession, fhir_documents: Iterable[Any], savepoint_batch_size: int, strict: bool = False) -> None:
+    """
+    Processes the unprocessed *fhir_documents*.
+
+    Bundles are decoded by :func:`decode_bundle`, with the full FHIR models
+    if *strict* is true.
+    """
+    dimension_cache(db, "target").warm()
+    dimension_cache(db, "site").warm()
+    dimension_cache(db, "location", "tract").warm()
+
+    batches = savepoint_batches(db, fhir_documents, lambda record: f"FHIR document {record.id}", savepoint_batch_size)
+
+    for record, savepoint in batches:
+        with savepoint:
             LOG.info(f"Processing FHIR document {record.id}")
 
             assert_bundle_collection(record.document)
-            bundle      = Bundle(record.document)
-            resources   = extract_resources(bundle)
+            bundle      = decode_bundle(record.document, strict)
+            index       = BundleIndex(bundle)
+            resources   = index.by_type
 
             # Loop over every Resource the Bundle entry, processing what is
             # needed along the way.
             try:
                 assert_required_resource_types_present(resources)
-                process_bundle_entries(db, bundle)
+
+                # Resolve all of the bundle's specimen barcodes in one query
+                find_identifiers(db, (
+                    (identifier(specimen, f"{INTERNAL_SYSTEM}/sample") or "").strip()
+                        for specimen in resources.get("Specimen", [])
+                         if specimen.identifier))
+
+                process_bundle_entries(db, index)
 
             except SkipBundleError as error:
                 LOG.warning(f"Skipping bundle in FHIR document «{record.id}»: {error}")
@@ -149,25 +194,42 @@ def assert_bundle_collection(document: Dict[str, Any]):
         f"type «{document['type']}»."
 
 
-def process_bundle_entries(db: DatabaseSession, bundle: Bundle):
+def decode_bundle(document: Dict[str, Any], strict: bool = False) -> Any:
+    """
+    Returns the Bundle *document* decoded by the fast path (see
+    :mod:`~id3c.cli.command.etl.fhir_fast`), or as a full
+    :class:`~fhir.resources.bundle.Bundle` if *strict* is true or the fast
+    path can't decode it.
+    """
+    with ledger.stage("decode"):
+        if not strict:
+            try:
+                return fhir_fast.decode_bundle(document)
+            except fhir_fast.FastPathError as error:
+                LOG.debug(f"Decoding bundle with the full FHIR models, as the fast path can't: {error}")
+
+        return Bundle(document)
+
+
+def process_bundle_entries(db: DatabaseSession, index: "BundleIndex"):
     """
     Loads Encounter, DiagnosticReport, and other dependent FHIR DomainResources
-    from a given *Bundle* into the database warehouse as appropriate for each
-    Resource type.
+    from the Bundle of a given *index* into the database warehouse as
+    appropriate for each Resource type.
     Ensures that all Encounter resources are processed before DiagnosticReport
     resources to avoid potential :class:`SampleNotFoundError`s.
     """
-    for entry in bundle.entry:
-        process_encounter_bundle_entry(db, bundle, entry)
+    for entry in index.entries:
+        process_encounter_bundle_entry(db, index, entry)
 
-    for entry in bundle.entry:
-        process_diagnostic_report_bundle_entry(db, bundle, entry)
+    for entry in index.entries:
+        process_diagnostic_report_bundle_entry(db, index, entry)
 
 
-def process_encounter_bundle_entry(db: DatabaseSession, bundle: Bundle, entry: BundleEntry):
+def process_encounter_bundle_entry(db: DatabaseSession, index: "BundleIndex", entry: BundleEntry):
     """
-    Given an Encounter resource *entry* from a given *bundle*, processes the
-    relevant information into the database.
+    Given an Encounter resource *entry* from the Bundle of a given *index*,
+    processes the relevant information into the database.
     """
     resource, resource_type = resource_and_resource_type(entry)
 
@@ -176,8 +238,8 @@ def process_encounter_bundle_entry(db: DatabaseSession, bundle: Bundle, entry: B
 
     LOG.debug(f"Processing Encounter Resource «{entry.fullUrl}».")
 
-    related_resources = extract_related_resources(bundle, entry)
-    immunization_resources = extract_immunization_resources(bundle)
+    related_resources = extract_related_resources(index, entry)
+    immunization_resources = extract_immunization_resources(index)
 
     encounter = process_encounter(db, resource, related_resources, immunization_resources)
 
@@ -188,10 +250,10 @@ def process_encounter_bundle_entry(db: DatabaseSession, bundle: Bundle, entry: B
     process_locations(db, encounter.id, resource)
 
 
-def process_diagnostic_report_bundle_entry(db: DatabaseSession, bundle: Bundle, entry: BundleEntry):
+def process_diagnostic_report_bundle_entry(db: DatabaseSession, index: "BundleIndex", entry: BundleEntry):
     """
-    Given an DiagnosticReport resource *entry* from a given *bundle*, processes
-    the relevant information into the database.
+    Given an DiagnosticReport resource *entry* from the Bundle of a given
+    *index*, processes the relevant information into the database.
     """
     resource, resource_type = resource_and_resource_type(entry)
 
@@ -259,52 +321,74 @@ def resource_and_resource_type(entry: BundleEntry) -> Tuple[DomainResource, str]
     return entry.resource, entry.resource.resource_type
 
 
-def extract_resources(bundle: Bundle) -> Dict[str, List[DomainResource]]:
+class BundleIndex:
     """
-    Returns all top-level FHIR Resources in a given *bundle*, organized by
-    resource type.
+    Index of the entries of a FHIR *bundle*, built once per bundle so that
+    finding related resources doesn't rescan every entry of the bundle for
+    every Encounter, which is quadratic for large household bundles.
+
+    Top-level resources are indexed :attr:`by_url` (their entry's full URL),
+    :attr:`by_type` (in bundle order), and :attr:`by_reference` (the name of
+    their ``subject`` or ``encounter`` reference and the URL it refers to).
+
+    The bundle's resolved reference cache is also primed with every entry.
+    :meth:`FHIRReference.resolved` checks the cache of the referring resource
+    and each of its owners, up to the bundle, before scanning the bundle's
+    entries, so it then finds entries (e.g. a specimen) in constant time.
     """
-    resources: Dict[str, List[DomainResource]] = defaultdict(list)
+    #: Reference fields indexed :attr:`by_reference`.
+    REFERENCES = ("subject", "encounter")
 
-    for entry in bundle.entry:
-        resource, resource_type = resource_and_resource_type(entry)
-        resources[resource_type].append(resource)
+    def __init__(self, bundle: Bundle) -> None:
+        self.bundle = bundle
+        self.entries: List[BundleEntry] = bundle.entry
+        self.by_url: Dict[str, DomainResource] = {}
+        self.by_type: Dict[str, List[DomainResource]] = defaultdict(list)
+        self.by_reference: Dict[Tuple[str, str], List[DomainResource]] = defaultdict(list)
 
-    return resources
+        for entry in self.entries:
+            resource, resource_type = resource_and_resource_type(entry)
 
+            self.by_type[resource_type].append(resource)
 
-def extract_related_resources(bundle: Bundle, reference_entry: BundleEntry) -> Dict[str, List[DomainResource]]:
-    """
-    Finds all top-level FHIR Resources in a given *bundle* that contain a full
-    URL reference to a *reference_entry*. Returns these Resources organized by
-    resource type.
-    """
-    def is_related_resource(resource: DomainResource, type: str, url: str) -> bool:
+            # The first entry wins, as when scanning the bundle.
+            if entry.fullUrl and entry.fullUrl not in self.by_url:
+                self.by_url[entry.fullUrl] = resource
+                bundle.didResolveReference(entry.fullUrl, resource)
+
+            for name in self.REFERENCES:
+                reference = getattr(resource, name, None)
+
+                if reference and reference.reference:
+                    self.by_reference[name, reference.reference].append(resource)
+
+
+    def referring(self, name: str, url: str) -> List[DomainResource]:
         """
-        Returns True if the given *resource* has a *type* reference equal to the
-        given *url*. Otherwise, returns False.
+        Returns the top-level resources whose *name* reference (e.g.
+        ``encounter``) refers to *url*, in bundle order.
         """
-        reference_map = {
-            'Encounter': 'encounter',
-            'Patient': 'subject',
-        }
+        return self.by_reference.get((name, url), [])
 
-        reference = getattr(resource, reference_map[type], None)
-        if reference:
-            return reference.reference == url
 
-        return False
+def extract_related_resources(index: BundleIndex, reference_entry: BundleEntry) -> Dict[str, List[DomainResource]]:
+    """
+    Finds all top-level FHIR Resources in the Bundle of a given *index* that
+    contain a full URL reference to a *reference_entry*. Returns these
+    Resources organized by resource type.
+    """
+    reference_map = {
+        'Encounter': 'encounter',
+        'Patient': 'subject',
+    }
 
     resources: Dict[str, List[DomainResource]] = defaultdict(list)
 
     reference_type = reference_entry.resource.resource_type
     reference_url = reference_entry.fullUrl
 
-    for entry in bundle.entry:
-        resource, resource_type = resource_and_resource_type(entry)
-
-        if is_related_resource(resource, reference_type, reference_url):
-            resources[resource_type].append(resource)
+    for resource in index.referring(reference_map[reference_type], reference_url):
+        resources[resource.resource_type].append(resource)
 
     return resources
 
@@ -325,20 +409,16 @@ def extract_contained_resources(resource: DomainResource) -> Dict[str, List[Doma
     return resources
 
 
-def extract_immunization_resources(bundle: Bundle) -> Dict[str, List[DomainResource]]:
+def extract_immunization_resources(index: BundleIndex) -> Dict[str, List[DomainResource]]:
     """
-    Finds all top-level Immunization resources in a given FHIR *bundle* that contain a full
-    URL reference to a *patient* identifier. Returns these Resources organized by
-    resource type.
+    Finds all top-level Immunization resources in the FHIR Bundle of a given
+    *index*. Returns these Resources organized by resource type.
     """
 
     immunization_resources: Dict[str, List[DomainResource]] = defaultdict(list)
 
-    for entry in bundle.entry:
-        resource, resource_type = resource_and_resource_type(entry)
-
-        if resource_type == 'Immunization':
-            immunization_resources['Immunization'].append(resource)
+    if index.by_type.get('Immunization'):
+        immunization_resources['Immunization'] = list(index.by_type['Immunization'])
 
     return immunization_resources
 
@@ -698,14 +778,15 @@ def process_encounter_samples(db: DatabaseSession, encounter: Encounter, encount
 
         # XXX TODO: Improve details object here; the current approach produces
         # an object like {"coding": [{…}]} which isn't very useful.
-        upsert_sample(db,
-            update_identifiers          = False,
-            overwrite_collection_date   = False,
-            identifier                  = sample_identifier,
-            collection_identifier       = collection_identifier,
-            collection_date             = collection_date,
-            encounter_id                = encounter_id,
-            additional_details          = additional_details)
+        with ledger.stage("write"):
+            upsert_sample(db,
+                update_identifiers          = False,
+                overwrite_collection_date   = False,
+                identifier                  = sample_identifier,
+                collection_identifier       = collection_identifier,
+                collection_date             = collection_date,
+                encounter_id                = encounter_id,
+                additional_details          = additional_details)
 
 def encounter_age(encounter: Encounter, resources: Dict[str, List[DomainResource]]) -> Optional[str]:
     """
@@ -971,6 +1052,7 @@ def mark_skipped(db, fhir_id: int) -> None:
     mark_processed(db, fhir_id, { "status": "skipped" })
 
 
+@ledger.timed("write")
 def mark_processed(db, fhir_id: int, entry = {}) -> None:
     LOG.debug(f"Marking FHIR document {fhir_id} as processed")
 
@@ -991,6 +1073,8 @@ def mark_processed(db, fhir_id: int, entry = {}) -> None:
              where fhir_id = %(fhir_id)s
             """, data)
 
+    ledger.count(entry.get("status", "processed"), db = db)
+
 
 class SkipBundleError(Exception):
     pass
@@ -0,0 +1,399 @@
+"""
+Fast-path decoding of FHIR bundles for the FHIR ETL.
+
+Building a :class:`fhir.resources.bundle.Bundle` constructs and validates
+every element of every resource in the bundle, which for our bundles costs
+more than all of the database work done with them.  :func:`decode_bundle`
+instead checks only the fields the ETL reads (:data:`ELEMENTS`) of only the
+resource types it expects (:data:`RESOURCE_TYPES`), and returns views over
+the raw document which provide the same attributes as the full models for
+those fields, as well as ``resource_type``, ``as_json()``,
+``resolved()`` for references, and ``isostring`` for dates.
+
+Reading any other field of a view raises an :exc:`AttributeError`, so the
+ETL can't silently read a field the fast path doesn't check.  Documents
+which don't pass the checks raise a :exc:`FastPathError` and should be
+decoded with the full models instead.
+"""
+import logging
+import re
+from typing import Any, Dict, Optional
+
+
+LOG = logging.getLogger(__name__)
+
+
+class Date:
+    """
+    Marker for a field holding a FHIR date or dateTime, viewed as a
+    :class:`DateView`.
+    """
+
+
+#: Resource types decoded by the fast path.
+RESOURCE_TYPES = {
+    "Patient",
+    "Encounter",
+    "Specimen",
+    "Observation",
+    "DiagnosticReport",
+    "QuestionnaireResponse",
+    "Location",
+    "Immunization",
+}
+
+_RESOURCE = {
+    "id":           str,
+    "meta":         "Meta",
+    "identifier":   ["Identifier"],
+    "contained":    ["Resource"],
+}
+
+#: Fields read by the ETL for each type of element, by the kind of their
+#: value: ``str``, ``bool``, ``int``, :class:`Date`, the name of an element
+#: type ("Resource" for any of :data:`RESOURCE_TYPES`), or a list of one of
+#: those for an array.
+ELEMENTS: Dict[str, Dict[str, Any]] = {
+    "Bundle":                           { "entry": ["BundleEntry"] },
+    "BundleEntry":                      { "fullUrl": str, "resource": "Resource" },
+
+    "Patient": {
+        **_RESOURCE,
+        "gender":                       str,
+        "communication":                ["PatientCommunication"],
+    },
+    "Encounter": {
+        **_RESOURCE,
+        "subject":                      "Reference",
+        "partOf":                       "Reference",
+        "period":                       "Period",
+        "location":                     ["EncounterLocation"],
+        "reasonCode":                   ["CodeableConcept"],
+    },
+    "Specimen": {
+        **_RESOURCE,
+        "subject":                      "Reference",
+        "type":                         "CodeableConcept",
+        "note":                         ["Annotation"],
+        "collection":                   "SpecimenCollection",
+    },
+    "Observation": {
+        **_RESOURCE,
+        "subject":                      "Reference",
+        "encounter":                    "Reference",
+        "specimen":                     "Reference",
+        "device":                       "Reference",
+        "code":                         "CodeableConcept",
+        "valueBoolean":                 bool,
+        "valueCodeableConcept":         "CodeableConcept",
+    },
+    "DiagnosticReport": {
+        **_RESOURCE,
+        "subject":                      "Reference",
+        "encounter":                    "Reference",
+        "specimen":                     ["Reference"],
+        "result":                       ["Reference"],
+        "effectiveDateTime":            Date,
+    },
+    "QuestionnaireResponse": {
+        **_RESOURCE,
+        "subject":                      "Reference",
+        "encounter":                    "Reference",
+        "item":                         ["QuestionnaireResponseItem"],
+    },
+    "Location": {
+        **_RESOURCE,
+        "type":                         ["CodeableConcept"],
+        "partOf":                       "Reference",
+    },
+    "Immunization": {
+        **_RESOURCE,
+        "patient":                      "Reference",
+        "encounter":                    "Reference",
+    },
+
+    "Annotation":                       { "text": str },
+    "CodeableConcept":                  { "coding": ["Coding"], "text": str },
+    "Coding":                           { "system": str, "code": str, "display": str },
+    "EncounterLocation":                { "location": "Reference" },
+    "Identifier":                       { "system": str, "value": str },
+    "Meta":                             { "source": str },
+    "PatientCommunication":             { "language": "CodeableConcept", "preferred": bool },
+    "Period":                           { "start": Date, "end": Date },
+    "QuestionnaireResponseItem":        { "linkId": str, "answer": ["QuestionnaireResponseItemAnswer"] },
+    "QuestionnaireResponseItemAnswer":  { "valueInteger": int },
+    "Reference":                        { "reference": str, "identifier": "Identifier", "display": str },
+    "SpecimenCollection":               { "collectedDateTime": Date, "collectedPeriod": "Period" },
+}
+
+# Full dates and dateTimes only.  Partial dates (e.g. "2020-01") are left to
+# the full models, which normalize them.
+DATE = re.compile(r"\d{4}-\d{2}-\d{2}(T\d{2}:\d{2}:\d{2}(\.\d+)?(Z|[+-]\d{2}:\d{2}))?")
+
+
+def decode_bundle(document: dict) -> "ElementView":
+    """
+    Returns a view of the FHIR Bundle *document*, after checking that the
+    fields the ETL reads are as expected.
+
+    Raises a :exc:`FastPathError` if they aren't or *document* contains a
+    resource type other than :data:`RESOURCE_TYPES`.
+
+    >>> bundle = decode_bundle({
+    ...     "resourceType": "Bundle",
+    ...     "type": "collection",
+    ...     "entry": [
+    ...         {"fullUrl": "urn:uuid:1", "resource": {"resourceType": "Patient", "gender": "female"}},
+    ...         {"fullUrl": "urn:uuid:2", "resource": {
+    ...             "resourceType": "Encounter",
+    ...             "subject": {"reference": "urn:uuid:1"},
+    ...             "period": {"start": "2020-01-01T10:00:00-08:00"}}}]})
+    >>> class Patient: # like fhir.resources.patient.Patient
+    ...     resource_type = "Patient"
+
+    >>> encounter = bundle.entry[1].resource
+    >>> encounter.resource_type
+    'Encounter'
+    >>> encounter.period.start.isostring
+    '2020-01-01T10:00:00-08:00'
+    >>> encounter.subject.resolved(Patient) is bundle.entry[0].resource
+    True
+    >>> encounter.subject.resolved(Patient).gender
+    'female'
+    >>> encounter.partOf is None
+    True
+    >>> encounter.status
+    Traceback (most recent call last):
+        ...
+    AttributeError: Encounter field «status» isn't read by the fast path
+
+    >>> decode_bundle({"entry": [{"resource": {"resourceType": "Condition"}}]})
+    Traceback (most recent call last):
+        ...
+    id3c.cli.command.etl.fhir_fast.FastPathError: Bundle.entry[0].resource: unsupported resource type «Condition»
+    >>> decode_bundle({"entry": [{"resource": {"resourceType": "Patient", "identifier": {}}}]})
+    Traceback (most recent call last):
+        ...
+    id3c.cli.command.etl.fhir_fast.FastPathError: Bundle.entry[0].resource.identifier: expected an array
+    >>> decode_bundle({"entry": [{"resource": {"resourceType": "Encounter", "period": {"start": "2020-01"}}}]})
+    Traceback (most recent call last):
+        ...
+    id3c.cli.command.etl.fhir_fast.FastPathError: Bundle.entry[0].resource.period.start: expected a full date or dateTime
+    """
+    check("Bundle", document, "Bundle")
+
+    return ElementView("Bundle", document)
+
+
+def check(kind: Any, value: Any, path: str) -> None:
+    """
+    Raises a :exc:`FastPathError` if *value* at *path* isn't of *kind* (see
+    :data:`ELEMENTS`).  Values of ``null`` are fine, as with the full models.
+    """
+    if value is None:
+        return
+
+    if isinstance(kind, list):
+        if not isinstance(value, list):
+            raise FastPathError(f"{path}: expected an array")
+
+        for index, item in enumerate(value):
+            check(kind[0], item, f"{path}[{index}]")
+
+    elif kind is Date:
+        if not isinstance(value, str) or not DATE.fullmatch(value):
+            raise FastPathError(f"{path}: expected a full date or dateTime")
+
+    elif isinstance(kind, str):
+        if not isinstance(value, dict):
+            raise FastPathError(f"{path}: expected an object")
+
+        if kind == "Resource":
+            kind = value.get("resourceType")
+
+            if kind not in RESOURCE_TYPES:
+                raise FastPathError(f"{path}: unsupported resource type «{kind}»")
+
+        for field, field_kind in ELEMENTS[kind].items():
+            check(field_kind, value.get(field), f"{path}.{field}")
+
+    # Exact types, as JSON booleans are also ints to Python.
+    elif type(value) is not kind:
+        raise FastPathError(f"{path}: expected {kind.__name__}")
+
+
+class ElementView:
+    """
+    View of the raw JSON *data* of a FHIR element of *type*, with an
+    attribute for each of its fields in :data:`ELEMENTS`.  Field values are
+    viewed as they're first read and kept, so that reading a field again
+    returns the same view.
+
+    Like the full models, each view knows its *owner* and keeps a cache of
+    resolved references, which :meth:`didResolveReference` adds to and
+    :meth:`ReferenceView.resolved` checks (up the chain of owners) before
+    looking through contained resources and the bundle.
+    """
+    def __init__(self, type: str, data: dict, owner: "ElementView" = None) -> None:
+        if type == "Resource":
+            type = data["resourceType"]
+
+        self.element_type = type
+        self.data = data
+        self._owner = owner
+        self._resolved: Dict[str, ElementView] = {}
+
+    def __getattr__(self, name: str) -> Any:
+        if name.startswith("_"):
+            raise AttributeError(name)
+
+        fields = ELEMENTS[self.element_type]
+
+        if name not in fields:
+            raise AttributeError(f"{self.element_type} field «{name}» isn't read by the fast path")
+
+        value = self._view(fields[name], self.data.get(name))
+        setattr(self, name, value)
+        return value
+
+    def _view(self, kind: Any, value: Any) -> Any:
+        if value is None:
+            return None
+        elif isinstance(kind, list):
+            return [ self._view(kind[0], item) for item in value ]
+        elif kind is Date:
+            return DateView(value)
+        elif isinstance(kind, str):
+            return VIEWS.get(kind, ElementView)(kind, value, self)
+        else:
+            return value
+
+    @property
+    def resource_type(self) -> str:
+        if self.element_type not in RESOURCE_TYPES:
+            raise AttributeError(f"{self.element_type} isn't a resource")
+
+        return self.element_type
+
+    def owningResource(self) -> Optional["ElementView"]:
+        """
+        Returns the resource this element is part of, if any.
+        """
+        owner = self._owner
+
+        while owner is not None and owner.element_type not in RESOURCE_TYPES:
+            owner = owner._owner
+
+        return owner
+
+    def owningBundle(self) -> Optional["ElementView"]:
+        """
+        Returns the bundle this element is part of, if any.
+        """
+        owner = self._owner
+
+        while owner is not None and owner.element_type != "Bundle":
+            owner = owner._owner
+
+        return owner
+
+    def didResolveReference(self, refid: str, resolved: "ElementView") -> None:
+        """
+        Caches *resolved* as the resource referred to by *refid* for this
+        element and the elements it owns.
+        """
+        self._resolved[refid] = resolved
+
+    def resolvedReference(self, refid: str) -> Optional["ElementView"]:
+        """
+        Returns the cached resource referred to by *refid* for this element,
+        if any.
+        """
+        if refid in self._resolved:
+            return self._resolved[refid]
+
+        return self._owner.resolvedReference(refid) if self._owner is not None else None
+
+    def as_json(self) -> dict:
+        """
+        Returns the element's JSON data, which must not be modified.
+        """
+        return self.data
+
+    def __repr__(self) -> str:
+        return f"<{self.element_type} view>"
+
+
+class ReferenceView(ElementView):
+    """
+    View of a FHIR Reference element.
+    """
+    def resolved(self, klass: Any) -> Optional[ElementView]:
+        """
+        Returns the resource referred to, if it's of the same type as the
+        FHIR model *klass* (e.g. :class:`fhir.resources.patient.Patient`),
+        from the cache of resolved references, the referring resource's
+        contained resources, or the bundle, in that order.
+        """
+        reference = self.reference
+
+        if not reference:
+            LOG.warning("No `reference` set, cannot resolve")
+            return None
+
+        refid = reference[1:] if reference.startswith("#") else reference
+        resolved = self.resolvedReference(refid)
+
+        if resolved is None:
+            resource = self.owningResource()
+
+            for contained in (resource.contained or []) if resource is not None else []:
+                if contained.data.get("id") == refid:
+                    resolved = contained
+                    break
+
+        if resolved is None:
+            bundle = self.owningBundle()
+
+            for entry in (bundle.entry or []) if bundle is not None else []:
+                if entry.fullUrl == reference:
+                    resolved = entry.resource
+                    break
+
+        if resolved is None:
+            LOG.warning(f"Not resolving reference «{reference}», which isn't in the bundle")
+            return None
+
+        if resolved.resource_type != klass.resource_type:
+            LOG.warning(f"Referenced resource «{reference}» is a {resolved.resource_type}, not a {klass.resource_type}")
+            return None
+
+        return resolved
+
+
+class DateView:
+    """
+    View of a FHIR date or dateTime *value*.
+    """
+    def __init__(self, value: str) -> None:
+        self.origval = value
+
+    @property
+    def isostring(self) -> str:
+        return self.origval
+
+    def as_json(self) -> str:
+        return self.origval
+
+
+VIEWS = {
+    "Reference": ReferenceView,
+}
+
+
+class FastPathError(ValueError):
+    """
+    Raised by :func:`decode_bundle` when a document can't be decoded by the
+    fast path.
+    """
+    pass
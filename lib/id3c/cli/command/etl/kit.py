@@ -16,7 +16,7 @@ from id3c.db import find_identifier
 from id3c.db.session import DatabaseSession
 from id3c.db.datatypes import Json
 from id3c.db.types import KitRecord, SampleRecord
-from . import etl, update_sample, find_sample_by_id
+from . import etl, ledger, prefetch_identifiers, receiving_records, savepoint_batches, with_run_ledger, with_savepoint_batch_size, update_sample, find_sample_by_id
 
 LOG = logging.getLogger(__name__)
 
@@ -44,25 +44,25 @@ def kits():
     pass
 
 @kits.command("enrollments", help = __doc__)
+@with_run_ledger
 @with_database_session
+@with_savepoint_batch_size
 
-def kit_enrollments(*, db: DatabaseSession):
+def kit_enrollments(*, db: DatabaseSession, savepoint_batch_size: int):
     LOG.debug(f"Starting the kit enrollments ETL routine, revision {ENROLLMENTS_REVISION}")
 
     expected_barcode_types = {"ScannedSelfSwab", "ManualSelfSwab"}
 
     LOG.debug("Fetching unprocessed enrollments")
-    enrollments = db.cursor("enrollments")
-    enrollments.execute("""
-        select enrollment_id as id, document
-          from receiving.enrollment
-         where not processing_log @> %s
-         order by id
-          for update
-        """, (Json([{ "etl": ETL_NAME, "revision": ENROLLMENTS_REVISION }]),))
-
-    for enrollment in enrollments:
-        with db.savepoint(f"enrollment {enrollment.id}"):
+    enrollments = receiving_records(db, "enrollment", { "etl": ETL_NAME, "revision": ENROLLMENTS_REVISION })
+
+    enrollments = prefetch_identifiers(db, enrollments,
+        lambda enrollment: (code.get("code") for code in enrollment.document.get("sampleCodes", [])))
+
+    batches = savepoint_batches(db, enrollments, lambda enrollment: f"enrollment {enrollment.id}", savepoint_batch_size)
+
+    for enrollment, savepoint in batches:
+        with savepoint:
             LOG.info(f"Processing enrollment {enrollment.id}")
 
             # Find encounter that should have been created
@@ -140,7 +140,7 @@ def find_encounter(db: DatabaseSession, identifier: str) -> Any:
           from warehouse.encounter
           join warehouse.site using (site_id)
          where encounter.identifier = %s
-        """, (identifier,))
+        """, (identifier,), prepare = True)
 
     if not encounter:
         return None
@@ -149,6 +149,7 @@ def find_encounter(db: DatabaseSession, identifier: str) -> Any:
     return encounter
 
 
+@ledger.timed("write")
 def upsert_kit_with_encounter(db: DatabaseSession,
                               identifier: str,
                               encounter_id: int,
@@ -207,6 +208,7 @@ def upsert_kit_with_encounter(db: DatabaseSession,
     return kit, status
 
 
+@ledger.timed("write")
 def mark_enrollment_processed(db, enrollment_id: int) -> None:
     LOG.debug(f"Marking enrollment {enrollment_id} as processed")
 
@@ -226,35 +228,41 @@ def mark_enrollment_processed(db, enrollment_id: int) -> None:
              where enrollment_id = %(enrollment_id)s
             """, data)
 
+    ledger.count("processed", db = db)
+
 @kits.command("manifest", help = __doc__)
+@with_run_ledger
 @with_database_session
+@with_savepoint_batch_size
 
-def kit_manifests(*, db: DatabaseSession):
+def kit_manifests(*, db: DatabaseSession, savepoint_batch_size: int):
     LOG.debug(f"Starting the kits manifests ETL routine, revision {MANIFEST_REVISION}")
 
     LOG.debug("Fetching unprocessed manifest records")
 
-    manifest = db.cursor("manifest")
-    manifest.execute("""
-        select manifest_id as id, document
-          from receiving.manifest
-         where not processing_log @> %s
-         order by id
-           for update
-        """, (Json([{ "etl": ETL_NAME, "revision": MANIFEST_REVISION }]),))
-
-    for manifest_record in manifest:
-        with db.savepoint(f"manifest record {manifest_record.id}"):
+    manifest = receiving_records(db, "manifest", { "etl": ETL_NAME, "revision": MANIFEST_REVISION })
+
+    manifest = prefetch_identifiers(db, manifest,
+        lambda record: (record.document.get(key) for key in ("sample", "kit", "test_strip")))
+
+    batches = savepoint_batches(db, manifest, lambda record: f"manifest record {record.id}", savepoint_batch_size)
+
+    for manifest_record, savepoint in batches:
+        with savepoint:
             LOG.info(f"Processing record {manifest_record.id}")
 
+            # Work on a copy so the record can be processed again if its
+            # savepoint batch is retried.
+            document = dict(manifest_record.document)
+
             # Mark record as skipped
             # if it does not contain a kit related sample
-            if "kit" not in manifest_record.document:
+            if "kit" not in document:
                 LOG.info(f"Skipping manifest record {manifest_record.id} without kit data")
                 mark_skipped(db, manifest_record.id)
                 continue
 
-            sample_barcode = manifest_record.document.pop("sample")
+            sample_barcode = document.pop("sample")
             sample_identifier = find_identifier(db, sample_barcode)
 
             # Mark record as skipped
@@ -290,7 +298,7 @@ def kit_manifests(*, db: DatabaseSession):
                 mark_skipped(db, manifest_record.id)
                 continue
 
-            kit_barcode = manifest_record.document.pop("kit")
+            kit_barcode = document.pop("kit")
             kit_identifier = find_identifier(db, kit_barcode)
 
             # Mark record as skipped if it has an unknown kit barcode
@@ -311,16 +319,16 @@ def kit_manifests(*, db: DatabaseSession):
             extra_data = ["collection", "sample_type",
                           "aliquot_date", "aliquots", "racks"]
             for key in extra_data:
-                manifest_record.document.pop(key, None)
+                document.pop(key, None)
 
             # Try to find identifier for the test-strip barcode for rdt samples
             if sample.type == "rdt":
-                update_test_strip(db, manifest_record.document)
+                update_test_strip(db, document)
 
             kit, status = upsert_kit_with_sample(db,
                 identifier          = kit_identifier.uuid,
                 sample              = sample,
-                additional_details  = manifest_record.document)
+                additional_details  = document)
 
             if status == "updated":
                 update_sample(db, sample, kit.encounter_id)
@@ -351,6 +359,7 @@ def find_sample(db: DatabaseSession, identifier: str) -> Optional[SampleRecord]:
     return sample
 
 
+@ledger.timed("write")
 def update_test_strip(db: DatabaseSession, document: dict):
     """
     Find identifier that matches the test_strip barcode within *document*.
@@ -378,6 +387,7 @@ def update_test_strip(db: DatabaseSession, document: dict):
         }
 
 
+@ledger.timed("write")
 def upsert_kit_with_sample(db: DatabaseSession,
                            identifier: str,
                            sample: SampleRecord,
@@ -464,6 +474,7 @@ def mark_skipped(db, manifest_id: int) -> None:
     mark_manifest_processed(db, manifest_id, { "status": "skipped" })
 
 
+@ledger.timed("write")
 def mark_manifest_processed(db, manifest_id: int, entry = {}) -> None:
     LOG.debug(f"Marking manifest {manifest_id} as processed")
 
@@ -484,6 +495,8 @@ def mark_manifest_processed(db, manifest_id: int, entry = {}) -> None:
              where manifest_id = %(manifest_id)s
             """, data)
 
+    ledger.count(entry.get("status", "processed"), db = db)
+
 
 def find_kit(db: DatabaseSession, identifier: str) -> KitRecord:
     """
@@ -499,6 +512,7 @@ def find_kit(db: DatabaseSession, identifier: str) -> KitRecord:
     return kit
 
 
+@ledger.timed("write")
 def update_kit_samples(db: DatabaseSession, kit: KitRecord):
     """
     After upserting kit, update the samples linked to the kit.
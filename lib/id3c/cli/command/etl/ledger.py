@@ -0,0 +1,413 @@
+"""
+Ledger of ETL runs.
+
+Each ETL subcommand decorated with :func:`with_run_ledger` records a row in
+``receiving.etl_run`` when it starts and updates it when it finishes, with
+the number of records it processed by status and the seconds it spent in
+each stage.  Helpers like :func:`~id3c.cli.command.etl.receiving_records`
+and :func:`~id3c.cli.command.etl.savepoint_batches` report to the current
+run's ledger through :func:`count`, :func:`stage` and :func:`timed`, which
+do nothing outside of a run.
+
+Records are counted by status only once the changes made processing them are
+committed, so records retried after a failed savepoint batch are counted
+once and runs which roll back their changes count none as processed.
+
+The ledger uses its own database session so that runs which roll back their
+changes are recorded too.  Failing to record a run is logged but doesn't
+fail the run.
+"""
+import click
+import json
+import logging
+import os
+import resource
+import socket
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from functools import wraps
+from time import monotonic
+from typing import Callable, ContextManager, Dict, Iterator, List, Optional
+from id3c.db.session import DatabaseSession
+from id3c.db.datatypes import Json
+
+
+LOG = logging.getLogger(__name__)
+
+
+class RunLedger:
+    """
+    Counts of records by status and cumulative seconds by stage for a run of
+    ETL *routine*, and its row in ``receiving.etl_run``.
+    """
+    def __init__(self, routine: str, action: str = "rollback") -> None:
+        self.routine = routine
+        self.action = action
+        self.id: Optional[int] = None
+        self.started = datetime.now(timezone.utc)
+        self.finished: Optional[datetime] = None
+        self.status = "running"
+        self.error: Optional[str] = None
+        self.records: Counter = Counter()
+        self.stages: Dict[str, float] = defaultdict(float)
+        self.peak_rss: Optional[int] = None
+        self._start = monotonic()
+
+        # Seconds spent in stages nested within each active stage.
+        self._nested: List[float] = []
+
+
+    def count(self, status: str, records: int = 1) -> None:
+        """
+        Adds *records* to the number of records with *status*.
+        """
+        self.records[status] += records
+
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        """
+        Adds the time spent in the ``with`` block to the stage *name*, except
+        for the time spent in stages nested within it.
+
+        >>> ledger = RunLedger("test")
+        >>> with ledger.stage("transform"):
+        ...     with ledger.stage("write"):
+        ...         pass
+        >>> sorted(ledger.stages)
+        ['transform', 'write']
+        >>> ledger.stages["transform"] + ledger.stages["write"] <= monotonic() - ledger._start
+        True
+        """
+        start = monotonic()
+        self._nested.append(0.0)
+
+        try:
+            yield
+        finally:
+            elapsed = monotonic() - start
+            self.stages[name] += elapsed - self._nested.pop()
+
+            if self._nested:
+                self._nested[-1] += elapsed
+
+
+    def start(self) -> None:
+        """
+        Records the start of the run.
+        """
+        def insert(db: DatabaseSession) -> None:
+            self.id = db.fetch_row("""
+                insert into receiving.etl_run (routine, action, host, pid, started)
+                    values (%s, %s, %s, %s, %s)
+                returning etl_run_id as id
+                """, (self.routine, self.action, socket.gethostname(), os.getpid(), self.started)).id
+
+            LOG.debug(f"Recording ETL run {self.id} of {self.routine}")
+
+        self._record(insert)
+
+
+    def finish(self, error: BaseException = None) -> None:
+        """
+        Records the end of the run, which failed if *error* is given.
+        """
+        self.finished = datetime.now(timezone.utc)
+        self.status = "failed" if error is not None else "succeeded"
+        self.error = (str(error) or type(error).__name__) if error is not None else None
+
+        # Includes workers, which have been waited for by now.
+        self.peak_rss = 1024 * max(
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+            resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+        self.stages["total"] = monotonic() - self._start
+
+        self.merge()
+
+        LOG.info(f"ETL run of {self.routine} {self.status} after {self.stages['total']:.1f}s: "
+                 + (", ".join(f"{count:,} {status}" for status, count in sorted(self.records.items())) or "no records"))
+
+
+    def worker(self) -> "RunLedger":
+        """
+        Returns an empty ledger for the same run, for a worker process to
+        count its own records in and :meth:`merge` when it's done.
+        """
+        ledger = RunLedger(self.routine, self.action)
+        ledger.id = self.id
+        ledger.started = self.started
+        return ledger
+
+
+    def merge(self) -> None:
+        """
+        Adds this ledger's counts and stage timings to the run's row, along
+        with the end of the run if it's :meth:`finish`-ed.  The counts and
+        timings are replaced with the run's totals.
+        """
+        if self.id is None:
+            return
+
+        def update(db: DatabaseSession) -> None:
+            run = db.fetch_row("""
+                select records, stages
+                  from receiving.etl_run
+                 where etl_run_id = %s
+                   for update
+                """, (self.id,))
+
+            self.records.update(run.records)
+
+            for stage, seconds in run.stages.items():
+                self.stages[stage] += seconds
+
+            with db.cursor() as cursor:
+                cursor.execute("""
+                    update receiving.etl_run
+                       set records  = %s,
+                           stages   = %s,
+                           finished = %s,
+                           status   = %s,
+                           error    = %s,
+                           peak_rss = %s
+                     where etl_run_id = %s
+                    """, (Json(self.records), Json(self.stages), self.finished, self.status, self.error, self.peak_rss, self.id))
+
+        self._record(update)
+
+
+    def _record(self, write: Callable[[DatabaseSession], None]) -> None:
+        """
+        Calls *write* with a new session and commits it.  Errors are logged
+        and stop the run from being recorded further.
+        """
+        try:
+            db = DatabaseSession()
+
+            try:
+                write(db)
+                db.commit()
+            finally:
+                db.close()
+
+        except Exception as error:
+            LOG.warning(f"Not recording ETL run of {self.routine}: {error}")
+            self.id = None
+
+
+    def metrics(self) -> dict:
+        """
+        Returns the run's metrics as a JSON-serializable dictionary.
+        """
+        return {
+            "id": self.id,
+            "routine": self.routine,
+            "action": self.action,
+            "started": self.started.isoformat(),
+            "finished": self.finished.isoformat() if self.finished else None,
+            "status": self.status,
+            "error": self.error,
+            "records": dict(self.records),
+            "stages": dict(self.stages),
+            "peak_rss": self.peak_rss,
+        }
+
+
+    def prometheus(self) -> str:
+        """
+        Returns the run's metrics in the Prometheus text exposition format,
+        suitable for node_exporter's textfile collector.
+        """
+        routine = self.routine.replace("\\", "\\\\").replace('"', '\\"')
+
+        def metric(name: str, kind: str, help: str, samples) -> str:
+            return "".join([
+                f"# HELP id3c_etl_run_{name} {help}\n",
+                f"# TYPE id3c_etl_run_{name} {kind}\n",
+                *(f'id3c_etl_run_{name}{{routine="{routine}"{labels}}} {value}\n' for labels, value in samples),
+            ])
+
+        return "".join([
+            metric("succeeded", "gauge", "Whether the last run succeeded",
+                [("", int(self.status == "succeeded"))]),
+            metric("finished_timestamp_seconds", "gauge", "When the last run finished",
+                [("", self.finished.timestamp() if self.finished else "NaN")]),
+            metric("records", "gauge", "Records processed by the last run, by status",
+                [(f',status="{status}"', count) for status, count in sorted(self.records.items())]),
+            metric("stage_seconds", "gauge", "Seconds spent in each stage of the last run",
+                [(f',stage="{stage}"', f"{seconds:.3f}") for stage, seconds in sorted(self.stages.items())]),
+            metric("peak_rss_bytes", "gauge", "Peak resident set size of the last run",
+                [("", self.peak_rss if self.peak_rss is not None else "NaN")]),
+        ])
+
+
+    def write(self, path: str) -> None:
+        """
+        Writes the run's metrics to *path*, in the Prometheus text format if
+        it ends in ``.prom`` and as JSON otherwise.  The file is replaced
+        atomically so readers never see it partially written.
+        """
+        temporary = f"{path}.{os.getpid()}.tmp"
+
+        with open(temporary, "w", encoding = "utf-8") as file:
+            if path.endswith(".prom"):
+                file.write(self.prometheus())
+            else:
+                json.dump(self.metrics(), file, indent = 2)
+                file.write("\n")
+
+        os.replace(temporary, path)
+
+
+#: Ledger of the ETL run in progress in this process, if any.
+_current: Optional[RunLedger] = None
+
+
+def current() -> Optional[RunLedger]:
+    """
+    Returns the ledger of the ETL run in progress, if any.
+    """
+    return _current
+
+
+def count(status: str, records: int = 1, db: DatabaseSession = None) -> None:
+    """
+    Counts *records* with *status* in the current run's ledger, if any.
+
+    If *db* is given, they're counted only once the changes made so far in
+    it are committed.  Pass the session the records were processed in.
+
+    >>> from unittest.mock import MagicMock
+    >>> from id3c.cli.command.etl import ledger
+    >>> db = DatabaseSession.__new__(DatabaseSession)
+    >>> db.connection = MagicMock()
+    >>> db._rollback_callbacks = [[]]
+    >>> db._commit_callbacks = [[]]
+    >>> run = ledger._current = RunLedger("test")
+    >>> try:
+    ...     with db.savepoint("batch"):
+    ...         count("processed", db = db)
+    ...         raise ValueError
+    ... except ValueError:
+    ...     pass
+    >>> with db.savepoint("retry"):
+    ...     count("processed", db = db)
+    >>> run.records
+    Counter()
+    >>> db.commit()
+    >>> run.records
+    Counter({'processed': 1})
+    >>> count("processed", db = db)
+    >>> db.rollback()
+    >>> run.records
+    Counter({'processed': 1})
+    >>> ledger._current = None
+    """
+    run = _current
+
+    if run is None:
+        return
+
+    if db is not None:
+        db.on_commit(lambda: run.count(status, records))
+    else:
+        run.count(status, records)
+
+
+def stage(name: str) -> ContextManager:
+    """
+    Times a ``with`` block as stage *name* of the current run, if any.
+
+    >>> with stage("fetch"):
+    ...     pass
+    """
+    if _current is not None:
+        return _current.stage(name)
+    else:
+        return _nothing()
+
+
+@contextmanager
+def _nothing() -> Iterator[None]:
+    yield
+
+
+def timed(name: str):
+    """
+    Decorator to time each call of a function as stage *name* of the current
+    run, if any.
+    """
+    def decorator(function):
+        @wraps(function)
+        def decorated(*args, **kwargs):
+            with stage(name):
+                return function(*args, **kwargs)
+
+        return decorated
+
+    return decorator
+
+
+@contextmanager
+def worker() -> Iterator[None]:
+    """
+    Counts records processed in a worker process within the ``with`` block
+    in a ledger of its own, merged into the run's when the block exits.
+    """
+    global _current
+
+    if _current is None:
+        yield
+        return
+
+    run, _current = _current, _current.worker()
+
+    try:
+        yield
+    finally:
+        _current.merge()
+        _current = run
+
+
+def with_run_ledger(command):
+    """
+    Decorator to record each run of an ETL *command* in the ledger and add a
+    ``--metrics-file`` option to also write the run's metrics to a file.
+
+    It must be applied outside of (i.e. above)
+    :func:`~id3c.cli.command.with_database_session`, so that the run is
+    recorded after its changes are committed or rolled back.
+    """
+    @click.option("--metrics-file",
+        metavar = "<file>",
+        type = click.Path(dir_okay = False, writable = True),
+        help = "Write the run's metrics to <file> when finished, in the "
+               "Prometheus text format (e.g. for node_exporter's textfile "
+               "collector) if it ends in .prom and as JSON otherwise")
+    @wraps(command)
+    def decorated(*args, metrics_file: str = None, **kwargs):
+        global _current
+
+        # "id3c etl fhir" → "fhir"
+        routine = click.get_current_context().command_path.split(" ", 2)[-1]
+        action = kwargs.get("action")
+
+        ledger = _current = RunLedger(routine, getattr(action, "value", "rollback"))
+        ledger.start()
+
+        try:
+            command(*args, **kwargs)
+        except BaseException as error:
+            ledger.finish(error)
+            raise
+        else:
+            ledger.finish()
+        finally:
+            _current = None
+
+            if metrics_file:
+                ledger.write(metrics_file)
+
+    return decorated
@@ -14,15 +14,20 @@ example, we can track the output of preparing the manifest and only receive new
 or updated records.
 """
 import click
+import csv
 import logging
+from collections import Counter
 from datetime import datetime, timezone
+from io import StringIO
+from more_itertools import chunked
 from psycopg2 import sql
-from typing import Any, Tuple, Optional
-from id3c.cli.command import with_database_session
-from id3c.db import find_identifier, upsert_sample
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple
+from id3c.cli.command import DatabaseSessionAction, with_database_session
+from id3c.db import find_identifier, sample_content_digest, sample_update_needed, upsert_sample
 from id3c.db.session import DatabaseSession
 from id3c.db.datatypes import Json
-from . import etl
+from id3c.json import as_json
+from . import etl, ledger, prefetch_identifiers, process_receiving_records, savepoint_batches, with_backfill, with_run_ledger, with_savepoint_batch_size, with_workers
 
 
 LOG = logging.getLogger(__name__)
@@ -40,11 +45,33 @@ LOG = logging.getLogger(__name__)
 REVISION = 1
 ETL_NAME = "manifest"
 
+# Records about the same sample must be processed in order, as later records
+# update the sample.
+SAMPLE_KEY = "coalesce(document->>'sample', document->>'collection')"
 
-@etl.command("manifest", help = __doc__)
-@with_database_session
 
-def etl_manifest(*, db: DatabaseSession):
+@etl.command("manifest", help = __doc__)
+@with_run_ledger
+@with_database_session(pass_action = True, periodic_commits = True)
+@with_savepoint_batch_size
+@with_workers
+@with_backfill
+
+@click.option("--bulk",
+    is_flag = True,
+    help = "Upsert samples set-wise by staging batches of records in a "
+           "temporary table, instead of one record at a time.  Much faster "
+           "for large manifests, particularly re-parsed ones which are "
+           "mostly unchanged.")
+
+@click.option("--bulk-batch-size",
+    metavar = "<n>",
+    type = click.IntRange(min = 1),
+    default = 5000,
+    show_default = True,
+    help = "Number of records staged at a time with --bulk")
+
+def etl_manifest(*, db: DatabaseSession, action: DatabaseSessionAction, savepoint_batch_size: int, workers: Optional[int], claim_size: int, backfill: Optional[str], range_size: int, bulk: bool, bulk_batch_size: int):
     LOG.debug(f"Starting the manifest ETL routine, revision {REVISION}")
 
     # XXX TODO: Stop hardcoding valid identifier sets.  Instead, accept them as
@@ -102,90 +129,111 @@ def etl_manifest(*, db: DatabaseSession):
     # command don't try to process the same samples.
     LOG.debug("Fetching unprocessed manifest records")
 
-    manifest = db.cursor("manifest")
-    manifest.execute("""
-        select manifest_id as id, document
-          from receiving.manifest
-         where not processing_log @> %s
-         order by id
-           for update
-        """, (Json([{ "etl": ETL_NAME, "revision": REVISION }]),))
-
-    for manifest_record in manifest:
-        with db.savepoint(f"manifest record {manifest_record.id}"):
+    process_receiving_records(db, action,
+        lambda db, manifest: process_manifest_records(
+            db, manifest, expected_identifier_sets, savepoint_batch_size, bulk, bulk_batch_size),
+        "manifest", { "etl": ETL_NAME, "revision": REVISION },
+        ordered_by = SAMPLE_KEY,
+        workers = workers,
+        claim_size = claim_size,
+        backfill = backfill,
+        range_size = range_size)
+
+
+def process_manifest_records(db: DatabaseSession,
+                             manifest: Iterable[Any],
+                             expected_identifier_sets: Mapping[str, Set[str]],
+                             savepoint_batch_size: int,
+                             bulk: bool,
+                             bulk_batch_size: int) -> None:
+    """
+    Processes the unprocessed *manifest* records.
+
+    With *bulk*, records are loaded set-wise in batches of *bulk_batch_size*
+    by :func:`load_manifest_batch`, each in its own savepoint.  A batch which
+    fails is rolled back and its records processed one at a time instead, so
+    that a bad record fails (or is retried) on its own as without *bulk*.
+    """
+    if bulk:
+        for records in chunked(manifest, bulk_batch_size):
+            try:
+                with db.savepoint(f"manifest records {records[0].id} to {records[-1].id}"):
+                    load_manifest_batch(db, records, expected_identifier_sets)
+
+            except Exception:
+                LOG.exception(f"Failed to load manifest records {records[0].id} to {records[-1].id} set-wise, "
+                              f"so processing them one at a time")
+
+                process_manifest_records_serially(db, records, expected_identifier_sets, savepoint_batch_size)
+        return
+
+    process_manifest_records_serially(db, manifest, expected_identifier_sets, savepoint_batch_size)
+
+
+def process_manifest_records_serially(db: DatabaseSession,
+                                      manifest: Iterable[Any],
+                                      expected_identifier_sets: Mapping[str, Set[str]],
+                                      savepoint_batch_size: int) -> None:
+    """
+    Processes the unprocessed *manifest* records one at a time, in savepoint
+    batches of *savepoint_batch_size*.
+    """
+    manifest = prefetch_identifiers(db, manifest,
+        lambda record: (record.document.get("sample"), record.document.get("collection")))
+
+    batches = savepoint_batches(db, manifest, lambda record: f"manifest record {record.id}", savepoint_batch_size)
+
+    for manifest_record, savepoint in batches:
+        with savepoint:
             LOG.info(f"Processing record {manifest_record.id}")
 
+            # Work on a copy so the record can be processed again if its
+            # savepoint batch is retried.
+            document = dict(manifest_record.document)
+
             # When updating an existing row, update the identifiers
             # only if the record has both the 'sample' and
             # 'collection' keys.
-            should_update_identifiers = "sample" in manifest_record.document \
-                and "collection" in manifest_record.document
+            should_update_identifiers = "sample" in document \
+                and "collection" in document
 
              # Sample collection date
              # Don't pop this entry off the document. For backwards
              # compatibility reasons, keep it in the document so that 'date'
              # also gets written to the 'details' column in warehouse.sample.
-            collected_date = manifest_record.document.get("date", None)
+            collected_date = document.get("date", None)
 
             # Attempt to find barcodes and their related identifiers
-            sample_barcode = manifest_record.document.pop("sample", None)
+            sample_barcode = document.pop("sample", None)
             sample_identifier = find_identifier(db, sample_barcode) if sample_barcode else None
-            collection_barcode = manifest_record.document.pop("collection", None)
+            collection_barcode = document.pop("collection", None)
             collection_identifier = find_identifier(db, collection_barcode) if collection_barcode else None
 
-            # Skip a record if it has no associated barcodes
-            if not sample_barcode and not collection_barcode:
-                LOG.warning(f"Skipping record «{manifest_record.id}» because it has neither a sample "
-                    "barcode nor a collection barcode")
-                mark_skipped(db, manifest_record.id)
-                continue
-
-            # Skip a record if it has a sample barcode but the barcode doesn't match an identifier
-            if sample_barcode and not sample_identifier:
-                LOG.warning(f"Skipping record «{manifest_record.id}» with unknown sample barcode «{sample_barcode}»")
-                mark_skipped(db, manifest_record.id)
-                continue
-
-            # Skip a record if it has a collection barcode but the barcode doesn't match an identifier
-            if collection_barcode and not collection_identifier:
-                LOG.warning(f"Skipping record «{manifest_record.id}» with unknown collection barcode «{collection_barcode}»")
+            if not valid_identifiers(manifest_record.id,
+                                     document,
+                                     sample_barcode,
+                                     sample_identifier.set_name if sample_identifier else None,
+                                     collection_barcode,
+                                     collection_identifier.set_name if collection_identifier else None,
+                                     expected_identifier_sets):
                 mark_skipped(db, manifest_record.id)
                 continue
 
-             # Skip a record if the collection identifier is from an unexpected set
-            if collection_identifier and collection_identifier.set_name not in expected_identifier_sets["collections"]:
-                LOG.warning(f"Skipping record «{manifest_record.id}» because collection identifier found in set «{collection_identifier.set_name}», not \
-                    {expected_identifier_sets['collections']}")
-                mark_skipped(db, manifest_record.id)
-                continue
-
-            # Validate the sample identifer and assert if a record fails
-            if sample_identifier:
-                if (manifest_record.document.get("sample_type") and
-                    manifest_record.document["sample_type"] == "rdt"):
-                    assert sample_identifier.set_name in expected_identifier_sets["rdt"], \
-                        (f"Sample identifier found in set «{sample_identifier.set_name}»," +
-                        f"not {expected_identifier_sets['rdt']}")
-                else:
-                    assert sample_identifier.set_name in expected_identifier_sets["samples"], \
-                        (f"Sample identifier found in set «{sample_identifier.set_name}», " +
-                        f"not {expected_identifier_sets['samples']}")
-
-
             # Upsert sample cooperatively with enrollments ETL routine
             #
             # The details document was intentionally modified by two pop()s
             # earlier to remove barcodes that were looked up.
             # The rationale is that we want just one clear place in the
             # warehouse for each piece of information.
-            sample, status = upsert_sample(db,
-                update_identifiers          = should_update_identifiers,
-                overwrite_collection_date   = True,
-                identifier                  = sample_identifier.uuid if sample_identifier else None,
-                collection_identifier       = collection_identifier.uuid if collection_identifier else None,
-                collection_date             = collected_date,
-                encounter_id                = None,
-                additional_details          = manifest_record.document)
+            with ledger.stage("write"):
+                sample, status = upsert_sample(db,
+                    update_identifiers          = should_update_identifiers,
+                    overwrite_collection_date   = True,
+                    identifier                  = sample_identifier.uuid if sample_identifier else None,
+                    collection_identifier       = collection_identifier.uuid if collection_identifier else None,
+                    collection_date             = collected_date,
+                    encounter_id                = None,
+                    additional_details          = document)
 
             mark_loaded(db, manifest_record.id,
                 status = status,
@@ -193,6 +241,385 @@ def etl_manifest(*, db: DatabaseSession):
 
             LOG.info(f"Finished processing manifest record {manifest_record.id}")
 
+
+def valid_identifiers(manifest_id: int,
+                      document: Mapping,
+                      sample_barcode: Optional[str],
+                      sample_set: Optional[str],
+                      collection_barcode: Optional[str],
+                      collection_set: Optional[str],
+                      expected_identifier_sets: Mapping[str, Set[str]]) -> bool:
+    """
+    Checks the barcodes of manifest record *manifest_id* and the identifier
+    sets they were found in (``None`` if not found).
+
+    Returns ``False`` if the record should be skipped, after logging why.
+    Raises an :class:`AssertionError` if the sample identifier is from an
+    unexpected set.
+    """
+    # Skip a record if it has no associated barcodes
+    if not sample_barcode and not collection_barcode:
+        LOG.warning(f"Skipping record «{manifest_id}» because it has neither a sample "
+            "barcode nor a collection barcode")
+        return False
+
+    # Skip a record if it has a sample barcode but the barcode doesn't match an identifier
+    if sample_barcode and not sample_set:
+        LOG.warning(f"Skipping record «{manifest_id}» with unknown sample barcode «{sample_barcode}»")
+        return False
+
+    # Skip a record if it has a collection barcode but the barcode doesn't match an identifier
+    if collection_barcode and not collection_set:
+        LOG.warning(f"Skipping record «{manifest_id}» with unknown collection barcode «{collection_barcode}»")
+        return False
+
+     # Skip a record if the collection identifier is from an unexpected set
+    if collection_set and collection_set not in expected_identifier_sets["collections"]:
+        LOG.warning(f"Skipping record «{manifest_id}» because collection identifier found in set «{collection_set}», not \
+            {expected_identifier_sets['collections']}")
+        return False
+
+    # Validate the sample identifer and assert if a record fails
+    if sample_set:
+        if (document.get("sample_type") and
+            document["sample_type"] == "rdt"):
+            assert sample_set in expected_identifier_sets["rdt"], \
+                (f"Sample identifier found in set «{sample_set}»," +
+                f"not {expected_identifier_sets['rdt']}")
+        else:
+            assert sample_set in expected_identifier_sets["samples"], \
+                (f"Sample identifier found in set «{sample_set}», " +
+                f"not {expected_identifier_sets['samples']}")
+
+    return True
+
+
+@ledger.timed("write")
+def load_manifest_batch(db: DatabaseSession, records: List[Any], expected_identifier_sets: Mapping[str, Set[str]]) -> None:
+    """
+    Upserts the samples of manifest *records* set-wise, with the same results
+    as processing them one at a time.
+
+    The parsed records are copied into a temporary staging table, where their
+    barcodes are resolved, existing samples are matched, and changes are
+    detected with joins.  New samples are then inserted and changed samples
+    updated with one statement each.  Records which touch the same sample as
+    another record of the batch are instead upserted one at a time, in order,
+    after the rest.  Finally, every record's processing log is updated.
+    """
+    LOG.info(f"Staging {len(records):,} manifest records {records[0].id} to {records[-1].id}")
+
+    with db.cursor() as cursor:
+        cursor.execute(CREATE_MANIFEST_STAGE)
+
+        documents: Dict[int, dict] = {}
+        # None is written as a quoted empty string, which force_null below
+        # turns back into null.
+        stage = StringIO()
+        writer = csv.writer(stage, quoting = csv.QUOTE_NONNUMERIC)
+
+        for ordinal, record in enumerate(records):
+            document = documents[ordinal] = dict(record.document)
+
+            # When updating an existing row, update the identifiers only if
+            # the record has both the 'sample' and 'collection' keys.
+            update_identifiers = "sample" in document and "collection" in document
+
+            sample_barcode = document.pop("sample", None)
+            collection_barcode = document.pop("collection", None)
+
+            writer.writerow([
+                ordinal,
+                record.id,
+                sample_barcode or None,
+                collection_barcode or None,
+                "t" if update_identifiers else "f",
+                document.get("date", None),
+                as_json(document) if document else None,
+            ])
+
+        stage.seek(0)
+
+        cursor.copy_expert("""
+            copy manifest_stage (ordinal, manifest_id, sample_barcode, collection_barcode,
+                                 update_identifiers, collection_date, details)
+            from stdin with (
+                format csv,
+                force_null (sample_barcode, collection_barcode, collection_date, details))
+            """, stage)
+
+        cursor.execute(RESOLVE_MANIFEST_STAGE_BARCODES)
+        cursor.execute("select * from manifest_stage order by ordinal")
+        staged = cursor.fetchall()
+
+    log_entries: List[Tuple[int, dict]] = []
+    skipped = []
+
+    for row in staged:
+        if not valid_identifiers(row.manifest_id,
+                                 documents[row.ordinal],
+                                 row.sample_barcode,
+                                 row.sample_set,
+                                 row.collection_barcode,
+                                 row.collection_set,
+                                 expected_identifier_sets):
+            skipped.append(row.ordinal)
+            log_entries.append((row.manifest_id, { "status": "skipped" }))
+
+    with db.cursor() as cursor:
+        cursor.execute("delete from manifest_stage where ordinal = any(%s)", (skipped,))
+        cursor.execute(MATCH_MANIFEST_STAGE_SAMPLES)
+        cursor.execute("select * from manifest_stage order by ordinal")
+        staged = cursor.fetchall()
+
+    for row in staged:
+        if row.matches > 1:
+            raise Exception(f"More than one sample matching sample and/or collection barcodes of manifest record {row.manifest_id}")
+
+    # Digest each record as upsert_sample() would, so unchanged samples skip
+    # the comparison.
+    with db.cursor() as cursor:
+        cursor.execute(DIGEST_MANIFEST_STAGE, (
+            [ row.ordinal for row in staged ],
+            [ sample_content_digest(
+                update_identifiers        = row.update_identifiers,
+                overwrite_collection_date = True,
+                identifier                = row.identifier,
+                collection_identifier     = row.collection_identifier,
+                collection_date           = documents[row.ordinal].get("date", None),
+                encounter_id              = None,
+                additional_details        = documents[row.ordinal],
+                access_role               = None) for row in staged ],
+        ))
+
+    # Records touching the same sample must be applied in order, which a
+    # single statement can't do.
+    keys = Counter(key for row in staged for key in sample_keys(row))
+    serial = [ row for row in staged if any(keys[key] > 1 for key in sample_keys(row)) ]
+
+    with db.cursor() as cursor:
+        cursor.execute("delete from manifest_stage where ordinal = any(%s)", ([ row.ordinal for row in serial ],))
+        cursor.execute(COMPARE_MANIFEST_STAGE_SAMPLES)
+        cursor.execute("""
+            select sample_id as id,
+                   previous_identifier as identifier,
+                   previous_collection_identifier as collection_identifier,
+                   previous_encounter_id as encounter_id,
+                   identifiers_changed,
+                   metadata_changed,
+                   false as access_role_changed,
+                   ordinal,
+                   update_identifiers,
+                   identifier as new_identifier,
+                   collection_identifier as new_collection_identifier
+              from manifest_stage
+             where sample_id is not null
+             order by ordinal
+            """)
+        existing = cursor.fetchall()
+
+        updates = [
+            sample.ordinal
+                for sample in existing
+                 if sample_update_needed(sample,
+                                         sample.update_identifiers,
+                                         sample.new_identifier,
+                                         sample.new_collection_identifier,
+                                         None) ]
+
+        cursor.execute(UPDATE_MANIFEST_STAGE_SAMPLES, (updates,))
+        cursor.execute(STORE_MANIFEST_STAGE_DIGESTS)
+        cursor.execute(INSERT_MANIFEST_STAGE_SAMPLES)
+
+        cursor.execute("select manifest_id, sample_id, status from manifest_stage order by ordinal")
+        loaded = cursor.fetchall()
+
+        cursor.execute("drop table manifest_stage")
+
+    for row in loaded:
+        log_entries.append((row.manifest_id, { "status": row.status, "sample_id": row.sample_id }))
+
+    LOG.info(
+        f"Loaded {len(loaded):,} manifest records set-wise "
+        f"({len(updates):,} updated samples, {sum(row.status == 'created' for row in loaded):,} created), "
+        f"skipped {len(skipped):,}, and loading {len(serial):,} one at a time")
+
+    for row in serial:
+        document = documents[row.ordinal]
+
+        sample, status = upsert_sample(db,
+            update_identifiers          = row.update_identifiers,
+            overwrite_collection_date   = True,
+            identifier                  = row.identifier,
+            collection_identifier       = row.collection_identifier,
+            collection_date             = document.get("date", None),
+            encounter_id                = None,
+            additional_details          = document)
+
+        log_entries.append((row.manifest_id, { "status": status, "sample_id": sample.id }))
+
+    mark_processed_many(db, log_entries)
+
+
+def sample_keys(row: Any) -> List[str]:
+    """
+    Returns the keys by which staged manifest *row* identifies its sample.
+    """
+    return [
+        *([f"identifier {row.identifier}"] if row.identifier else []),
+        *([f"collection {row.collection_identifier}"] if row.collection_identifier else []),
+        *([f"sample {row.sample_id}"] if row.sample_id else []),
+    ]
+
+
+CREATE_MANIFEST_STAGE = """
+    create temporary table manifest_stage (
+        ordinal integer primary key,
+        manifest_id integer not null,
+        sample_barcode citext,
+        collection_barcode citext,
+        update_identifiers boolean not null,
+        collection_date text,
+        details jsonb,
+
+        identifier text,
+        sample_set text,
+        collection_identifier text,
+        collection_set text,
+
+        sample_id integer,
+        matches integer not null default 0,
+        previous_identifier text,
+        previous_collection_identifier text,
+        previous_encounter_id integer,
+        content_digest bytea,
+        identifiers_changed boolean,
+        metadata_changed boolean,
+        status text
+    ) on commit drop
+    """
+
+RESOLVE_MANIFEST_STAGE_BARCODES = """
+    update manifest_stage
+       set identifier = found.uuid,
+           sample_set = found.set_name
+      from (select uuid, barcode, identifier_set.name as set_name
+              from warehouse.identifier
+              join warehouse.identifier_set using (identifier_set_id)) as found
+     where found.barcode = manifest_stage.sample_barcode;
+
+    update manifest_stage
+       set collection_identifier = found.uuid,
+           collection_set = found.set_name
+      from (select uuid, barcode, identifier_set.name as set_name
+              from warehouse.identifier
+              join warehouse.identifier_set using (identifier_set_id)) as found
+     where found.barcode = manifest_stage.collection_barcode;
+    """
+
+MATCH_MANIFEST_STAGE_SAMPLES = """
+    with matched as (
+        select ordinal, sample.sample_id
+          from manifest_stage
+          join warehouse.sample using (identifier)
+        union
+        select ordinal, sample.sample_id
+          from manifest_stage
+          join warehouse.sample using (collection_identifier)
+    ),
+    locked as (
+        select sample_id
+          from warehouse.sample
+         where sample_id in (select sample_id from matched)
+           for update
+    )
+    update manifest_stage
+       set sample_id = matched_samples.sample_id,
+           matches = matched_samples.n
+      from (select ordinal, min(sample_id) as sample_id, count(*) as n
+              from matched
+             where sample_id in (select sample_id from locked)
+             group by ordinal) as matched_samples
+     where manifest_stage.ordinal = matched_samples.ordinal
+    """
+
+DIGEST_MANIFEST_STAGE = """
+    update manifest_stage
+       set content_digest = digests.content_digest
+      from unnest(%s::integer[], %s::bytea[]) as digests (ordinal, content_digest)
+     where manifest_stage.ordinal = digests.ordinal
+    """
+
+# Mirrors id3c.db.FIND_SAMPLES_FOR_UPSERT, with collected being a date.
+COMPARE_MANIFEST_STAGE_SAMPLES = """
+    update manifest_stage
+       set previous_identifier = sample.identifier,
+           previous_collection_identifier = sample.collection_identifier,
+           previous_encounter_id = sample.encounter_id,
+           identifiers_changed =
+                case when sample.content_digest = manifest_stage.content_digest then false else
+                row (sample.identifier, sample.collection_identifier)::text
+                !=
+                row (manifest_stage.identifier, manifest_stage.collection_identifier)::text end,
+           metadata_changed =
+                case when sample.content_digest = manifest_stage.content_digest then false else
+                row (sample.collected::timestamp, sample.encounter_id, sample.details)::text
+                !=
+                row (coalesce(manifest_stage.collection_date::date, sample.collected)::timestamp,
+                     sample.encounter_id,
+                     coalesce(sample.details, '{}'::jsonb) || coalesce(manifest_stage.details - '_provenance', '{}'::jsonb))::text end,
+           status = 'updated'
+      from warehouse.sample
+     where sample.sample_id = manifest_stage.sample_id
+    """
+
+# Mirrors id3c.db.update_sample_sql(..., overwrite_collection_date = True)
+UPDATE_MANIFEST_STAGE_SAMPLES = """
+    update warehouse.sample
+       set identifier = case when manifest_stage.update_identifiers then manifest_stage.identifier else sample.identifier end,
+           collection_identifier = case when manifest_stage.update_identifiers then manifest_stage.collection_identifier else sample.collection_identifier end,
+           collected = coalesce(date_or_null(manifest_stage.collection_date), sample.collected),
+           details = coalesce(sample.details, '{}'::jsonb) || manifest_stage.details,
+           content_digest = manifest_stage.content_digest
+      from manifest_stage
+     where manifest_stage.ordinal = any(%s)
+       and sample.sample_id = manifest_stage.sample_id
+    """
+
+# Stores the digests of unchanged samples, as upsert_sample() does.  Updated
+# samples already have theirs.
+STORE_MANIFEST_STAGE_DIGESTS = """
+    update warehouse.sample
+       set content_digest = manifest_stage.content_digest
+      from manifest_stage
+     where sample.sample_id = manifest_stage.sample_id
+       and sample.content_digest is distinct from manifest_stage.content_digest
+    """
+
+# Mirrors id3c.db.INSERT_SAMPLE
+INSERT_MANIFEST_STAGE_SAMPLES = """
+    with inserted as (
+        insert into warehouse.sample (identifier, collection_identifier, collected, details, content_digest)
+        select identifier,
+               collection_identifier,
+               date_or_null(collection_date),
+               details,
+               content_digest
+          from manifest_stage
+         where sample_id is null
+         order by ordinal
+        returning sample_id, identifier, collection_identifier
+    )
+    update manifest_stage
+       set sample_id = inserted.sample_id,
+           status = 'created'
+      from inserted
+     where manifest_stage.sample_id is null
+       and (inserted.identifier = manifest_stage.identifier
+            or inserted.collection_identifier = manifest_stage.collection_identifier)
+    """
+
+
 def mark_loaded(db, manifest_id: int, status: str, sample_id: int) -> None:
     LOG.debug(f"Marking sample manifest record {manifest_id} as loaded")
     mark_processed(db, manifest_id, { "status": status, "sample_id": sample_id })
@@ -203,6 +630,30 @@ def mark_skipped(db, manifest_id: int) -> None:
     mark_processed(db, manifest_id, { "status": "skipped" })
 
 
+@ledger.timed("write")
+def mark_processed_many(db, entries: Sequence[Tuple[int, dict]]) -> None:
+    """
+    Appends each of *entries*, a (manifest id, log entry) pair, to the
+    processing log of its sample manifest record as :func:`mark_processed`
+    does, but in one round trip.
+    """
+    LOG.debug(f"Appending to processing log of {len(entries):,} sample manifest records")
+
+    timestamp = datetime.now(timezone.utc)
+
+    db.execute_many(MARK_PROCESSED, [
+        {
+            "manifest_id": manifest_id,
+            "log_entry": Json({ **entry, "etl": ETL_NAME, "revision": REVISION, "timestamp": timestamp }),
+        }
+        for manifest_id, entry in entries
+    ], page_size = max(len(entries), 1))
+
+    for status, records in Counter(entry.get("status", "processed") for _, entry in entries).items():
+        ledger.count(status, records, db = db)
+
+
+@ledger.timed("write")
 def mark_processed(db, manifest_id: int, entry = {}) -> None:
     LOG.debug(f"Appending to processing log of sample manifest record {manifest_id}")
 
@@ -217,8 +668,13 @@ def mark_processed(db, manifest_id: int, entry = {}) -> None:
     }
 
     with db.cursor() as cursor:
-        cursor.execute("""
-            update receiving.manifest
-               set processing_log = processing_log || %(log_entry)s
-             where manifest_id = %(manifest_id)s
-            """, data)
+        cursor.execute(MARK_PROCESSED, data)
+
+    ledger.count(entry.get("status", "processed"), db = db)
+
+
+MARK_PROCESSED = """
+    update receiving.manifest
+       set processing_log = processing_log || %(log_entry)s
+     where manifest_id = %(manifest_id)s
+    """
@@ -19,17 +19,28 @@ import click
 import logging
 from datetime import date, datetime, timezone
 from dateutil import parser
-from typing import Any, Optional
-from id3c.cli.command import with_database_session
+from more_itertools import peekable
+from typing import Any, Iterable, Optional
+from id3c.cli.command import DatabaseSessionAction, with_database_session
 from id3c.db import find_identifier
 from id3c.db.session import DatabaseSession
 from id3c.db.datatypes import Json
+from id3c.json import load_json, load_json_items
 from . import (
     etl,
+    ledger,
+    dimension_cache,
+    prefetch_identifiers,
+    process_receiving_records,
+    savepoint_batches,
+    with_backfill,
+    with_run_ledger,
+    with_savepoint_batch_size,
+    with_workers,
 
     find_or_create_target,
     SampleNotFoundError,
-    upsert_presence_absence,
+    upsert_presence_absences,
 )
 
 
@@ -45,6 +56,10 @@ LOG = logging.getLogger(__name__)
 REVISION = 8
 
 
+# Number of sample barcodes resolved at once, one per sample
+SAMPLE_PREFETCH_SIZE = 100
+
+
 # Valid identifier.set_name values for the samples to be processed
 valid_identifiers = [
         "samples",
@@ -56,9 +71,13 @@ valid_identifiers = [
 ]
 
 @etl.command("presence-absence", help = __doc__)
-@with_database_session
+@with_run_ledger
+@with_database_session(pass_action = True, periodic_commits = True)
+@with_savepoint_batch_size
+@with_workers
+@with_backfill
 
-def etl_presence_absence(*, db: DatabaseSession):
+def etl_presence_absence(*, db: DatabaseSession, action: DatabaseSessionAction, savepoint_batch_size: int, workers: Optional[int], claim_size: int, backfill: Optional[str], range_size: int):
     LOG.debug(f"Starting the presence_absence ETL routine, revision {REVISION}")
 
     # Fetch and iterate over presence-absence tests that aren't processed
@@ -67,19 +86,33 @@ def etl_presence_absence(*, db: DatabaseSession):
     # command don't try to process the same presence-absence tests.
     LOG.debug("Fetching unprocessed presence-absence tests")
 
-    presence_absence = db.cursor("presence_absence")
-    presence_absence.itersize = 1
-    presence_absence.execute("""
-        select presence_absence_id as id, document,
-               received::date as received_date
-          from receiving.presence_absence
-         where not processing_log @> %s
-         order by id
-           for update
-        """, (Json([{ "revision": REVISION }]),))
-
-    for group in presence_absence:
-        with db.savepoint(f"presence_absence group {group.id}"):
+    process_receiving_records(db, action,
+        lambda db, presence_absence: process_groups(db, presence_absence, savepoint_batch_size),
+        "presence_absence", { "revision": REVISION },
+        columns = ["received::date as received_date"],
+        raw_documents = True,
+        workers = workers,
+        claim_size = claim_size,
+        backfill = backfill,
+        range_size = range_size)
+
+
+def process_groups(db: DatabaseSession, presence_absence: Iterable[Any], savepoint_batch_size: int) -> None:
+    """
+    Processes the unprocessed *presence_absence* groups.
+
+    Each group's document is its JSON text, as a whole run's results can be
+    huge.  Samples are decoded one at a time as they're processed with
+    :func:`~id3c.json.load_json_items`, and their barcodes resolved
+    :data:`SAMPLE_PREFETCH_SIZE` samples at a time, so that only that many
+    are in memory at once.
+    """
+    dimension_cache(db, "target").warm()
+
+    batches = savepoint_batches(db, presence_absence, lambda group: f"presence_absence group {group.id}", savepoint_batch_size)
+
+    for group, savepoint in batches:
+        with savepoint:
             LOG.info(f"Processing presence_absence group {group.id}")
 
             # Samplify will now send documents with a top level key
@@ -88,7 +121,8 @@ def etl_presence_absence(*, db: DatabaseSession):
             # each presence/absence result
             #   -Jover, 14 Nov 2019
             try:
-                received_samples = group.document["samples"]
+                received_samples = peekable(load_json_items(group.document, "samples"))
+                received_samples.peek(None)
             except KeyError as error:
                 # Skip documents in the old format because they do not
                 # include the "chip" key which is needed for the
@@ -98,8 +132,10 @@ def etl_presence_absence(*, db: DatabaseSession):
                 # plate swapped data! This will lead to 188 samples with the
                 # wrong nwgc_id associated with them.
                 #   -Jover, 06 Dec 2019
-                if (group.document.get("store") is not None or
-                    group.document.get("Update") is not None):
+                document = load_json(group.document)
+
+                if (document.get("store") is not None or
+                    document.get("Update") is not None):
 
                     LOG.info("Skipping presence_absence record that is in old format")
                     mark_processed(db, group.id)
@@ -108,7 +144,12 @@ def etl_presence_absence(*, db: DatabaseSession):
                 else:
                     raise error from None
 
-            for received_sample in received_samples:
+            # Results of all samples in the group, upserted together at the end
+            results = []
+
+            for received_sample in prefetch_identifiers(db, received_samples,
+                                                        lambda sample: (sample.get("investigatorId"),),
+                                                        size = SAMPLE_PREFETCH_SIZE):
                 received_sample_barcode = received_sample.get("investigatorId")
                 if not received_sample_barcode:
                     LOG.info(f"Skipping sample «{received_sample['sampleId']}» without SFS barcode")
@@ -211,20 +252,23 @@ def etl_presence_absence(*, db: DatabaseSession):
                     # presence_absence tests, so an insert-first approach makes more sense.
                     # Presence-absence tests we see more than once are presumed to be
                     # corrections.
-                    upsert_presence_absence(db,
-                        identifier = identifier,
-                        sample_id  = sample.id,
-                        target_id  = target.id,
-                        present    = present,
-                        details    = presence_absence_details(test_result,
-                                                              group.received_date,
-                                                              chip,
-                                                              extraction_date,
-                                                              assay_name,
-                                                              assay_date,
-                                                              assay_type,
-                                                              result_timestamp,
-                                                              review_timestamp))
+                    results.append({
+                        "identifier": identifier,
+                        "sample_id":  sample.id,
+                        "target_id":  target.id,
+                        "present":    present,
+                        "details":    presence_absence_details(test_result,
+                                                               group.received_date,
+                                                               chip,
+                                                               extraction_date,
+                                                               assay_name,
+                                                               assay_date,
+                                                               assay_type,
+                                                               result_timestamp,
+                                                               review_timestamp),
+                    })
+
+            upsert_presence_absences(db, results)
 
             mark_processed(db, group.id)
 
@@ -256,6 +300,7 @@ def target_control(control: str) -> bool:
     return control == "PositiveControl"
 
 
+@ledger.timed("write")
 def update_sample(db: DatabaseSession,
                   identifier: str = None,
                   collection_identifier: str = None,
@@ -452,6 +497,7 @@ def target_present(test_result: dict) -> Any:
     return mapping[status]
 
 
+@ledger.timed("write")
 def mark_processed(db, group_id: int) -> None:
     LOG.debug(f"Marking presence_absence group {group_id} as processed")
 
@@ -470,6 +516,8 @@ def mark_processed(db, group_id: int) -> None:
              where presence_absence_id = %(group_id)s
             """, data)
 
+    ledger.count("processed", db = db)
+
 
 class UnknownControlStatusError(ValueError):
     """
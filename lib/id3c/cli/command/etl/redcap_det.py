@@ -7,20 +7,20 @@ REDCap.
 import os
 import click
 import logging
-import psycopg2.sql as sql
+import multiprocessing
 from collections import defaultdict
 from datetime import datetime, timezone
 from functools import wraps
 from more_itertools import chunked
 from textwrap import dedent
-from typing import Callable, Iterable, Optional, Tuple, Dict, List, Any, DefaultDict
+from typing import Callable, Iterable, MutableMapping, Optional, Tuple, Dict, List, Any, DefaultDict
 from urllib.parse import urljoin
-from id3c.cli.command import with_database_session
+from id3c.cli.command import DatabaseSessionAction, with_database_session
 from id3c.cli.redcap import is_complete, Project
 from id3c.db.session import DatabaseSession
 from id3c.db.datatypes import as_json, Json
 from id3c.cli.command import pickled_cache
-from . import etl
+from . import etl, ledger, process_receiving_records, savepoint_batches, with_backfill, with_run_ledger, with_savepoint_batch_size, with_workers
 
 
 LOG = logging.getLogger(__name__)
@@ -108,131 +108,154 @@ def command_for_project(name: str,
             type = click.Path(dir_okay=False, writable=True))
 
         @redcap_det.command(name, **kwargs)
-        @with_database_session
+        @with_run_ledger
+        @with_database_session(pass_action = True, periodic_commits = True)
+        @with_savepoint_batch_size
+        @with_workers
+        @with_backfill
         @wraps(routine)
 
-        def decorated(*args, db: DatabaseSession, log_output: bool, det_limit: int = None, redcap_api_batch_size: int, geocoding_cache: str = None, **kwargs):
+        def decorated(*args, db: DatabaseSession, action: DatabaseSessionAction, log_output: bool, det_limit: int = None, redcap_api_batch_size: int, geocoding_cache: str = None, savepoint_batch_size: int, workers: Optional[int], claim_size: int, backfill: Optional[str], range_size: int, **kwargs):
             LOG.debug(f"Starting the REDCap DET ETL routine {name}, revision {revision}")
 
             project = Project(redcap_url, project_id)
 
             if det_limit:
                 LOG.debug(f"Processing up to {det_limit:,} pending DETs")
-                limit = sql.Literal(det_limit)
             else:
                 LOG.debug(f"Processing all pending DETs")
-                limit = sql.SQL("all")
-
-            redcap_det = db.cursor(f"redcap-det {name}")
-            redcap_det.execute(sql.SQL("""
-                select redcap_det_id as id, document
-                  from receiving.redcap_det
-                 where not processing_log @> %s
-                   and document::jsonb @> %s
-                 order by id
-                 limit {}
-                   for update
-                """).format(limit), (Json([etl_id]), Json(det_contains)))
-
-            # First loop of the DETs to determine how to process each one.
-            # Uses `first_complete_dets` to keep track of which DET to
-            # use to process a unique REDCap record.
-            # Uses `all_dets` to keep track of the status for each DET record
-            # so that they can be processed in order of `redcap_det_id` later.
-            #   --Jover, 21 May 2020
-            first_complete_dets: Dict[str, Any] = {}
-            all_dets: List[Dict[str, str]] = []
-            for det in redcap_det:
-                instrument = det.document['instrument']
-                record_id = det.document['record']
-                # Assume we are loading all DETs
-                # Status will be updated to "skip" if DET does not need to be processed
-                det_record = { "id": det.id, "status": "load" }
-
-                # Only pull REDCap record if
-                # `include_incomplete` flag was not included and
-                # the current instrument is complete
-                if not include_incomplete and not is_complete(instrument, det.document):
-                   det_record.update({
-                       "status": "skip",
-                       "reason": "incomplete/unverified DET"
-                   })
-
-                # Check if this is record has an older DET
-                # Skip latest DET in favor of the first DET
-                # This is done to continue our first-in-first-out
-                # semantics of our receiving tables
-                elif first_complete_dets.get(record_id):
-                    det_record.update({
-                        "status": "skip",
-                        "reason": "repeat REDCap record"
-                    })
 
-                else:
-                    first_complete_dets[record_id] = det
-                    det_record["record_id"] = record_id
-
-                all_dets.append(det_record)
-
-            if not first_complete_dets:
-                LOG.info("No new complete DETs found.")
-            else:
-                # Batch request records from REDCap
-                LOG.info(f"Fetching REDCap project {project_id}")
-                record_ids = list(first_complete_dets.keys())
-
-                LOG.info(f"Fetching {len(record_ids):,} REDCap records from project {project.id}")
-
-                # Convert list of REDCap records to a dict so that
-                # records can be looked up by record id.
-                # Records with repeating instruments or longitudinal
-                # events will have multiple entries in the list.
-                redcap_records: DefaultDict[str, List[dict]] = defaultdict(list)
-
-                batches = list(chunked(record_ids, redcap_api_batch_size))
-
-                for i, batch in enumerate(batches, 1):
-                    LOG.info(f"Fetching REDCap record batch {i:,}/{len(batches):,} of size {len(batch):,}")
-
-                    for record in project.records(ids = batch, raw = raw_coded_values):
-                        redcap_records[record.id].append(record)
-
-            # Process all DETs in order of redcap_det_id
             with pickled_cache(geocoding_cache) as cache:
-                for det in all_dets:
-                    with db.savepoint(f"redcap_det {det['id']}"):
-                        LOG.info(f"Processing REDCap DET {det['id']}")
-
-                        if det["status"] == "skip":
-                            LOG.debug(f"Skipping REDCap DET {det['id']} due to {det['reason']}")
-                            mark_skipped(db, det["id"], etl_id, det["reason"])
-                            continue
-
-                        received_det = first_complete_dets.pop(det["record_id"])
-                        redcap_record_instances = redcap_records.get(received_det.document["record"])
-
-                        if not redcap_record_instances:
-                            LOG.debug(f"REDCap record is missing or invalid.  Skipping REDCap DET {received_det.id}")
-                            mark_skipped(db, received_det.id, etl_id, "invalid REDCap record")
-                            continue
-
-                        bundle = routine(db = db, cache = cache, det = received_det, redcap_record_instances = redcap_record_instances)
-
-                        if not bundle:
-                            LOG.debug(f"Skipping REDCap DET {received_det.id} due to insufficient data in REDCap record.")
-                            mark_skipped(db, received_det.id, etl_id, "insufficient data in record")
-                            continue
-
-                        if log_output:
-                            print(as_json(bundle))
-
-                        insert_fhir_bundle(db, bundle)
-                        mark_loaded(db, received_det.id, etl_id, bundle['id'])
+                # Forked workers share new geocoding results through a
+                # manager process, so they can be saved to the cache file.
+                if workers or backfill is not None:
+                    manager = multiprocessing.get_context("fork").Manager()
+                    shared_cache: MutableMapping = manager.dict(cache)
+                else:
+                    shared_cache = cache
+
+                def process(db: DatabaseSession, redcap_det: Iterable[Any]) -> None:
+                    # First loop of the DETs to determine how to process each one.
+                    # Uses `first_complete_dets` to keep track of which DET to
+                    # use to process a unique REDCap record.
+                    # Uses `all_dets` to keep track of the status for each DET record
+                    # so that they can be processed in order of `redcap_det_id` later.
+                    #   --Jover, 21 May 2020
+                    first_complete_dets: Dict[str, Any] = {}
+                    all_dets: List[Dict[str, str]] = []
+                    for det in redcap_det:
+                        instrument = det.document['instrument']
+                        record_id = det.document['record']
+                        # Assume we are loading all DETs
+                        # Status will be updated to "skip" if DET does not need to be processed
+                        det_record = { "id": det.id, "status": "load" }
+
+                        # Only pull REDCap record if
+                        # `include_incomplete` flag was not included and
+                        # the current instrument is complete
+                        if not include_incomplete and not is_complete(instrument, det.document):
+                           det_record.update({
+                               "status": "skip",
+                               "reason": "incomplete/unverified DET"
+                           })
+
+                        # Check if this is record has an older DET
+                        # Skip latest DET in favor of the first DET
+                        # This is done to continue our first-in-first-out
+                        # semantics of our receiving tables
+                        elif first_complete_dets.get(record_id):
+                            det_record.update({
+                                "status": "skip",
+                                "reason": "repeat REDCap record"
+                            })
+
+                        else:
+                            first_complete_dets[record_id] = det
+                            det_record["record_id"] = record_id
+
+                        all_dets.append(det_record)
+
+                    if not first_complete_dets:
+                        LOG.info("No new complete DETs found.")
+                    else:
+                        # Batch request records from REDCap
+                        LOG.info(f"Fetching REDCap project {project_id}")
+                        record_ids = list(first_complete_dets.keys())
+
+                        LOG.info(f"Fetching {len(record_ids):,} REDCap records from project {project.id}")
+
+                        # Convert list of REDCap records to a dict so that
+                        # records can be looked up by record id.
+                        # Records with repeating instruments or longitudinal
+                        # events will have multiple entries in the list.
+                        redcap_records: DefaultDict[str, List[dict]] = defaultdict(list)
+
+                        batches = list(chunked(record_ids, redcap_api_batch_size))
+
+                        for i, batch in enumerate(batches, 1):
+                            LOG.info(f"Fetching REDCap record batch {i:,}/{len(batches):,} of size {len(batch):,}")
+
+                            with ledger.stage("redcap"):
+                                records = project.records(ids = batch, raw = raw_coded_values)
+
+                            for record in records:
+                                redcap_records[record.id].append(record)
+
+                    # Process all DETs in order of redcap_det_id
+                    dets = savepoint_batches(db, all_dets, lambda det: f"redcap_det {det['id']}", savepoint_batch_size)
+
+                    for det, savepoint in dets:
+                        with savepoint:
+                            LOG.info(f"Processing REDCap DET {det['id']}")
+
+                            if det["status"] == "skip":
+                                LOG.debug(f"Skipping REDCap DET {det['id']} due to {det['reason']}")
+                                mark_skipped(db, det["id"], etl_id, det["reason"])
+                                continue
+
+                            received_det = first_complete_dets[det["record_id"]]
+                            redcap_record_instances = redcap_records.get(received_det.document["record"])
+
+                            if not redcap_record_instances:
+                                LOG.debug(f"REDCap record is missing or invalid.  Skipping REDCap DET {received_det.id}")
+                                mark_skipped(db, received_det.id, etl_id, "invalid REDCap record")
+                                continue
+
+                            bundle = routine(db = db, cache = shared_cache, det = received_det, redcap_record_instances = redcap_record_instances)
+
+                            if not bundle:
+                                LOG.debug(f"Skipping REDCap DET {received_det.id} due to insufficient data in REDCap record.")
+                                mark_skipped(db, received_det.id, etl_id, "insufficient data in record")
+                                continue
+
+                            if log_output:
+                                print(as_json(bundle))
+
+                            insert_fhir_bundle(db, bundle)
+                            mark_loaded(db, received_det.id, etl_id, bundle['id'])
+
+                # DETs for the same REDCap record are processed in order, by
+                # the same worker.
+                process_receiving_records(db, action, process, "redcap_det", etl_id,
+                    contains = det_contains,
+                    limit = det_limit or None,
+                    ordered_by = "document->>'record'",
+                    workers = workers,
+                    claim_size = claim_size,
+                    backfill = backfill,
+                    range_size = range_size)
+
+                if workers or backfill is not None:
+                    for key in set(shared_cache.keys()) - set(cache.keys()):
+                        cache[key] = shared_cache[key]
+
+                    manager.shutdown()
 
         return decorated
     return decorator
 
 
+@ledger.timed("write")
 def insert_fhir_bundle(db: DatabaseSession, bundle: dict) -> None:
     """
     Insert FHIR bundles into the receiving area of the database.
@@ -261,6 +284,7 @@ def mark_skipped(db: DatabaseSession, det_id: int, etl_id: dict, reason: str) ->
     mark_processed(db, det_id, {**etl_id, "status": "skipped", "skip_reason": reason})
 
 
+@ledger.timed("write")
 def mark_processed(db: DatabaseSession, det_id: int, entry = {}) -> None:
     LOG.debug(f"Appending to processing log of REDCap DET record {det_id}")
 
@@ -278,3 +302,5 @@ def mark_processed(db: DatabaseSession, det_id: int, entry = {}) -> None:
                set processing_log = processing_log || %(log_entry)s
              where redcap_det_id = %(det_id)s
             """, data)
+
+    ledger.count(entry.get("status", "processed"), db = db)
@@ -0,0 +1,209 @@
+"""
+Run several ETL routines, optionally continuously.
+
+Routines are named by their ``id3c etl`` subcommand, like "fhir", or for
+REDCap DET routines, "redcap-det/<project>".  By default, the fhir,
+presence-absence, and manifest routines and all REDCap DET routines are run.
+
+With --follow, routines are run again whenever records are received into
+their receiving table, as notified by the database, and at least every
+--poll-interval seconds.  Each run commits records in small batches, as with
+--commit-every, so results land as soon as they're processed.  Each routine
+keeps its database session, and the caches scoped to it, from one run to the
+next.  Runs which fail are logged and retried the next time their routine is
+woken, with a new session if the old one lost its connection.  If the
+connection listening for received records is lost, it's reestablished with
+backoff and all routines are run again.
+"""
+import click
+import logging
+import select
+from psycopg2 import OperationalError
+from time import sleep
+from typing import Dict, Iterable, List, Set
+from id3c.db.session import DatabaseSession
+from . import etl
+from .redcap_det import redcap_det
+
+
+LOG = logging.getLogger(__name__)
+
+
+#: Channel notified by the ``receiving.notify_received()`` trigger with the
+#: name of the receiving table records were inserted into.
+CHANNEL = "receiving"
+
+#: Receiving table processed by each ETL subcommand (or group of them).
+RECEIVING_TABLES = {
+    "fhir": "fhir",
+    "manifest": "manifest",
+    "presence-absence": "presence_absence",
+    "redcap-det": "redcap_det",
+}
+
+#: Longest wait, in seconds, between attempts to reconnect to listen for
+#: received records.
+MAX_RECONNECT_DELAY = 60
+
+
+@etl.command("run", help = __doc__)
+
+@click.argument("routines",
+    metavar = "[<routine> …]",
+    nargs = -1)
+
+@click.option("--follow",
+    is_flag = True,
+    help = "Keep running routines as records are received")
+
+@click.option("--poll-interval",
+    metavar = "<seconds>",
+    type = click.FloatRange(min = 1),
+    default = 300,
+    show_default = True,
+    help = "With --follow, run all routines at least this often even if no records are received")
+
+@click.option("--claim-size",
+    metavar = "<n>",
+    type = click.IntRange(min = 1),
+    default = 25,
+    show_default = True,
+    help = "Number of records claimed and committed at a time by each routine")
+
+@click.option("--commit",
+    is_flag = True,
+    help = "Save changes to the database.  By default, each batch is rolled back.")
+
+@click.pass_context
+
+def run(ctx: click.Context, routines: List[str], follow: bool, poll_interval: float, claim_size: int, commit: bool):
+    if not routines:
+        routines = ["fhir", "presence-absence", "manifest",
+            *(f"redcap-det/{project}" for project in redcap_det.list_commands(ctx))]
+
+    commands = { routine: find_command(ctx, routine) for routine in routines }
+    tables = { routine: RECEIVING_TABLES[routine.split("/")[0]] for routine in routines }
+
+    arguments = [
+        "--commit" if commit else "--dry-run",
+        "--commit-every", str(claim_size),
+        "--claim-size", str(claim_size),
+    ]
+
+    sessions: Dict[str, DatabaseSession] = {}
+
+    def run_routines(received: Set[str]) -> None:
+        for routine, command in commands.items():
+            if tables[routine] not in received:
+                continue
+
+            LOG.info(f"Running ETL routine {routine}")
+
+            try:
+                if routine not in sessions:
+                    sessions[routine] = DatabaseSession()
+
+                command.main(arguments, prog_name = f"id3c etl {routine.replace('/', ' ')}", standalone_mode = False, obj = sessions[routine])
+            except Exception as error:
+                LOG.exception(f"ETL routine {routine} failed: {error}")
+
+                # Connect again on the next run if the connection was lost.
+                if routine in sessions and sessions[routine].connection.closed:
+                    sessions.pop(routine).close()
+
+    if not follow:
+        run_routines(set(tables.values()))
+        return
+
+    # Listen before the first run so that nothing received during it is missed.
+    listener = listen(tables.values())
+    received = set(tables.values())
+
+    try:
+        while True:
+            run_routines(received)
+
+            # Notifications which arrived during the runs are already waiting,
+            # so a burst of them results in one more run, not one per insert.
+            try:
+                readable, _, _ = select.select([listener.connection], [], [], poll_interval)
+
+                if readable:
+                    listener.connection.poll()
+
+            except OperationalError as error:
+                LOG.warning(f"Lost the connection listening for received records: {error}")
+                listener.close()
+
+                # Records received while reconnecting weren't notified, so run
+                # all routines once listening again.
+                listener = listen(tables.values())
+                received = set(tables.values())
+                continue
+
+            if readable:
+                received = { notify.payload for notify in listener.connection.notifies }
+                listener.connection.notifies.clear()
+
+                LOG.debug(f"Received records into {', '.join(sorted(received))}")
+            else:
+                LOG.debug(f"No records received in {poll_interval:g}s; running all routines")
+                received = set(tables.values())
+
+    finally:
+        listener.close()
+
+        for db in sessions.values():
+            db.close()
+
+
+def listen(tables: Iterable[str]) -> DatabaseSession:
+    """
+    Returns a new session listening for records received into any of
+    *tables*, retrying with exponential backoff until it connects.
+    """
+    delay = 1
+
+    while True:
+        listener = None
+
+        try:
+            listener = DatabaseSession()
+            listener.connection.autocommit = True
+
+            with listener.cursor() as cursor:
+                cursor.execute(f"listen {CHANNEL}")
+
+        except OperationalError as error:
+            if listener:
+                listener.close()
+
+            LOG.warning(f"Couldn't listen for received records: {error}; retrying in {delay}s")
+            sleep(delay)
+            delay = min(delay * 2, MAX_RECONNECT_DELAY)
+
+        else:
+            LOG.info(f"Listening for records received into {', '.join(sorted(set(tables)))}")
+            return listener
+
+
+def find_command(ctx: click.Context, routine: str) -> click.Command:
+    """
+    Returns the ``id3c etl`` subcommand named by *routine*, with nested
+    subcommands separated by slashes.
+    """
+    command: click.Command = etl
+
+    for name in routine.split("/"):
+        subcommand = command.get_command(ctx, name) if isinstance(command, click.Group) else None
+
+        if subcommand is None:
+            raise click.BadParameter(f"no such ETL routine «{routine}»", param_hint = "<routine>")
+
+        command = subcommand
+
+    if isinstance(command, click.Group) or routine.split("/")[0] not in RECEIVING_TABLES:
+        raise click.BadParameter(f"«{routine}» can't be run continuously; "
+                                 f"choose from {', '.join(RECEIVING_TABLES)} (or a redcap-det/<project>)", param_hint = "<routine>")
+
+    return command
@@ -400,9 +400,10 @@ def lookup(filename: click.File,
     db = DatabaseSession()
     locations = []
 
-    for lat_lng in lat_lngs:
-        location = location_lookup(db, lat_lng, scale)
-        locations.append(location.identifier if location else None)
+    with db.read_only() as reader:
+        for lat_lng in lat_lngs:
+            location = location_lookup(reader, lat_lng, scale)
+            locations.append(location.identifier if location else None)
 
     output_df = input_df.copy()
     output_df[f"{scale}_identifier"] = locations
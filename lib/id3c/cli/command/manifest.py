@@ -26,10 +26,10 @@ from os import chdir
 from os.path import dirname
 from typing import Iterable, List, Optional, Set, Tuple, Union
 from id3c.cli import cli
+from id3c.cli.command import upload_ndjson, with_ndjson_upload_options
 from id3c.cli.io import LocalOrRemoteFile, urlopen
 from id3c.cli.io.google import *
 from id3c.cli.io.pandas import read_excel
-from id3c.db.session import DatabaseSession
 from id3c.json import dump_ndjson, load_ndjson
 from id3c.utils import format_doc
 
@@ -439,9 +439,11 @@ def diff(manifest_a, manifest_b, ignore_case = False):
 @manifest.command("upload")
 @click.argument("manifest_file",
     metavar = "<manifest.ndjson>",
-    type = LocalOrRemoteFile("r"))
+    type = LocalOrRemoteFile("rb", compression = "infer"))
+
+@with_ndjson_upload_options
 
-def upload(manifest_file):
+def upload(manifest_file, **options):
     """
     Upload manifest records into the database receiving area.
 
@@ -451,21 +453,9 @@ def upload(manifest_file):
     Once records are uploaded, the manifest ETL routine will reconcile the
     manifest records with known identifiers and existing samples.
     """
-    db = DatabaseSession()
-
-    try:
-        LOG.info(f"Copying sample manifest records from {manifest_file.path}")
-
-        row_count = db.copy_from_ndjson(("receiving", "manifest", "document"), manifest_file)
-
-        LOG.info(f"Received {row_count:,} manifest records")
-        LOG.info("Committing all changes")
-        db.commit()
+    row_count = upload_ndjson(("receiving", "manifest", "document"), manifest_file, **options)
 
-    except:
-        LOG.info("Rolling back all changes; the database will not be modified")
-        db.rollback()
-        raise
+    LOG.info(f"Received {row_count:,} manifest records")
 
 
 def select_column(table: pandas.DataFrame, name: str) -> pandas.Series:
@@ -11,13 +11,25 @@ particularly true for receiving tables which are generally populated through
 the web API and do not have a more tailored command.
 """
 import click
+import gzip
 import logging
+import os
+import re
+from datetime import datetime
+from functools import partial
+from psycopg2.sql import SQL, Identifier
 from id3c.cli import cli
+from id3c.cli.command import DatabaseSessionAction, upload_ndjson, with_database_session, with_ndjson_upload_options
+from id3c.cli.io import LocalOrRemoteFile
 from id3c.db.session import DatabaseSession
 
 
 LOG = logging.getLogger(__name__)
 
+# Receiving tables partitioned by month received (see the
+# receiving/partitions schema change).
+PARTITIONED_TABLES = ("fhir", "manifest", "presence_absence", "redcap_det")
+
 
 @cli.group("receiving", help = __doc__)
 def receiving():
@@ -30,9 +42,11 @@ def receiving():
 
 @click.argument("document_file",
     metavar = "<documents.ndjson>",
-    type = click.File("r"))
+    type = LocalOrRemoteFile("rb", compression = "infer"))
+
+@with_ndjson_upload_options
 
-def upload(table_name, document_file):
+def upload(table_name, document_file, **options):
     """
     Upload documents into a receiving table.
 
@@ -41,20 +55,188 @@ def upload(table_name, document_file):
     insert, as only "document" is provided.
 
     <documents.ndjson> must be a newline-delimited JSON file containing one
-    document per line to insert as a table row.
+    document per line to insert as a table row.  It may be compressed with
+    gzip, bzip2, xz, or zstd (if installed with the "zstd" extra), as
+    indicated by its file extension.
     """
-    db = DatabaseSession()
+    row_count = upload_ndjson(("receiving", table_name, "document"), document_file, **options)
 
-    try:
-        LOG.info(f"Copying documents from {document_file.name}")
+    LOG.info(f"Received {row_count:,} {table_name} records")
 
-        row_count = db.copy_from_ndjson(("receiving", table_name, "document"), document_file)
 
-        LOG.info(f"Received {row_count:,} {table_name} records")
-        LOG.info("Committing all changes")
-        db.commit()
+@receiving.command("partition")
+
+@click.option("--table", "tables",
+    metavar = "<table>",
+    type = click.Choice(PARTITIONED_TABLES),
+    multiple = True,
+    default = PARTITIONED_TABLES,
+    help = "Partitioned receiving table to maintain.  May be given more than once.  (default: all)")
+
+@click.option("--months",
+    metavar = "<n>",
+    type = click.IntRange(min = 1),
+    default = 3,
+    show_default = True,
+    help = "Number of months ahead to create partitions for")
+
+@with_database_session
+
+def partition(tables, months, db: DatabaseSession):
+    """
+    Create upcoming monthly partitions of receiving tables.
+
+    Records received in a month without its own partition are kept in the
+    table's default partition until this command creates one and moves them
+    into it.  Run it regularly, e.g. weekly, so the default partition stays
+    empty.
+    """
+    for table in tables:
+        created = db.fetch_all("""
+            select partition
+              from receiving.create_partitions(%s, now(), now() + make_interval(months => %s)) as partition
+            """, (table, months))
+
+        for row in created:
+            LOG.info(f"Created partition {row.partition}")
+
+
+@receiving.command("archive")
+
+@click.option("--table", "tables",
+    metavar = "<table>",
+    type = click.Choice(PARTITIONED_TABLES),
+    multiple = True,
+    default = PARTITIONED_TABLES,
+    help = "Partitioned receiving table to archive from.  May be given more than once.  (default: all)")
+
+@click.option("--before",
+    metavar = "<yyyy-mm>",
+    type = click.DateTime(["%Y-%m"]),
+    help = "Only archive months before this one  [default: the current month]")
 
-    except:
-        LOG.info("Rolling back all changes; the database will not be modified")
+@click.option("--export-to",
+    metavar = "<directory>",
+    type = click.Path(file_okay = False, writable = True),
+    help = "Export archived partitions to gzip-compressed NDJSON files in <directory> and drop them, instead of moving them into the archive schema")
+
+@with_database_session(pass_action = True)
+
+def archive(tables, before, export_to, db: DatabaseSession, action: DatabaseSessionAction):
+    """
+    Archive fully processed monthly partitions of receiving tables.
+
+    A partition is archived once it has no records waiting to be processed by
+    any ETL routine registered for its table.  Archived partitions are
+    detached from their table and moved into the archive schema, or, with
+    --export-to, written to <directory>/<partition>.ndjson.gz, one JSON object
+    per record, and dropped.  Export files are removed again unless the
+    changes are committed.
+
+    With --commit, each partition is committed as soon as it's archived, so
+    that its table is locked against inserts only briefly.  A dry run rolls
+    back each partition in turn instead.  With --prompt, all partitions are
+    archived in one transaction, which locks their tables until the prompt is
+    answered.
+    """
+    if before is None:
+        before = datetime.now().replace(day = 1, hour = 0, minute = 0, second = 0, microsecond = 0)
+
+    for table in tables:
+        relation = SQL(".").join(map(Identifier, ["receiving", table]))
+
+        for name, month in monthly_partitions(db, table):
+            if month >= before:
+                continue
+
+            partition = SQL(".").join(map(Identifier, ["receiving", name]))
+
+            # Block changes to the partition's records, including processing
+            # them, while it's checked and exported.  Inserts into other
+            # months and reads aren't blocked.
+            with db.cursor() as cursor:
+                cursor.execute(SQL("lock table {} in share mode").format(partition))
+
+            pending = db.fetch_row(SQL("""
+                select count(*) as count
+                  from receiving.pending
+                  join receiving.etl using (etl_id)
+                  join {partition} on (record_id = {id})
+                 where etl.relation = %s
+                """).format(partition = partition, id = Identifier(f"{table}_id")), (table,)).count
+
+            if pending:
+                LOG.info(f"Not archiving {name}: {pending:,} records are pending processing")
+                end_partition(db, action)
+                continue
+
+            if export_to:
+                path = os.path.join(export_to, f"{name}.ndjson.gz")
+
+                with gzip.open(path, "wb") as file, db.cursor() as cursor:
+                    db.on_rollback(partial(os.remove, path))
+
+                    # See copy_from_ndjson() for why CSV format.
+                    cursor.copy_expert(
+                        SQL("""
+                            copy (select row_to_json(record) from {partition} as record order by {id})
+                              to stdout with (
+                                format csv,
+                                delimiter E'\\x1f',
+                                quote E'\\x1b',
+                                encoding 'utf-8')
+                            """).format(partition = partition, id = Identifier(f"{table}_id")),
+                        file)
+
+                    count = cursor.rowcount
+
+            # Detaching locks the whole table, so do it only once the export
+            # is written.
+            with db.cursor() as cursor:
+                cursor.execute(SQL("alter table {} detach partition {}").format(relation, partition))
+
+                if export_to:
+                    cursor.execute(SQL("drop table {}").format(partition))
+                else:
+                    cursor.execute(SQL("alter table {} set schema archive").format(partition))
+
+            if export_to:
+                LOG.info(f"Exported {count:,} records from {name} to {path}")
+            else:
+                LOG.info(f"Moved {name} to archive.{name}")
+
+            end_partition(db, action)
+
+
+def end_partition(db: DatabaseSession, action: DatabaseSessionAction) -> None:
+    """
+    Commits or rolls back the archiving of a partition according to *action*,
+    releasing its locks, or leaves it to the end of the run for a prompt.
+    """
+    if action is DatabaseSessionAction.COMMIT:
+        db.commit()
+    elif action is DatabaseSessionAction.DRY_RUN:
         db.rollback()
-        raise
+
+
+def monthly_partitions(db: DatabaseSession, table: str):
+    """
+    Returns (name, month) pairs for the monthly partitions of receiving
+    *table*, oldest first, as named by ``receiving.create_partitions()``.
+    """
+    partitions = db.fetch_all("""
+        select relname as name
+          from pg_inherits
+          join pg_class on (pg_class.oid = inhrelid)
+         where inhparent = %s::regclass
+        """, (f"receiving.{table}",))
+
+    months = []
+
+    for row in partitions:
+        match = re.fullmatch(re.escape(table) + r"_(\d{4})_(\d{2})", row.name)
+
+        if match:
+            months.append((row.name, datetime(int(match[1]), int(match[2]), 1)))
+
+    return sorted(months, key = lambda partition: partition[1])
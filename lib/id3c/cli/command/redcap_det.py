@@ -17,9 +17,9 @@ import logging
 from typing import List
 from id3c.cli import cli
 from id3c.cli.redcap import Project, completion_status_field, is_complete, det
-from id3c.db.session import DatabaseSession
 from id3c.db.datatypes import as_json
-from id3c.cli.command import with_redcap_project
+from id3c.cli.command import upload_ndjson, with_ndjson_upload_options, with_redcap_project
+from id3c.cli.io import LocalOrRemoteFile
 
 
 LOG = logging.getLogger(__name__)
@@ -156,27 +156,17 @@ def assert_known_attribute_value(project: Project, attribute: str, values: List[
 
 @click.argument("det_file",
     metavar = "<det.ndjson>",
-    type = click.File("r"))
+    type = LocalOrRemoteFile("rb", compression = "infer"))
 
-def upload(det_file):
+@with_ndjson_upload_options
+
+def upload(det_file, **options):
     """
     Upload REDCap DET notifications into database receiving area.
 
     <det.ndjson> must be a newline-delimited JSON file produced by this
-    command's sibling command.
+    command's sibling command, optionally compressed.
     """
-    db = DatabaseSession()
-
-    try:
-        LOG.info(f"Copying REDCap DET records from {det_file.name}")
-
-        row_count = db.copy_from_ndjson(("receiving", "redcap_det", "document"), det_file)
-
-        LOG.info(f"Received {row_count:,} DET records")
-        LOG.info("Committing all changes")
-        db.commit()
+    row_count = upload_ndjson(("receiving", "redcap_det", "document"), det_file, **options)
 
-    except:
-        LOG.info("Rolling back all changes; the database will not be modified")
-        db.rollback()
-        raise
+    LOG.info(f"Received {row_count:,} DET records")
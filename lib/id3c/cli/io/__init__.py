@@ -12,16 +12,26 @@ class LocalOrRemoteFile(click.File):
     using :py:func:`urlopen`.
 
     Intended for use as the ``type`` of a :py:class:`click.Option`.
+
+    If *compression* is given, it's passed to :py:func:`urlopen` and local
+    files (except ``-`` for stdin) are opened with it too.  Use ``"infer"`` to
+    transparently decompress files based on their extension, e.g. ``.gz`` or
+    ``.zst`` (which requires the ``zstd`` extra).
     """
+    def __init__(self, *args, compression: str = None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.compression = compression
+
     def convert(self, value, param, ctx):
         original_path = str(value)
 
-        if isinstance(value, str) and "://" in value:
+        if isinstance(value, str) and ("://" in value or (self.compression and value != "-")):
             remote_file = urlopen(
                 value,
                 mode = self.mode,           # type: ignore
                 encoding = self.encoding,   # type: ignore
-                errors = self.errors)       # type: ignore
+                errors = self.errors,       # type: ignore
+                compression = self.compression)
 
             value = remote_file.open()
 
@@ -41,14 +51,16 @@ class LocalOrRemoteFile(click.File):
         return fh
 
 
-def urlopen(path, mode = "rb", encoding = None, errors = None):
+def urlopen(path, mode = "rb", encoding = None, errors = None, compression = None):
     """
     Open a local file path or URL with :py:func:`fsspec.open`.
 
     Notable supported URL schemes include ``http[s]://`` and ``s3://``, but
     other schemes are supported as well.
 
+    *compression* is passed through to :py:func:`fsspec.open`.
+
     The returned object is an :py:class:`~fsspec.core.OpenFile`, ready to be
     used as a context manager.
     """
-    return fsspec.open(path, mode = mode, encoding = encoding, errors = errors)
+    return fsspec.open(path, mode = mode, encoding = encoding, errors = errors, compression = compression)
@@ -1,19 +1,23 @@
 """
 Database interfaces
 """
+import hashlib
 import logging
 import secrets
 import statistics
 import json
+from collections import OrderedDict
 from datetime import datetime
 from psycopg2 import IntegrityError
 from psycopg2.errors import ExclusionViolation
-from psycopg2.sql import SQL, Identifier, Literal
+from psycopg2.sql import SQL, Identifier
 from statistics import median, StatisticsError
-from typing import Any, Dict, Iterable, List, Tuple, NamedTuple, Optional
+from typing import Any, Callable, Dict, Iterable, List, Tuple, NamedTuple, Optional
+from weakref import WeakKeyDictionary
 from .types import IdentifierRecord
 from .session import DatabaseSession
 from .datatypes import Json
+from ..json import JsonEncoder
 
 LOG = logging.getLogger(__name__)
 
@@ -44,25 +48,40 @@ def mint_identifiers(session: DatabaseSession, name: str, n: int) -> Any:
     minted: List[Any] = []
 
     # Lookup identifier set by name
-    identifier_set = session.fetch_row("""
-        select identifier_set_id as id
-          from warehouse.identifier_set
-         where name = %s
-        """, (name,))
+    identifier_set = session.fetch_row(FIND_IDENTIFIER_SET, (name,))
 
     if not identifier_set:
         LOG.error(f"Identifier set «{name}» does not exist")
         raise IdentifierSetNotFoundError(name)
 
-    minted = session.fetch_all("""
-        select uuid, barcode, identifier_set_id, generated
-        from mint_identifiers(%s, %s)
-        """, (identifier_set.id, n))
+    minted = session.fetch_all(MINT_IDENTIFIERS, (identifier_set.id, n))
 
     LOG.debug(f"finished minting ")
 
+    log_minting_performance(session.connection.notices, n)
+
+    return minted
+
+
+FIND_IDENTIFIER_SET = """
+    select identifier_set_id as id
+      from warehouse.identifier_set
+     where name = %s
+    """
+
+MINT_IDENTIFIERS = """
+    select uuid, barcode, identifier_set_id, generated
+    from mint_identifiers(%s, %s)
+    """
+
+
+def log_minting_performance(notices: Iterable[str], n: int) -> None:
+    """
+    Logs the minting performance stats of *n* identifiers contained in the
+    *notices* raised by the ``mint_identifiers()`` database function.
+    """
     # capture and log notice from postgres function that contains minting performance stats
-    for notice in session.connection.notices:
+    for notice in notices:
         if 'id3c_minting_performance::' in notice:
             minting_stats = json.loads(notice.split('::')[-1])
 
@@ -73,25 +92,26 @@ def mint_identifiers(session: DatabaseSession, name: str, n: int) -> Any:
             LOG.info(f"Minted {minting_stats['count']} identifiers in {minting_stats['count'] + minting_stats['failures']} tries ({minting_stats['failures']} retries) over {duration:.2f} seconds ({per_identifier:.2f} s/identifier = {per_second:.2f} identifiers/s)")
             LOG.info(f"Failure distribution: max={minting_stats['max']} mode={minting_stats['mode']} median={minting_stats['median']}")
 
-    return minted
-
 
 def find_identifier(db: DatabaseSession, barcode: str) -> Optional[IdentifierRecord]:
     """
     Lookup a known identifier by *barcode*.
+
+    Identifiers are served from the session's :func:`identifier_cache` when
+    possible, so resolve many barcodes upfront with :func:`find_identifiers`.
     """
     LOG.debug(f"Looking up barcode {barcode}")
 
-    identifier: IdentifierRecord = db.fetch_row("""
-        select uuid::text,
-               barcode,
-               generated,
-               identifier_set.name as set_name,
-               identifier_set.use as set_use
-          from warehouse.identifier
-          join warehouse.identifier_set using (identifier_set_id)
-         where barcode = %s
-        """, (barcode,))
+    cache = identifier_cache(db)
+    identifier: Optional[IdentifierRecord] = cache.get(barcode.lower())
+
+    if identifier:
+        cache.move_to_end(barcode.lower())
+    else:
+        identifier = db.fetch_row(FIND_IDENTIFIER, (barcode,), prepare = True)
+
+        if identifier:
+            cache_identifiers(cache, [identifier])
 
     if identifier:
         LOG.info(f"Found {identifier.set_name} identifier {identifier.uuid}")
@@ -101,6 +121,104 @@ def find_identifier(db: DatabaseSession, barcode: str) -> Optional[IdentifierRec
         return None
 
 
+def find_identifiers(db: DatabaseSession, barcodes: Iterable[str]) -> Dict[str, IdentifierRecord]:
+    """
+    Lookup known identifiers for all of *barcodes* at once.
+
+    Barcodes not in the session's :func:`identifier_cache` are resolved with
+    a single query and added to the cache.  Returns a dictionary mapping each
+    of *barcodes* which is known, as given, to its identifier.  Unknown
+    barcodes are omitted.
+    """
+    cache = identifier_cache(db)
+    barcodes = { barcode for barcode in barcodes if barcode }
+    missing = [ barcode for barcode in barcodes if barcode.lower() not in cache ]
+
+    if missing:
+        LOG.debug(f"Looking up {len(missing):,} barcodes")
+
+        cache_identifiers(cache, db.fetch_all(FIND_IDENTIFIERS, (missing,)))
+
+    found = {}
+
+    for barcode in barcodes:
+        identifier = cache.get(barcode.lower())
+
+        if identifier:
+            cache.move_to_end(barcode.lower())
+            found[barcode] = identifier
+
+    return found
+
+
+FIND_IDENTIFIERS = """
+    select uuid::text,
+           barcode,
+           generated,
+           identifier_set.name as set_name,
+           identifier_set.use as set_use
+      from warehouse.identifier
+      join warehouse.identifier_set using (identifier_set_id)
+     where barcode = any(%s::citext[])
+    """
+
+
+#: Maximum number of identifiers kept by each session's
+#: :func:`identifier_cache`.
+IDENTIFIER_CACHE_SIZE = 100_000
+
+_identifier_caches: "WeakKeyDictionary[DatabaseSession, Tuple[Optional[str], OrderedDict]]" = WeakKeyDictionary()
+
+
+def identifier_cache(db: DatabaseSession) -> OrderedDict:
+    """
+    Returns the LRU cache of identifiers found by *db*, keyed by lowercased
+    barcode (barcodes are case-insensitive).
+
+    Identifiers never change once minted, so cached identifiers are always
+    safe to use.  Only found identifiers are cached, since an unknown barcode
+    may be minted later.  The cache is cleared when the session switches
+    roles, as identifier visibility may depend on the role.
+    """
+    role, cache = _identifier_caches.get(db, (None, None))
+
+    if cache is None or role != db.role:
+        cache = OrderedDict()
+        _identifier_caches[db] = (db.role, cache)
+
+    return cache
+
+
+def cache_identifiers(cache: OrderedDict, identifiers: Iterable[IdentifierRecord]) -> None:
+    """
+    Adds *identifiers* to *cache*, evicting the least recently used beyond
+    :data:`IDENTIFIER_CACHE_SIZE`.
+
+    >>> cache: OrderedDict = OrderedDict()
+    >>> cache_identifiers(cache, [IdentifierRecord("u1", "AAA", None, "samples", "sample")])
+    >>> list(cache)
+    ['aaa']
+    """
+    for identifier in identifiers:
+        cache[identifier.barcode.lower()] = identifier
+        cache.move_to_end(identifier.barcode.lower())
+
+    while len(cache) > IDENTIFIER_CACHE_SIZE:
+        cache.popitem(last = False)
+
+
+FIND_IDENTIFIER = """
+    select uuid::text,
+           barcode,
+           generated,
+           identifier_set.name as set_name,
+           identifier_set.use as set_use
+      from warehouse.identifier
+      join warehouse.identifier_set using (identifier_set_id)
+     where barcode = %s
+    """
+
+
 def create_user(session: DatabaseSession, name, comment: str = None) -> None:
     """
     Create the user *name*, described by an optional *comment*.
@@ -179,6 +297,43 @@ def mode(values):
     except StatisticsError:
         return None
 
+
+def content_digest(*values: Any) -> bytes:
+    """
+    Returns a SHA-256 digest of *values*, serialized as JSON with sorted keys
+    so that the order of object keys doesn't matter.
+
+    Upserts store the digest of their incoming values in a row's
+    ``content_digest`` column and compare it before comparing the row itself.
+    Since each upsert's update is idempotent, a row whose stored digest
+    matches the incoming values needs no update.  Updates which don't set the
+    column null it (see ``warehouse.validate_content_digest()``).
+
+    >>> content_digest({"a": 1, "b": [1, 2]}, None) == content_digest({"b": [1, 2], "a": 1}, None)
+    True
+    >>> content_digest({"a": 1}, None) == content_digest({"a": 1}, False)
+    False
+    >>> len(content_digest("sample", "2026-10-16"))
+    32
+    """
+    return hashlib.sha256(
+        json.dumps(values, allow_nan = False, cls = JsonEncoder, sort_keys = True, separators = (",", ":"))
+            .encode("utf-8")).digest()
+
+
+def update_content_digest(db: DatabaseSession, table: str, id: int, digest: bytes) -> None:
+    """
+    Stores *digest* for the unchanged row *id* of warehouse *table*, so the
+    next upsert of the same values can skip comparing the row itself.
+
+    The ``modified`` timestamp of the row is left as is.
+    """
+    with db.cursor() as cursor:
+        cursor.execute(
+            sqlf("update warehouse.{} set content_digest = %s where {} = %s",
+                Identifier(table), Identifier(f"{table}_id")),
+            (digest, id))
+
 def upsert_sample(db: DatabaseSession,
                   update_identifiers: bool,
                   overwrite_collection_date: bool,
@@ -195,45 +350,13 @@ def upsert_sample(db: DatabaseSession,
     merged (at the top-level only) into the existing sample details, if any.
     Raises an exception if there is more than one matching sample.
     """
-    data = {
-        "identifier": identifier,
-        "collection_identifier": collection_identifier,
-        "collection_date": collection_date,
-        "encounter_id": encounter_id,
-        "additional_details": Json(additional_details) if additional_details else None,
-        "additional_details_without_prov": Json({k: additional_details[k] for k in additional_details if k != '_provenance'}) if additional_details else None,
-        "access_role": access_role,
-    }
+    data = upsert_sample_values(
+        update_identifiers, overwrite_collection_date, identifier, collection_identifier, collection_date,
+        encounter_id, additional_details, access_role, Json)
 
     # Look for existing sample(s)
     with db.cursor() as cursor:
-        cursor.execute("""
-            select
-                sample_id as id, identifier, collection_identifier, encounter_id, details, access_role,
-                row (
-                    identifier,
-                    collection_identifier
-                )::text !=
-                row (
-                    %(identifier)s,
-                    %(collection_identifier)s
-                )::text as identifiers_changed,
-                row(
-                    collected::timestamp,
-                    encounter_id,
-                    details
-                )::text !=
-                row(
-                    coalesce(%(collection_date)s, collected)::timestamp,
-                    coalesce(%(encounter_id)s::integer, encounter_id),
-                    coalesce(details, '{}'::jsonb) || coalesce(%(additional_details_without_prov)s, '{}')::jsonb
-                )::text as metadata_changed,
-                row(access_role)::text != row(coalesce(%(access_role)s, access_role))::text as access_role_changed
-            from warehouse.sample
-            where identifier = %(identifier)s
-                or collection_identifier = %(collection_identifier)s
-               for update
-            """, data)
+        cursor.execute(FIND_SAMPLES_FOR_UPSERT, data)
 
         samples = list(cursor)
 
@@ -242,74 +365,22 @@ def upsert_sample(db: DatabaseSession,
         LOG.info("Creating new sample")
         status = 'created'
 
-        sample = db.fetch_row("""
-            insert into warehouse.sample (identifier, collection_identifier, collected, encounter_id, details, access_role)
-                values (%(identifier)s,
-                        %(collection_identifier)s,
-                        date_or_null(%(collection_date)s),
-                        %(encounter_id)s,
-                        %(additional_details)s,
-                        %(access_role)s)
-            returning sample_id as id, identifier, collection_identifier, encounter_id
-            """, data)
+        sample = db.fetch_row(INSERT_SAMPLE, data)
 
     # One found → update
     elif len(samples) == 1:
         status = 'updated'
         sample = samples[0]
 
-        LOG.info(f"Updating existing sample {sample.id}")
-        LOG.info(f"Sample.identifiers_changed is «{sample.identifiers_changed}» ")
-        LOG.info(f"Sample.metadata_changed is «{sample.metadata_changed}» ")
-        LOG.info(f"Sample.access_role_changed is «{sample.access_role_changed}» ")
+        if not sample_update_needed(sample, update_identifiers, identifier, collection_identifier, encounter_id):
+            if not sample.digest_matched:
+                update_content_digest(db, "sample", sample.id, data["content_digest"])
 
-        # can safely skip upsert if metadata is unchanged and not updating identifiers or if all data is unchanged
-        if sample.metadata_changed == False and sample.access_role_changed == False and (not update_identifiers or sample.identifiers_changed == False):
-            LOG.info(f"Skipping upsert for sample {sample.id} «{sample.identifier}» (no change).")
             return sample, status
 
-        # Log when critical fields are changed to a different value, for manual followup as needed
-        if encounter_id and sample.encounter_id and encounter_id != sample.encounter_id:
-            LOG.debug(f"upsert_sample: encounter_id is changing on sample {sample.id} from {sample.encounter_id} to {encounter_id}")
-
-        if identifier and sample.identifier and identifier != sample.identifier:
-            LOG.warning(f"upsert_sample: identifier is changing on sample {sample.id} from {sample.identifier} to {identifier}")
-
-        if collection_identifier and sample.collection_identifier and collection_identifier != sample.collection_identifier:
-            LOG.warning(f"upsert_sample: collection_identifier is changing on sample {sample.id} from {sample.collection_identifier} to {collection_identifier}")
-
-        if sample.identifiers_changed == False and update_identifiers:
-            LOG.warning(f"upsert_sample: updating identifiers on sample {sample.id} with only one provided. Incoming identifiers are collection_identifier: {collection_identifier}, sample_identifier: {identifier}")
-
-        # Update identifier and collection_identifier if update_identifiers is True
-        identifiers_update_composable = SQL("""
-             identifier = %(identifier)s,
-                collection_identifier = %(collection_identifier)s, """)  \
-                    if update_identifiers else SQL("")
-
-        collected_update_composable = SQL("""
-             collected = coalesce(date_or_null(%(collection_date)s), collected), """) \
-                 if overwrite_collection_date else SQL("""
-                    collected = coalesce(collected, date_or_null(%(collection_date)s)), """)
-
-        # Update access_role if value changed
-        access_role_update_composable = SQL("""
-             access_role = %(access_role)s, """) if sample.access_role_changed else SQL("")
-
-        sample = db.fetch_row(SQL("""
-            update warehouse.sample
-                set {}
-                    {}
-                    {}
-                    encounter_id = coalesce(%(encounter_id)s, encounter_id),
-                    details = coalesce(details, {}) || %(additional_details)s
-             where sample_id = %(sample_id)s
-            returning sample_id as id, identifier, collection_identifier, encounter_id
-            """).format(identifiers_update_composable,
-                collected_update_composable,
-                access_role_update_composable,
-                Literal(Json({}))),
-                { **data, "sample_id": sample.id })
+        sample = db.fetch_row(
+            update_sample_sql(update_identifiers, overwrite_collection_date, sample.access_role_changed),
+            { **data, "sample_id": sample.id })
 
         assert sample.id, "Update affected no rows!"
 
@@ -317,14 +388,189 @@ def upsert_sample(db: DatabaseSession,
     else:
         raise Exception(f"More than one sample matching sample and/or collection barcodes: {samples}")
 
+    log_upserted_sample(sample, identifier, collection_identifier)
+
+    return sample, status
+
+
+def upsert_sample_values(update_identifiers: bool,
+                         overwrite_collection_date: bool,
+                         identifier: Optional[str],
+                         collection_identifier: Optional[str],
+                         collection_date: Optional[str],
+                         encounter_id: Optional[int],
+                         additional_details: dict,
+                         access_role: Optional[str],
+                         json_adapter: Callable[[Any], Any]) -> Dict[str, Any]:
+    """
+    Returns the query parameters used by :func:`upsert_sample`, wrapping JSON
+    values with the driver-specific *json_adapter*.
+    """
+    return {
+        "identifier": identifier,
+        "collection_identifier": collection_identifier,
+        "collection_date": collection_date,
+        "encounter_id": encounter_id,
+        "additional_details": json_adapter(additional_details) if additional_details else None,
+        "additional_details_without_prov": json_adapter({k: additional_details[k] for k in additional_details if k != '_provenance'}) if additional_details else None,
+        "access_role": access_role,
+        "content_digest": sample_content_digest(
+            update_identifiers, overwrite_collection_date, identifier, collection_identifier, collection_date,
+            encounter_id, additional_details, access_role),
+    }
+
+
+def sample_content_digest(update_identifiers: bool,
+                          overwrite_collection_date: bool,
+                          identifier: Optional[str],
+                          collection_identifier: Optional[str],
+                          collection_date: Optional[str],
+                          encounter_id: Optional[int],
+                          additional_details: Optional[dict],
+                          access_role: Optional[str]) -> bytes:
+    """
+    Returns the :func:`content_digest` of the parameters to
+    :func:`upsert_sample`.
+
+    Provenance in *additional_details* is left out, as it isn't considered a
+    change by :func:`upsert_sample` either.
+    """
+    return content_digest(
+        update_identifiers,
+        overwrite_collection_date,
+        identifier,
+        collection_identifier,
+        collection_date,
+        encounter_id,
+        {k: v for k, v in additional_details.items() if k != '_provenance'} if additional_details else None,
+        access_role)
+
+
+# The comparisons are skipped when the stored content digest matches.
+FIND_SAMPLES_FOR_UPSERT = """
+    select
+        sample_id as id, identifier, collection_identifier, encounter_id, details, access_role,
+        content_digest = %(content_digest)s as digest_matched,
+        case when content_digest = %(content_digest)s then false else
+        row (
+            identifier,
+            collection_identifier
+        )::text !=
+        row (
+            %(identifier)s,
+            %(collection_identifier)s
+        )::text end as identifiers_changed,
+        case when content_digest = %(content_digest)s then false else
+        row(
+            collected::timestamp,
+            encounter_id,
+            details
+        )::text !=
+        row(
+            coalesce(%(collection_date)s, collected)::timestamp,
+            coalesce(%(encounter_id)s::integer, encounter_id),
+            coalesce(details, '{}'::jsonb) || coalesce(%(additional_details_without_prov)s, '{}')::jsonb
+        )::text end as metadata_changed,
+        case when content_digest = %(content_digest)s then false else
+        row(access_role)::text != row(coalesce(%(access_role)s, access_role))::text end as access_role_changed
+    from warehouse.sample
+    where identifier = %(identifier)s
+        or collection_identifier = %(collection_identifier)s
+       for update
+    """
+
+INSERT_SAMPLE = """
+    insert into warehouse.sample (identifier, collection_identifier, collected, encounter_id, details, access_role, content_digest)
+        values (%(identifier)s,
+                %(collection_identifier)s,
+                date_or_null(%(collection_date)s),
+                %(encounter_id)s,
+                %(additional_details)s,
+                %(access_role)s,
+                %(content_digest)s)
+    returning sample_id as id, identifier, collection_identifier, encounter_id
+    """
+
+
+def sample_update_needed(sample: Any,
+                         update_identifiers: bool,
+                         identifier: Optional[str],
+                         collection_identifier: Optional[str],
+                         encounter_id: Optional[int]) -> bool:
+    """
+    Checks if the existing *sample* found by :data:`FIND_SAMPLES_FOR_UPSERT`
+    needs updating by :func:`upsert_sample`, logging critical changes for
+    manual followup.
+    """
+    LOG.info(f"Updating existing sample {sample.id}")
+    LOG.info(f"Sample.identifiers_changed is «{sample.identifiers_changed}» ")
+    LOG.info(f"Sample.metadata_changed is «{sample.metadata_changed}» ")
+    LOG.info(f"Sample.access_role_changed is «{sample.access_role_changed}» ")
+
+    # can safely skip upsert if metadata is unchanged and not updating identifiers or if all data is unchanged
+    if sample.metadata_changed == False and sample.access_role_changed == False and (not update_identifiers or sample.identifiers_changed == False):
+        LOG.info(f"Skipping upsert for sample {sample.id} «{sample.identifier}» (no change).")
+        return False
+
+    # Log when critical fields are changed to a different value, for manual followup as needed
+    if encounter_id and sample.encounter_id and encounter_id != sample.encounter_id:
+        LOG.debug(f"upsert_sample: encounter_id is changing on sample {sample.id} from {sample.encounter_id} to {encounter_id}")
+
+    if identifier and sample.identifier and identifier != sample.identifier:
+        LOG.warning(f"upsert_sample: identifier is changing on sample {sample.id} from {sample.identifier} to {identifier}")
+
+    if collection_identifier and sample.collection_identifier and collection_identifier != sample.collection_identifier:
+        LOG.warning(f"upsert_sample: collection_identifier is changing on sample {sample.id} from {sample.collection_identifier} to {collection_identifier}")
+
+    if sample.identifiers_changed == False and update_identifiers:
+        LOG.warning(f"upsert_sample: updating identifiers on sample {sample.id} with only one provided. Incoming identifiers are collection_identifier: {collection_identifier}, sample_identifier: {identifier}")
+
+    return True
+
+
+def update_sample_sql(update_identifiers: bool, overwrite_collection_date: bool, access_role_changed: bool) -> str:
+    """
+    Returns the update statement used by :func:`upsert_sample` for an existing
+    sample.
+    """
+    # Update identifier and collection_identifier if update_identifiers is True
+    identifiers_update = """
+         identifier = %(identifier)s,
+            collection_identifier = %(collection_identifier)s, """ \
+                if update_identifiers else ""
+
+    collected_update = """
+         collected = coalesce(date_or_null(%(collection_date)s), collected), """ \
+             if overwrite_collection_date else """
+                collected = coalesce(collected, date_or_null(%(collection_date)s)), """
+
+    # Update access_role if value changed
+    access_role_update = """
+         access_role = %(access_role)s, """ if access_role_changed else ""
+
+    return f"""
+        update warehouse.sample
+            set {identifiers_update}
+                {collected_update}
+                {access_role_update}
+                encounter_id = coalesce(%(encounter_id)s, encounter_id),
+                details = coalesce(details, '{{}}'::jsonb) || %(additional_details)s,
+                content_digest = %(content_digest)s
+         where sample_id = %(sample_id)s
+        returning sample_id as id, identifier, collection_identifier, encounter_id
+        """
+
+
+def log_upserted_sample(sample: Any, identifier: Optional[str], collection_identifier: Optional[str]) -> None:
+    """
+    Logs the outcome of :func:`upsert_sample`.
+    """
     if sample:
         if identifier:
             LOG.info(f"Upserted sample {sample.id} with identifier «{sample.identifier}»")
         elif collection_identifier:
             LOG.info(f"Upserted sample {sample.id} with collection identifier «{sample.collection_identifier}»")
 
-    return sample, status
-
 
 def delete_encounters(db: DatabaseSession, encounter_ids: List[int]):
     """
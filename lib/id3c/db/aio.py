@@ -0,0 +1,335 @@
+"""
+Asynchronous database sessions and helpers, using psycopg 3.
+
+:class:`AsyncDatabaseSession` mirrors :class:`~id3c.db.session.DatabaseSession`
+for use with :py:mod:`asyncio`, so DB I/O can overlap with other I/O (e.g. to
+REDCap or a geocoding service).  A single session runs one statement at a
+time, like its underlying connection; use a session per concurrent task to run
+statements concurrently.
+
+Requires the optional ``psycopg`` dependency, installed by the ``async`` extra:
+
+    pip install id3c[async]
+
+The SQL and decision logic of the async helpers here is shared with their
+synchronous counterparts in :py:mod:`id3c.db`.
+"""
+import logging
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, List, Mapping, Optional, Tuple, Union
+from uuid import uuid4
+from . import (
+    FIND_IDENTIFIER,
+    FIND_IDENTIFIER_SET,
+    FIND_SAMPLES_FOR_UPSERT,
+    INSERT_SAMPLE,
+    MINT_IDENTIFIERS,
+    IdentifierSetNotFoundError,
+    log_minting_performance,
+    log_upserted_sample,
+    sample_update_needed,
+    update_sample_sql,
+    upsert_sample_values,
+)
+from .session import fallback_application_name, pg_environment
+from .types import IdentifierRecord
+from ..json import as_json
+
+try:
+    import psycopg
+    from psycopg.rows import namedtuple_row
+    from psycopg.sql import SQL, Identifier
+    from psycopg.types.json import Jsonb
+except ImportError:
+    psycopg = None # type: ignore
+
+
+LOG = logging.getLogger(__name__)
+
+
+class AsyncDatabaseSession:
+    """
+    An asynchronous database session.
+
+    Create one by awaiting :meth:`connect`, not by calling the class directly.
+
+    >>> db = await AsyncDatabaseSession.connect() # doctest: +SKIP
+    >>> async with db:                            # doctest: +SKIP
+    ...     await db.fetch_row("select 1 as one")
+    Row(one=1)
+    """
+    connection: "psycopg.AsyncConnection"
+
+    def __init__(self, connection: "psycopg.AsyncConnection") -> None:
+        self.connection = connection
+        self.notices: List[str] = []
+
+        connection.add_notice_handler(
+            lambda diagnostic: self.notices.append(diagnostic.message_primary or ""))
+
+
+    @classmethod
+    async def connect(cls, *, username: str = None, password: str = None, role: str = None) -> "AsyncDatabaseSession":
+        """
+        Connects to the database.
+
+        Connection details and credentials work the same as for
+        :class:`~id3c.db.session.DatabaseSession`, as do *username*,
+        *password*, and *role*.
+        """
+        if psycopg is None:
+            raise RuntimeError("AsyncDatabaseSession requires psycopg 3; install id3c[async]")
+
+        LOG.debug(f"Authenticating to PostgreSQL database using {pg_environment()}")
+
+        connect_params = {
+            "row_factory": namedtuple_row,
+            "fallback_application_name": fallback_application_name(),
+
+            **({"user": username}     if username is not None else {}),
+            **({"password": password} if password is not None else {}),
+        }
+
+        try:
+            connection = await psycopg.AsyncConnection.connect("", **connect_params)
+        except psycopg.DatabaseError as error:
+            LOG.error(f"Authentication failed: {error}")
+            raise error from None
+
+        session = cls(connection)
+
+        LOG.info(f"Connected to {connection.info.user}@{connection.info.host}:{connection.info.port}/{connection.info.dbname}")
+
+        if role is not None:
+            await session.set_role(role)
+            await session.commit()
+
+        return session
+
+
+    async def __aenter__(self) -> "AsyncDatabaseSession":
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback) -> None:
+        """
+        Commits the transaction if the ``async with`` block returns normally
+        and rolls it back otherwise.  Unlike psycopg 3's own connection
+        context manager, but like psycopg2's, the connection stays open.
+        """
+        if exc_type is None:
+            await self.commit()
+        else:
+            await self.rollback()
+
+    def cursor(self) -> "psycopg.AsyncCursor":
+        """Proxy for the underlying connection's ``cursor`` method."""
+        return self.connection.cursor()
+
+    async def commit(self) -> None:
+        """Proxy for the underlying connection's ``commit`` method."""
+        await self.connection.commit()
+
+    async def rollback(self) -> None:
+        """Proxy for the underlying connection's ``rollback`` method."""
+        await self.connection.rollback()
+
+    async def close(self) -> None:
+        """Proxy for the underlying connection's ``close`` method."""
+        await self.connection.close()
+
+
+    @asynccontextmanager
+    async def savepoint(self, name: str = None) -> AsyncIterator:
+        """
+        Async context manager for database savepoints, with the same behaviour
+        as :meth:`~id3c.db.session.DatabaseSession.savepoint`.
+
+        >>> async with db.savepoint(): # doctest: +SKIP
+        ...     ... # execute database statements here
+        """
+        if name is None:
+            name = str(uuid4())
+
+        id = Identifier(name)
+
+        async with self.cursor() as cursor:
+            LOG.debug(f"Creating savepoint {name}")
+
+            await cursor.execute(
+                SQL("savepoint {}").format(id))
+
+            try:
+                yield
+
+            except Exception as error:
+                LOG.debug(f"Rolling back to savepoint {name}")
+
+                await cursor.execute(
+                    SQL("rollback to savepoint {}").format(id))
+
+                raise error from None
+
+            else:
+                LOG.debug(f"Releasing savepoint {name}")
+
+                await cursor.execute(
+                    SQL("release savepoint {}").format(id))
+
+
+    async def set_role(self, role: str) -> None:
+        """
+        Switches the current role of the session to *role*.  See
+        :meth:`~id3c.db.session.DatabaseSession.set_role`.
+        """
+        async with self.cursor() as cursor:
+            await cursor.execute(SQL("set role {}").format(Identifier(role)))
+
+
+    async def reset_role(self) -> None:
+        """
+        Switches the current role of the session back to the session user.
+        """
+        async with self.cursor() as cursor:
+            await cursor.execute("reset role")
+
+
+    async def fetch_row(self, sql: str, values: Union[Tuple, Mapping] = None) -> Any:
+        """
+        Fetches the first row from the results of the *sql* query.  See
+        :meth:`~id3c.db.session.DatabaseSession.fetch_row`.
+        """
+        async with self.cursor() as cursor:
+            await cursor.execute(sql, values)
+            assert cursor.rowcount <= 1, f"More than one result row for fetch_row({sql!r}, {values!r})"
+            return await cursor.fetchone()
+
+
+    async def fetch_all(self, sql: str, values: Union[Tuple, Mapping] = None) -> Any:
+        """
+        Fetches all rows from the results of the *sql* query.
+        """
+        async with self.cursor() as cursor:
+            await cursor.execute(sql, values)
+            return await cursor.fetchall()
+
+
+    async def copy_from_ndjson(self, qualified_column: Tuple, stream, size: int = 2**16) -> int:
+        """
+        Copies JSON documents (one per line) from the file-like object *stream*
+        into *qualified_column*, reading *size* bytes at a time.  See
+        :meth:`~id3c.db.session.DatabaseSession.copy_from_ndjson`.
+        """
+        assert len(qualified_column) >= 2, \
+            "No table name included in qualified column tuple"
+
+        table  = SQL(".").join(map(Identifier, qualified_column[0:-1]))
+        column = Identifier(qualified_column[-1])
+
+        async with self.cursor() as cursor:
+            # See DatabaseSession.copy_from_ndjson() for why CSV is used.
+            statement = SQL("""
+                copy {} ({}) from stdin with (
+                    format csv,
+                    delimiter E'\\x1f',
+                    quote E'\\x1b',
+                    encoding 'utf-8')
+                """).format(table, column)
+
+            async with cursor.copy(statement) as copy:
+                while data := stream.read(size):
+                    await copy.write(data)
+
+            return cursor.rowcount
+
+
+def json_adapter(value: Any) -> Any:
+    """
+    psycopg 3 counterpart of :class:`id3c.db.datatypes.Json`.
+    """
+    return Jsonb(value, dumps = as_json)
+
+
+async def mint_identifiers(session: AsyncDatabaseSession, name: str, n: int) -> Any:
+    """
+    Async version of :func:`id3c.db.mint_identifiers`.
+    """
+    identifier_set = await session.fetch_row(FIND_IDENTIFIER_SET, (name,))
+
+    if not identifier_set:
+        LOG.error(f"Identifier set «{name}» does not exist")
+        raise IdentifierSetNotFoundError(name)
+
+    session.notices.clear()
+
+    minted = await session.fetch_all(MINT_IDENTIFIERS, (identifier_set.id, n))
+
+    log_minting_performance(session.notices, n)
+
+    return minted
+
+
+async def find_identifier(db: AsyncDatabaseSession, barcode: str) -> Optional[IdentifierRecord]:
+    """
+    Async version of :func:`id3c.db.find_identifier`.
+    """
+    LOG.debug(f"Looking up barcode {barcode}")
+
+    identifier: IdentifierRecord = await db.fetch_row(FIND_IDENTIFIER, (barcode,))
+
+    if identifier:
+        LOG.info(f"Found {identifier.set_name} identifier {identifier.uuid}")
+        return identifier
+    else:
+        LOG.warning(f"No identifier found for barcode «{barcode}»")
+        return None
+
+
+async def upsert_sample(db: AsyncDatabaseSession,
+                        update_identifiers: bool,
+                        overwrite_collection_date: bool,
+                        identifier: Optional[str],
+                        collection_identifier: Optional[str],
+                        collection_date: Optional[str],
+                        encounter_id: Optional[int],
+                        additional_details: dict,
+                        access_role: Optional[str] = None) -> Tuple[Any, str]:
+    """
+    Async version of :func:`id3c.db.upsert_sample`.
+    """
+    data = upsert_sample_values(
+        update_identifiers, overwrite_collection_date, identifier, collection_identifier, collection_date,
+        encounter_id, additional_details, access_role, json_adapter)
+
+    samples = await db.fetch_all(FIND_SAMPLES_FOR_UPSERT, data)
+
+    if not samples:
+        LOG.info("Creating new sample")
+        status = 'created'
+
+        sample = await db.fetch_row(INSERT_SAMPLE, data)
+
+    elif len(samples) == 1:
+        status = 'updated'
+        sample = samples[0]
+
+        if not sample_update_needed(sample, update_identifiers, identifier, collection_identifier, encounter_id):
+            if not sample.digest_matched:
+                async with db.cursor() as cursor:
+                    await cursor.execute(
+                        "update warehouse.sample set content_digest = %s where sample_id = %s",
+                        (data["content_digest"], sample.id))
+
+            return sample, status
+
+        sample = await db.fetch_row(
+            update_sample_sql(update_identifiers, overwrite_collection_date, sample.access_role_changed),
+            { **data, "sample_id": sample.id })
+
+        assert sample.id, "Update affected no rows!"
+
+    else:
+        raise Exception(f"More than one sample matching sample and/or collection barcodes: {samples}")
+
+    log_upserted_sample(sample, identifier, collection_identifier)
+
+    return sample, status
@@ -0,0 +1,271 @@
+"""
+Chunked, resumable loading of newline-delimited JSON documents with ``COPY``.
+
+:meth:`~id3c.db.session.DatabaseSession.copy_from_ndjson` sends a whole stream
+in one ``COPY`` within one transaction.  The functions here instead split the
+stream into chunks of whole lines, copy and commit each chunk separately, and
+record the byte ranges of committed chunks in a :class:`Checkpoint` so an
+interrupted load can skip them when run again.
+"""
+import json
+import logging
+import os
+import threading
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from io import BytesIO
+from time import monotonic
+from typing import Callable, IO, Iterable, Iterator, List, NamedTuple, Optional, Set, Tuple
+from .session import DatabaseSession
+
+
+LOG = logging.getLogger(__name__)
+
+
+class CheckpointMismatchError(Exception):
+    """
+    Raised when a :class:`Checkpoint` file was written for a different source
+    than the one being loaded.
+    """
+    def __init__(self, path: str, source: str, expected: str) -> None:
+        super().__init__(path, source, expected)
+        self.path = path
+        self.source = source
+        self.expected = expected
+
+    def __str__(self):
+        return f"Checkpoint file {self.path} is for {self.source!r}, not {self.expected!r}"
+
+
+class Checkpoint:
+    """
+    Byte ranges of an NDJSON source which have been committed, persisted as
+    JSON to *path* after every change.
+
+    If *path* is ``None``, nothing is persisted and all offsets are
+    uncommitted.  Safe to use from multiple threads.
+
+    >>> checkpoint = Checkpoint(None, "example.ndjson")
+    >>> checkpoint.add(0, 10, 2)
+    >>> checkpoint.add(10, 25, 3)
+    >>> checkpoint.add(40, 50, 1)
+    >>> checkpoint.ranges
+    [(0, 25), (40, 50)]
+    >>> checkpoint.rows
+    6
+    >>> [ offset in checkpoint for offset in (0, 24, 25, 39, 40, 50) ]
+    [True, True, False, False, True, False]
+    """
+    def __init__(self, path: Optional[str], source: str) -> None:
+        self.path = path
+        self.source = source
+        self.ranges: List[Tuple[int, int]] = []
+        self.rows = 0
+        self._lock = threading.Lock()
+
+        if path and os.path.exists(path):
+            with open(path, encoding = "utf-8") as file:
+                saved = json.load(file)
+
+            if saved["source"] != source:
+                raise CheckpointMismatchError(path, saved["source"], source)
+
+            self.ranges = [ tuple(range_) for range_ in saved["ranges"] ] # type: ignore
+            self.rows = saved["rows"]
+
+            LOG.info(f"Resuming from checkpoint {path}: {self.rows:,} rows already committed")
+
+
+    def __contains__(self, offset: int) -> bool:
+        with self._lock:
+            return any(start <= offset < end for start, end in self.ranges)
+
+
+    def covers(self, start: int, end: int) -> bool:
+        """
+        Returns true if the whole range [*start*, *end*) has been committed.
+
+        >>> checkpoint = Checkpoint(None, "example")
+        >>> checkpoint.add(0, 10, 2)
+        >>> checkpoint.add(20, 30, 2)
+        >>> [ checkpoint.covers(*range_) for range_ in [(0, 10), (5, 10), (5, 25), (10, 20)] ]
+        [True, True, False, False]
+        """
+        with self._lock:
+            return any(covered_start <= start and end <= covered_end for covered_start, covered_end in self.ranges)
+
+
+    def add(self, start: int, end: int, rows: int) -> None:
+        """
+        Records the byte range [*start*, *end*) containing *rows* lines as
+        committed and saves the checkpoint.
+        """
+        with self._lock:
+            ranges = sorted([*self.ranges, (start, end)])
+            merged = [ranges[0]]
+
+            for next_start, next_end in ranges[1:]:
+                last_start, last_end = merged[-1]
+
+                if next_start <= last_end:
+                    merged[-1] = (last_start, max(last_end, next_end))
+                else:
+                    merged.append((next_start, next_end))
+
+            self.ranges = merged
+            self.rows += rows
+            self._save()
+
+
+    def _save(self) -> None:
+        if not self.path:
+            return
+
+        # Write and rename so that a crash mid-write can't lose the ranges
+        # saved by previous chunks.
+        temporary = f"{self.path}.tmp"
+
+        with open(temporary, "w", encoding = "utf-8") as file:
+            json.dump({"source": self.source, "ranges": self.ranges, "rows": self.rows}, file)
+
+        os.replace(temporary, self.path)
+
+
+class Chunk(NamedTuple):
+    start: int
+    end: int
+    rows: int
+    data: bytes
+
+
+def ndjson_chunks(stream: IO[bytes], size: int, skip: Checkpoint) -> Iterator[Chunk]:
+    """
+    Splits the binary *stream* into :class:`Chunk`\\ s of at most *size* whole
+    lines each, omitting lines which start at an offset contained in *skip*.
+
+    Offsets are counted in the (decompressed) bytes read from *stream*, so
+    they don't depend on *size* and a resumed load may use a different one.
+
+    >>> from io import BytesIO
+    >>> stream = BytesIO(b'{"a":1}\\n{"b":2}\\n{"c":3}\\n')
+    >>> [ (c.start, c.end, c.rows) for c in ndjson_chunks(stream, 2, Checkpoint(None, "")) ]
+    [(0, 16, 2), (16, 24, 1)]
+
+    >>> skip = Checkpoint(None, "")
+    >>> skip.add(8, 16, 1)
+    >>> [ c.data for c in ndjson_chunks(BytesIO(stream.getvalue()), 2, skip) ]
+    [b'{"a":1}\\n', b'{"c":3}\\n']
+    """
+    lines: List[bytes] = []
+    start = offset = 0
+
+    for line in stream:
+        line_start = offset
+        offset += len(line)
+
+        if line_start in skip:
+            # Chunks must be contiguous so their range can be checkpointed.
+            if lines:
+                yield Chunk(start, line_start, len(lines), b"".join(lines))
+                lines = []
+
+            start = offset
+            continue
+
+        lines.append(line)
+
+        if len(lines) >= size:
+            yield Chunk(start, offset, len(lines), b"".join(lines))
+            lines = []
+            start = offset
+
+    if lines:
+        yield Chunk(start, offset, len(lines), b"".join(lines))
+
+
+def copy_ndjson_chunks(qualified_column: Tuple,
+                       chunks: Iterable[Chunk],
+                       checkpoint: Checkpoint,
+                       jobs: int = 1,
+                       session_factory: Callable[[], DatabaseSession] = DatabaseSession) -> int:
+    """
+    Copies each of *chunks* into *qualified_column* (see
+    :meth:`~id3c.db.session.DatabaseSession.copy_from_ndjson`) and commits it,
+    recording it in *checkpoint* once committed.
+
+    With *jobs* greater than 1, that many chunks are copied concurrently, each
+    using its own session from *session_factory*.  Chunks may then be
+    committed out of order.
+
+    If a chunk fails, it is rolled back, no new chunks are started, and the
+    error is re-raised once in-progress chunks finish.  Previously committed
+    chunks remain committed and checkpointed.
+
+    Returns the number of rows copied.
+    """
+    local = threading.local()
+    sessions: List[DatabaseSession] = []
+    progress_lock = threading.Lock()
+    copied = {"rows": 0, "bytes": 0}
+    started = monotonic()
+
+    def copy(chunk: Chunk) -> int:
+        db = getattr(local, "db", None)
+
+        if db is None:
+            db = local.db = session_factory()
+            sessions.append(db)
+
+        try:
+            rows = db.copy_from_ndjson(qualified_column, BytesIO(chunk.data))
+            db.commit()
+        except:
+            db.rollback()
+            raise
+
+        checkpoint.add(chunk.start, chunk.end, rows)
+
+        with progress_lock:
+            copied["rows"] += rows
+            copied["bytes"] += len(chunk.data)
+            elapsed = monotonic() - started
+
+            LOG.info(
+                f"Committed {copied['rows']:,} rows ({copied['bytes'] / 2**20:,.1f} MiB) "
+                f"in {elapsed:,.0f}s, {copied['rows'] / max(elapsed, 1e-3):,.0f} rows/s")
+
+        return rows
+
+    try:
+        if jobs <= 1:
+            for chunk in chunks:
+                copy(chunk)
+
+        else:
+            # Bound the chunks held in memory to those in flight plus one
+            # queued per job.
+            with ThreadPoolExecutor(max_workers = jobs) as executor:
+                pending: Set = set()
+
+                try:
+                    for chunk in chunks:
+                        pending.add(executor.submit(copy, chunk))
+
+                        if len(pending) >= 2 * jobs:
+                            done, pending = wait(pending, return_when = FIRST_COMPLETED)
+
+                            for future in done:
+                                future.result()
+
+                    for future in pending:
+                        future.result()
+
+                except:
+                    for future in pending:
+                        future.cancel()
+                    raise
+
+    finally:
+        for db in sessions:
+            db.close()
+
+    return copied["rows"]
@@ -0,0 +1,538 @@
+"""
+Pooling of reusable database sessions.
+"""
+import hmac
+import logging
+import secrets
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from hashlib import pbkdf2_hmac, sha256
+from time import monotonic
+from typing import Any, DefaultDict, Dict, Iterator, List, NamedTuple, Optional, Tuple
+from psycopg2 import DatabaseError, InterfaceError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+from .session import DatabaseSession
+
+
+LOG = logging.getLogger(__name__)
+
+
+CredentialsKey = Tuple[Optional[str], Optional[str]]
+
+
+class PoolTimeoutError(Exception):
+    """
+    Raised when a :class:`DatabaseSessionPool` can't provide a session within
+    its checkout timeout because the pool is at its maximum size.
+    """
+    def __init__(self, max_size: int, timeout: float):
+        self.max_size = max_size
+        self.timeout = timeout
+
+    def __str__(self):
+        return f"No database session available after {self.timeout}s (pool is at its maximum size of {self.max_size})"
+
+
+class IdleSession(NamedTuple):
+    session: DatabaseSession
+    released: float
+
+
+class DatabaseSessionPool:
+    """
+    A thread-safe pool of reusable :class:`~id3c.db.session.DatabaseSession`
+    objects, keyed by the credentials used to create them.
+
+    Sessions are checked out with :meth:`checkout` and must be handed back
+    with :meth:`release` (or use the :meth:`session` context manager).  A
+    session is only ever reused for the same username and password it was
+    created with, so authentication and authorization remain the database's
+    job.
+
+    *max_size* limits the total number of open sessions (checked out or idle)
+    across all credentials; ``0`` means no limit.  When the limit is reached,
+    idle sessions for other credentials are closed to make room and, failing
+    that, :meth:`checkout` waits up to *checkout_timeout* seconds before
+    raising a :class:`PoolTimeoutError`.
+
+    *max_idle* limits the number of idle sessions kept per credential; ``0``
+    disables reuse entirely.  Idle sessions older than *idle_timeout* seconds
+    are closed (reaped) on the next checkout or release.
+
+    Idle sessions are health checked on checkout.  Sessions idle for longer
+    than *ping_after* seconds are additionally pinged with a trivial query
+    before being handed out.
+    """
+    max_size: int
+    max_idle: int
+    idle_timeout: float
+    checkout_timeout: float
+    ping_after: float
+
+    def __init__(self,
+                 *,
+                 max_size: int = 20,
+                 max_idle: int = 4,
+                 idle_timeout: float = 300,
+                 checkout_timeout: float = 10,
+                 ping_after: float = 30) -> None:
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.checkout_timeout = checkout_timeout
+        self.ping_after = ping_after
+
+        self._lock = threading.Condition()
+        self._idle: DefaultDict[CredentialsKey, List[IdleSession]] = defaultdict(list)
+        self._checked_out: Dict[int, CredentialsKey] = {}
+        self._size = 0
+
+        self._counters: Dict[str, int] = {
+            "created": 0,
+            "reused": 0,
+            "released": 0,
+            "discarded": 0,
+            "reaped": 0,
+            "evicted": 0,
+            "failed_health_checks": 0,
+            "waits": 0,
+            "timeouts": 0,
+        }
+
+
+    def checkout(self, username: str = None, password: str = None) -> DatabaseSession:
+        """
+        Returns a healthy session authenticated with *username* and
+        *password*, reusing an idle one if possible.
+
+        As with :class:`~id3c.db.session.DatabaseSession`, credentials default
+        to those from the environment.
+
+        Raises a :class:`psycopg2.DatabaseError` if a new session can't be
+        created and a :class:`PoolTimeoutError` if the pool is exhausted.
+        """
+        key = credentials_key(username, password)
+        deadline = monotonic() + self.checkout_timeout
+
+        while True:
+            idle = self._take_idle_or_reserve(key, deadline)
+
+            if idle is None:
+                session = self._connect(username, password)
+                break
+
+            if self._healthy(idle):
+                session = idle.session
+                self._count("reused")
+                break
+
+            self._count("failed_health_checks")
+            self._discard(idle.session)
+
+        with self._lock:
+            self._checked_out[id(session)] = key
+
+        return session
+
+
+    def release(self, session: DatabaseSession) -> None:
+        """
+        Returns a *session* previously obtained from :meth:`checkout` to the
+        pool.
+
+        Any open transaction is rolled back.  The session is closed instead of
+        kept if it is broken or if there are already *max_idle* idle sessions
+        for its credentials.
+        """
+        with self._lock:
+            key = self._checked_out.pop(id(session))
+
+        try:
+            self._reset(session)
+        except (DatabaseError, InterfaceError) as error:
+            LOG.debug(f"Discarding session which failed to reset: {error}")
+            self._discard(session)
+            return
+
+        with self._lock:
+            self._counters["released"] += 1
+
+            if len(self._idle[key]) >= self.max_idle:
+                keep = False
+            else:
+                keep = True
+                self._idle[key].append(IdleSession(session, monotonic()))
+
+            self._reap()
+            self._lock.notify()
+
+        if not keep:
+            self._discard(session)
+
+
+    @contextmanager
+    def session(self, username: str = None, password: str = None) -> Iterator[DatabaseSession]:
+        """
+        Context manager which checks out a session for the ``with`` block and
+        releases it afterwards.
+
+        >>> with pool.session(username, password) as session: # doctest: +SKIP
+        ...     ... # use session here
+        """
+        session = self.checkout(username, password)
+
+        try:
+            yield session
+        finally:
+            self.release(session)
+
+
+    def close(self) -> None:
+        """
+        Closes all idle sessions.  Checked out sessions are closed when they're
+        released.
+        """
+        with self._lock:
+            idle = [ entry.session for entries in self._idle.values() for entry in entries ]
+            self._idle.clear()
+            self.max_idle = 0
+
+        for session in idle:
+            self._discard(session)
+
+
+    def stats(self) -> Dict[str, Any]:
+        """
+        Returns a dictionary of pool-wide statistics: the current number of
+        open, idle, and checked out sessions, the number of distinct
+        credentials with idle sessions, and cumulative event counts since the
+        pool was created.
+        """
+        with self._lock:
+            idle = sum(map(len, self._idle.values()))
+
+            return {
+                "size": self._size,
+                "idle": idle,
+                "checked_out": len(self._checked_out),
+                "credentials": sum(1 for entries in self._idle.values() if entries),
+                **self._counters,
+            }
+
+
+    def _take_idle_or_reserve(self, key: CredentialsKey, deadline: float) -> Optional[IdleSession]:
+        """
+        Pops the most recently released idle session for *key*, or, if there
+        isn't one, reserves room in the pool for a new session and returns
+        ``None``.  Waits until *deadline* for room if necessary.
+        """
+        with self._lock:
+            self._reap()
+
+            while True:
+                if self._idle[key]:
+                    return self._idle[key].pop()
+
+                if not self.max_size or self._size < self.max_size:
+                    self._size += 1
+                    return None
+
+                evicted = self._evict_oldest_idle()
+
+                if evicted:
+                    self._close(evicted)
+                    self._counters["evicted"] += 1
+                    self._size -= 1
+                    continue
+
+                remaining = deadline - monotonic()
+
+                if remaining <= 0:
+                    self._counters["timeouts"] += 1
+                    raise PoolTimeoutError(self.max_size, self.checkout_timeout)
+
+                self._counters["waits"] += 1
+                self._lock.wait(remaining)
+
+
+    def _evict_oldest_idle(self) -> Optional[DatabaseSession]:
+        """
+        Removes and returns the least recently released idle session for any
+        credentials, or ``None`` if there are no idle sessions.
+        """
+        candidates = [ (entries[0].released, key) for key, entries in self._idle.items() if entries ]
+
+        if not candidates:
+            return None
+
+        _, key = min(candidates)
+
+        return self._idle[key].pop(0).session
+
+
+    def _reap(self) -> None:
+        """
+        Closes idle sessions which have been idle longer than *idle_timeout*.
+
+        Must be called with the pool lock held.
+        """
+        cutoff = monotonic() - self.idle_timeout
+
+        for key, entries in list(self._idle.items()):
+            expired = [ entry for entry in entries if entry.released < cutoff ]
+
+            if expired:
+                self._idle[key] = [ entry for entry in entries if entry.released >= cutoff ]
+
+            if not self._idle[key]:
+                del self._idle[key]
+
+            for entry in expired:
+                self._close(entry.session)
+                self._counters["reaped"] += 1
+                self._size -= 1
+
+            if expired:
+                self._lock.notify(len(expired))
+
+
+    def _connect(self, username: Optional[str], password: Optional[str]) -> DatabaseSession:
+        """
+        Creates a new session for a slot already reserved in the pool,
+        giving the slot back if the connection fails.
+        """
+        try:
+            session = DatabaseSession(username = username, password = password)
+        except:
+            with self._lock:
+                self._size -= 1
+                self._lock.notify()
+            raise
+
+        self._count("created")
+        return session
+
+
+    def _healthy(self, idle: IdleSession) -> bool:
+        """
+        Checks if the *idle* session is still usable, pinging the server if
+        the session has been idle for longer than *ping_after* seconds.
+        """
+        connection = idle.session.connection
+
+        if connection.closed or connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return False
+
+        if monotonic() - idle.released > self.ping_after:
+            try:
+                with idle.session.cursor() as cursor:
+                    cursor.execute("select 1")
+                idle.session.rollback()
+
+            except (DatabaseError, InterfaceError) as error:
+                LOG.debug(f"Idle session failed health check: {error}")
+                return False
+
+        return True
+
+
+    def _reset(self, session: DatabaseSession) -> None:
+        """
+        Prepares a released *session* for reuse.  Subclasses may extend this.
+        """
+        reset(session)
+
+
+    def _discard(self, session: DatabaseSession) -> None:
+        """
+        Closes *session* and gives its slot in the pool back.
+        """
+        self._close(session)
+
+        with self._lock:
+            self._counters["discarded"] += 1
+            self._size -= 1
+            self._lock.notify()
+
+
+    def _close(self, session: DatabaseSession) -> None:
+        try:
+            session.close()
+        except (DatabaseError, InterfaceError) as error:
+            LOG.debug(f"Error closing session: {error}")
+
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            self._counters[counter] += 1
+
+
+class RoleSwitchingSessionPool(DatabaseSessionPool):
+    """
+    A :class:`DatabaseSessionPool` which shares a single set of sessions
+    logged in as a service user (configured by the environment, as usual)
+    amongst many users.
+
+    Each :meth:`checkout` verifies the given username and password, checks
+    out one of the service user's sessions, and switches it to the user's role
+    with :meth:`~id3c.db.session.DatabaseSession.set_role`.  Privileges and
+    row-level security policies thus apply as if the user had logged in
+    directly, but the number of connections stays flat no matter how many
+    users there are.  The role is reset when the session is released.
+
+    The service user must be a member of every user role it switches to,
+    ideally with ``NOINHERIT`` so it doesn't gain their privileges itself.
+
+    Credentials are verified by a real login the first time they're seen and
+    then against a :class:`CredentialsVerifier` cache for *verifier_ttl*
+    seconds.
+
+    Other keyword arguments are the same as for :class:`DatabaseSessionPool`,
+    except that *max_idle* defaults to *max_size* since all idle sessions
+    belong to the same service user.
+    """
+    def __init__(self, *, verifier_ttl: float = 300, **kwargs) -> None:
+        kwargs.setdefault("max_idle", kwargs.get("max_size", 20))
+
+        super().__init__(**kwargs)
+
+        self.verifier = CredentialsVerifier(ttl = verifier_ttl)
+
+
+    def checkout(self, username: str = None, password: str = None) -> DatabaseSession:
+        """
+        Returns a session of the service user switched to the role
+        *username*, after verifying *password* for it.
+
+        Raises a :class:`psycopg2.DatabaseError` if the credentials are invalid
+        or the service user can't switch to the role, and a
+        :class:`PoolTimeoutError` if the pool is exhausted.
+        """
+        assert username is not None and password is not None, \
+            "username and password are required for role switching"
+
+        self.verifier.verify(username, password)
+
+        session = super().checkout()
+
+        try:
+            session.set_role(username)
+            session.commit()
+
+        except DatabaseError as error:
+            LOG.error(f"Unable to switch to role «{username}»: {error}")
+            self.release(session)
+            raise error from None
+
+        return session
+
+
+    def _reset(self, session: DatabaseSession) -> None:
+        """
+        Rolls back any open transaction and switches *session* back to the
+        service user.
+        """
+        super()._reset(session)
+
+        session.reset_role()
+        session.commit()
+
+
+class CredentialsVerifier:
+    """
+    Verifies usernames and passwords by logging into the database, caching
+    successful verifications for *ttl* seconds.
+
+    Only a salted, slow hash of each verified password is kept, never the
+    password itself.  A password which doesn't match the cached hash (e.g.
+    because it was changed) is verified again by logging in.
+    """
+    ttl: float
+
+    def __init__(self, *, ttl: float = 300) -> None:
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._cache: Dict[str, Tuple[bytes, bytes, float]] = {}
+
+
+    def verify(self, username: str, password: str) -> None:
+        """
+        Verifies that *password* is correct for *username*.
+
+        Raises a :class:`psycopg2.DatabaseError` if it isn't.
+        """
+        with self._lock:
+            cached = self._cache.get(username)
+
+        if cached:
+            salt, digest, expires = cached
+
+            if monotonic() < expires and hmac.compare_digest(digest, password_hash(password, salt)):
+                return
+
+        LOG.debug(f"Verifying credentials for «{username}» by logging in")
+
+        session = DatabaseSession(username = username, password = password)
+        session.connection.close()
+
+        salt = secrets.token_bytes(16)
+
+        with self._lock:
+            self._cache[username] = (salt, password_hash(password, salt), monotonic() + self.ttl)
+
+
+    def forget(self, username: str) -> None:
+        """
+        Removes any cached verification for *username*.
+        """
+        with self._lock:
+            self._cache.pop(username, None)
+
+
+def password_hash(password: str, salt: bytes) -> bytes:
+    """
+    Returns a salted, deliberately slow hash of *password*.
+
+    >>> password_hash("s3cret", b"salt") == password_hash("s3cret", b"salt")
+    True
+    >>> password_hash("s3cret", b"salt") == password_hash("s3cret", b"pepper")
+    False
+    """
+    return pbkdf2_hmac("sha256", password.encode("utf-8"), salt, 10_000)
+
+
+def credentials_key(username: Optional[str], password: Optional[str]) -> CredentialsKey:
+    """
+    Returns the pool key for the given *username* and *password*.
+
+    The password is hashed so that it isn't kept around in plain text as a
+    dictionary key.
+
+    >>> credentials_key("alice", "s3cret") == credentials_key("alice", "s3cret")
+    True
+    >>> credentials_key("alice", "s3cret") == credentials_key("alice", "other")
+    False
+    >>> credentials_key(None, None)
+    (None, None)
+    """
+    if password is None:
+        return (username, None)
+
+    return (username, sha256(password.encode("utf-8")).hexdigest())
+
+
+def reset(session: DatabaseSession) -> None:
+    """
+    Resets *session* so that it may be safely reused: any open transaction is
+    rolled back and notices from the server are cleared.
+    """
+    connection = session.connection
+
+    if connection.closed:
+        raise InterfaceError("connection already closed")
+
+    if connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+        session.rollback()
+
+    del connection.notices[:]
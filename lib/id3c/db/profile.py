@@ -0,0 +1,264 @@
+"""
+Opt-in per-statement timing for database sessions.
+
+A :class:`~id3c.db.session.DatabaseSession` created with ``profile = True``
+uses :class:`ProfilingConnection` and :class:`ProfilingCursor`, which record
+the wall time, rows, and number of calls of every statement in a
+:class:`QueryProfile`, aggregated by the statement's :func:`fingerprint`.
+Time spent fetching rows, including from named (server-side) cursors, is
+attributed to the statement which produced them.
+"""
+import json
+import re
+import threading
+from psycopg2.extensions import connection as Connection
+from psycopg2.extras import NamedTupleCursor
+from psycopg2.sql import Composable
+from time import perf_counter
+from typing import Dict, List, NamedTuple
+from ..utils import shorten
+
+
+COMMENT       = re.compile(r"--[^\n]*|/\*.*?\*/", re.DOTALL)
+STRING        = re.compile(r"(?:\b[Ee])?'(?:[^']|'')*'")
+UUID          = re.compile(r'"?\b[0-9a-fA-F]{8}(?:-[0-9a-fA-F]{4}){3}-[0-9a-fA-F]{12}\b"?')
+PLACEHOLDER   = re.compile(r"%\(\w+\)s|%s|\$\d+")
+NUMBER        = re.compile(r"(?<![\w.])-?\d+(?:\.\d+)?(?:[eE][-+]?\d+)?\b")
+WHITESPACE    = re.compile(r"\s+")
+VALUE_LIST    = re.compile(r"\((?:\?|null|true|false)(?:, ?(?:\?|null|true|false))*\)", re.IGNORECASE)
+REPEATED_LIST = re.compile(r"\(\.\.\.\)(?:, ?\(\.\.\.\))+")
+
+
+def fingerprint(sql: str) -> str:
+    """
+    Normalize *sql* so that executions of the same statement with different
+    values, as well as differently-sized lists of values, share a fingerprint.
+
+    >>> fingerprint('''
+    ...     select * -- comment
+    ...       from warehouse.sample
+    ...      where identifier = 'abc''d' and details->>'n' = %s
+    ...     ''')
+    'select * from warehouse.sample where identifier = ? and details->>? = ?'
+    >>> fingerprint("insert into t (a, b) values (1, 'x'), (2.5, null), (-3, E'y')")
+    'insert into t (a, b) values (...)'
+    >>> fingerprint('savepoint "0d2c1d3c-1b5e-4b8a-9a4c-6f0e2a1b3c4d"')
+    'savepoint ?'
+    >>> fingerprint("select x1 from t where id in (%(a)s, %(b)s) limit 10")
+    'select x1 from t where id in (...) limit ?'
+    """
+    sql = COMMENT.sub(" ", sql)
+    sql = STRING.sub("?", sql)
+    sql = UUID.sub("?", sql)
+    sql = PLACEHOLDER.sub("?", sql)
+    sql = NUMBER.sub("?", sql)
+    sql = WHITESPACE.sub(" ", sql).strip()
+    sql = VALUE_LIST.sub("(...)", sql)
+    sql = REPEATED_LIST.sub("(...)", sql)
+    return sql
+
+
+class StatementStats(NamedTuple):
+    fingerprint: str
+    calls: int
+    seconds: float
+    rows: int
+
+
+class QueryProfile:
+    """
+    Thread-safe aggregation of statement timings by :func:`fingerprint`.
+    """
+    def __init__(self) -> None:
+        self._stats: Dict[str, List] = {}
+        self._lock = threading.Lock()
+
+
+    def record(self, fingerprint: str, *, calls: int = 0, seconds: float = 0, rows: int = 0) -> None:
+        """
+        Adds *calls*, *seconds*, and *rows* to the totals for *fingerprint*.
+        """
+        with self._lock:
+            stats = self._stats.setdefault(fingerprint, [0, 0.0, 0])
+            stats[0] += calls
+            stats[1] += seconds
+            stats[2] += rows
+
+
+    def summary(self, top: int = None) -> List[StatementStats]:
+        """
+        Returns the stats for the *top* (default: all) statements by total
+        time, longest first.
+        """
+        with self._lock:
+            stats = [ StatementStats(fp, *values) for fp, values in self._stats.items() ]
+
+        return sorted(stats, key = lambda s: s.seconds, reverse = True)[:top]
+
+
+    def report(self, top: int = None) -> str:
+        """
+        Formats the :meth:`summary` of the *top* statements as a text table.
+
+        >>> profile = QueryProfile()
+        >>> profile.record("select ?", calls = 2, seconds = 0.5, rows = 2)
+        >>> profile.record("commit", calls = 1, seconds = 0.25)
+        >>> print(profile.report())
+          calls  total (s)  mean (ms)       rows  statement
+              2      0.500    250.000          2  select ?
+              1      0.250    250.000          0  commit
+        """
+        lines = [f"{'calls':>7}  {'total (s)':>9}  {'mean (ms)':>9}  {'rows':>9}  statement"]
+
+        for stats in self.summary(top):
+            mean = stats.seconds / stats.calls * 1000 if stats.calls else 0
+            lines.append(
+                f"{stats.calls:>7,}  {stats.seconds:>9.3f}  {mean:>9.3f}  {stats.rows:>9,}  "
+                + shorten(stats.fingerprint, 200, "…"))
+
+        return "\n".join(lines)
+
+
+    def dump(self, file, top: int = None) -> None:
+        """
+        Writes the :meth:`summary` of the *top* statements to *file* as a JSON
+        array of objects.
+        """
+        json.dump([ stats._asdict() for stats in self.summary(top) ], file, indent = 2)
+
+
+class ProfilingConnection(Connection):
+    """
+    A :class:`psycopg2.extensions.connection` which carries a
+    :class:`QueryProfile` for use by :class:`ProfilingCursor`.
+    """
+    def __init__(self, *args, **kwargs) -> None:
+        super().__init__(*args, **kwargs)
+        self.profile = QueryProfile()
+
+
+    def commit(self):
+        started = perf_counter()
+
+        try:
+            return super().commit()
+        finally:
+            self.profile.record("commit", calls = 1, seconds = perf_counter() - started)
+
+
+    def rollback(self):
+        started = perf_counter()
+
+        try:
+            return super().rollback()
+        finally:
+            self.profile.record("rollback", calls = 1, seconds = perf_counter() - started)
+
+
+class ProfilingCursor(NamedTupleCursor):
+    """
+    A :class:`psycopg2.extras.NamedTupleCursor` which records timings in the
+    :class:`QueryProfile` of its :class:`ProfilingConnection`.
+    """
+    _fingerprint = "(none)"
+
+    def _record(self, **kwargs) -> None:
+        self.connection.profile.record(self._fingerprint, **kwargs) # type: ignore
+
+
+    def execute(self, query, vars = None):
+        if isinstance(query, Composable):
+            query = query.as_string(self)
+        elif isinstance(query, bytes):
+            query = query.decode("utf-8", "replace")
+
+        self._fingerprint = fingerprint(query)
+
+        started = perf_counter()
+
+        try:
+            return super().execute(query, vars)
+        finally:
+            self._record(
+                calls = 1,
+                seconds = perf_counter() - started,
+                rows = self._affected_rows())
+
+
+    def executemany(self, query, vars_list):
+        if isinstance(query, Composable):
+            query = query.as_string(self)
+
+        self._fingerprint = fingerprint(query)
+
+        started = perf_counter()
+
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            self._record(
+                calls = 1,
+                seconds = perf_counter() - started,
+                rows = self._affected_rows())
+
+
+    def copy_expert(self, sql, file, size = 8192):
+        if isinstance(sql, Composable):
+            sql = sql.as_string(self)
+
+        self._fingerprint = fingerprint(sql)
+
+        started = perf_counter()
+
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            self._record(
+                calls = 1,
+                seconds = perf_counter() - started,
+                rows = max(self.rowcount, 0))
+
+
+    def _affected_rows(self) -> int:
+        # Rows returned by queries are counted as they're fetched, since named
+        # cursors don't know their row count up front.
+        if self.description is None and not self.closed:
+            return max(self.rowcount, 0)
+        return 0
+
+
+    def fetchone(self):
+        started = perf_counter()
+        row = super().fetchone()
+        self._record(seconds = perf_counter() - started, rows = int(row is not None))
+        return row
+
+
+    def fetchmany(self, size = None):
+        started = perf_counter()
+        rows = super().fetchmany(size)
+        self._record(seconds = perf_counter() - started, rows = len(rows))
+        return rows
+
+
+    def fetchall(self):
+        started = perf_counter()
+        rows = super().fetchall()
+        self._record(seconds = perf_counter() - started, rows = len(rows))
+        return rows
+
+
+    def __iter__(self):
+        iterator = super().__iter__()
+
+        while True:
+            started = perf_counter()
+
+            try:
+                row = next(iterator)
+            except StopIteration:
+                self._record(seconds = perf_counter() - started)
+                return
+
+            self._record(seconds = perf_counter() - started, rows = 1)
+            yield row
@@ -5,22 +5,51 @@ import logging
 import os
 import psycopg2
 import psycopg2.extensions
+import re
+from collections import OrderedDict
 from contextlib import contextmanager
+from itertools import count
+from time import monotonic
+from more_itertools import chunked
 from psycopg2 import DatabaseError
-from psycopg2.extras import NamedTupleCursor
-from psycopg2.sql import SQL, Identifier
-from typing import Any, Iterable, Iterator, Mapping, Tuple, Union
+from psycopg2.extras import NamedTupleCursor, execute_batch, execute_values
+from psycopg2.sql import SQL, Composable, Identifier
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Tuple, Union
 from uuid import uuid4
 from ..utils import shorten
+from .profile import ProfilingConnection, ProfilingCursor, QueryProfile
 
 
 LOG = logging.getLogger(__name__)
 
+PLACEHOLDER = re.compile(r"%%|%\((\w+)\)s|%s")
+
+#: Seconds between checks of a replica's replication lag.
+REPLICA_LAG_CHECK_INTERVAL = 5
+
+#: Seconds to wait before reconnecting to a replica which failed.
+REPLICA_RETRY_INTERVAL = 60
+
 
 class DatabaseSession:
     connection: psycopg2.extensions.connection
 
-    def __init__(self, *, username: str = None, password: str = None) -> None:
+    #: Number of times :meth:`fetch_row` or :meth:`fetch_all` must run a
+    #: statement with ``prepare = True`` before it's prepared server-side.
+    prepare_threshold = 5
+
+    #: Maximum number of statements kept prepared per session.
+    max_prepared = 100
+
+    #: If set, :meth:`commit_if_due` commits once this many records have been
+    #: processed since the last commit.
+    commit_every: Optional[int] = None
+
+    #: If set, :meth:`commit_if_due` commits once this many seconds have
+    #: passed since the last commit.
+    commit_interval: Optional[float] = None
+
+    def __init__(self, *, username: str = None, password: str = None, role: str = None, profile: bool = False, dsn: str = "") -> None:
         """
         Connects to the database.
 
@@ -37,11 +66,26 @@ class DatabaseSession:
         b. the optional keyword parameters *username* and *password*.
 
         Keyword parameters override credentials from the environment.
+
+        If *role* is provided, the session switches to it after connecting
+        using :meth:`set_role`.
+
+        If *profile* is true, every statement's timing is recorded in the
+        :class:`~id3c.db.profile.QueryProfile` available as :attr:`profile`.
+
+        An optional libpq connection string, *dsn*, overrides connection
+        details from the environment.
+
+        If the ``ID3C_REPLICA_DSN`` environment variable is set to a libpq
+        connection string for a hot standby, :meth:`read_only` routes queries
+        to it as long as it is no more than ``ID3C_REPLICA_MAX_LAG`` seconds
+        (default 30) behind.  The same credentials are used to connect to it.
         """
         LOG.debug(f"Authenticating to PostgreSQL database using {pg_environment()}")
 
         connect_params = {
             "cursor_factory": NamedTupleCursor,
+            **({"connection_factory": ProfilingConnection, "cursor_factory": ProfilingCursor} if profile else {}),
             "fallback_application_name": fallback_application_name(),
 
             **({"user": username}     if username is not None else {}),
@@ -52,38 +96,222 @@ class DatabaseSession:
             # connect() requires a DSN as the first arg even if the connection
             # details are fully-specified by the environment, but we don't need to
             # fill it with anything.
-            self.connection = psycopg2.connect("", **connect_params)
+            self.connection = psycopg2.connect(dsn, **connect_params)
         except DatabaseError as error:
             LOG.error(f"Authentication failed: {error}")
             raise error from None
 
         LOG.info(f"Connected to {self.session_info()}")
 
+        self._prepared: OrderedDict = OrderedDict()
+        self._statement_uses: OrderedDict = OrderedDict()
+        self._statement_names = count(1)
+
+        self.role: Optional[str] = None
+        self.replica_dsn = os.environ.get("ID3C_REPLICA_DSN") or None
+        self.replica_max_lag = float(os.environ.get("ID3C_REPLICA_MAX_LAG", 30))
+        self._replica_params: Dict[str, Any] = {"username": username, "password": password, "profile": profile}
+        self._replica: Optional[DatabaseSession] = None
+        self._replica_lagging = False
+        self._replica_checked = 0.0
+        self._replica_retry_after = 0.0
+
+        # One list per active savepoint, plus one for the transaction.
+        self._rollback_callbacks: List[List[Callable[[], Any]]] = [[]]
+        self._commit_callbacks: List[List[Callable[[], Any]]] = [[]]
+
+        self._uncommitted_records = 0
+        self._last_commit = monotonic()
+
+        if role is not None:
+            self.set_role(role)
+            self.commit()
+
+
+    @property
+    def profile(self) -> Optional[QueryProfile]:
+        """
+        The :class:`~id3c.db.profile.QueryProfile` of this session, or
+        ``None`` if it wasn't created with profiling enabled.
+        """
+        return getattr(self.connection, "profile", None)
+
 
     @property
     def __enter__(self):
         """Proxy for the underlying connection's ``__enter__`` method."""
         return self.connection.__enter__
 
-    @property
-    def __exit__(self):
-        """Proxy for the underlying connection's ``__exit__`` method."""
-        return self.connection.__exit__
+    def __exit__(self, exc_type, exc_value, traceback):
+        """
+        Proxy for the underlying connection's ``__exit__`` method, which
+        commits or rolls back the transaction.  See :meth:`on_rollback`.
+        """
+        try:
+            return self.connection.__exit__(exc_type, exc_value, traceback)
+        finally:
+            self._transaction_ended(rolled_back = exc_type is not None)
 
     @property
     def cursor(self) -> NamedTupleCursor:
         """Proxy for the underlying connection's ``cursor`` method."""
         return self.connection.cursor
 
-    @property
-    def commit(self):
+    def commit(self) -> None:
         """Proxy for the underlying connection's ``commit`` method."""
-        return self.connection.commit
+        self.connection.commit()
+        self._transaction_ended(rolled_back = False)
+
+        self._uncommitted_records = 0
+        self._last_commit = monotonic()
+
 
     @property
-    def rollback(self):
-        """Proxy for the underlying connection's ``rollback`` method."""
-        return self.connection.rollback
+    def commits_periodically(self) -> bool:
+        """
+        True if :attr:`commit_every` or :attr:`commit_interval` is set.
+        """
+        return bool(self.commit_every or self.commit_interval)
+
+
+    def commit_if_due(self, records: int = 1) -> bool:
+        """
+        Counts *records* more as processed and commits if :attr:`commit_every`
+        records have been processed or :attr:`commit_interval` seconds have
+        passed since the last commit.  Returns true if it committed.
+
+        Call it only at record boundaries, i.e. when the changes for every
+        record so far are complete, and only outside of savepoints.
+
+        >>> from unittest.mock import MagicMock
+        >>> db = DatabaseSession.__new__(DatabaseSession)
+        >>> db.connection = MagicMock()
+        >>> db._rollback_callbacks = [[]]
+        >>> db._commit_callbacks = [[]]
+        >>> db._uncommitted_records = 0
+        >>> db._last_commit = monotonic()
+        >>> db.commit_if_due()
+        False
+        >>> db.commit_every = 3
+        >>> [ db.commit_if_due(n) for n in (1, 1, 1, 2, 1) ]
+        [False, True, False, True, False]
+        """
+        self._uncommitted_records += records
+
+        due = (
+               (self.commit_every is not None and self._uncommitted_records >= self.commit_every)
+            or (self.commit_interval is not None and monotonic() - self._last_commit >= self.commit_interval))
+
+        if due:
+            self.commit()
+
+        return due
+
+    def rollback(self) -> None:
+        """
+        Proxy for the underlying connection's ``rollback`` method.  See
+        :meth:`on_rollback`.
+        """
+        try:
+            self.connection.rollback()
+        finally:
+            self._transaction_ended(rolled_back = True)
+
+
+    def on_rollback(self, callback: Callable[[], Any]) -> None:
+        """
+        Registers *callback* to be called if the changes made so far within
+        the innermost active :meth:`savepoint`, or the current transaction if
+        there is none, are rolled back.
+
+        Use it to keep in-memory state derived from those changes, such as a
+        cache of newly-inserted rows, consistent with the database.  Callbacks
+        are discarded once their changes are committed.
+
+        >>> from unittest.mock import MagicMock
+        >>> db = DatabaseSession.__new__(DatabaseSession)
+        >>> db.connection = MagicMock()
+        >>> db._rollback_callbacks = [[]]
+        >>> db._commit_callbacks = [[]]
+        >>> with db.savepoint("outer"):
+        ...     db.on_rollback(lambda: print("undo outer"))
+        ...     try:
+        ...         with db.savepoint("inner"):
+        ...             db.on_rollback(lambda: print("undo inner"))
+        ...             raise ValueError
+        ...     except ValueError:
+        ...         pass
+        undo inner
+        >>> db.rollback()
+        undo outer
+        """
+        self._rollback_callbacks[-1].append(callback)
+
+
+    def on_commit(self, callback: Callable[[], Any]) -> None:
+        """
+        Registers *callback* to be called once the changes made so far within
+        the innermost active :meth:`savepoint`, or the current transaction if
+        there is none, are committed.
+
+        Use it to act on changes only once they're durable, such as counting
+        processed records.  Callbacks are discarded if their changes are
+        rolled back.
+
+        >>> from unittest.mock import MagicMock
+        >>> db = DatabaseSession.__new__(DatabaseSession)
+        >>> db.connection = MagicMock()
+        >>> db._rollback_callbacks = [[]]
+        >>> db._commit_callbacks = [[]]
+        >>> with db.savepoint("outer"):
+        ...     db.on_commit(lambda: print("commit outer"))
+        ...     try:
+        ...         with db.savepoint("inner"):
+        ...             db.on_commit(lambda: print("commit inner"))
+        ...             raise ValueError
+        ...     except ValueError:
+        ...         pass
+        >>> db.commit()
+        commit outer
+        """
+        self._commit_callbacks[-1].append(callback)
+
+
+    def _unwind_callbacks(self, depth: int) -> Tuple[List[Callable[[], Any]], List[Callable[[], Any]]]:
+        """
+        Removes and returns the rollback and commit callbacks registered at
+        savepoint levels deeper than *depth*, each in order of registration.
+        """
+        rollback_callbacks: List[Callable[[], Any]] = []
+        commit_callbacks: List[Callable[[], Any]] = []
+
+        while len(self._rollback_callbacks) > depth:
+            rollback_callbacks[:0] = self._rollback_callbacks.pop()
+            commit_callbacks[:0] = self._commit_callbacks.pop()
+
+        return rollback_callbacks, commit_callbacks
+
+
+    def _transaction_ended(self, rolled_back: bool) -> None:
+        rollback_callbacks, commit_callbacks = self._unwind_callbacks(0)
+        self._rollback_callbacks = [[]]
+        self._commit_callbacks = [[]]
+
+        if rolled_back:
+            for callback in reversed(rollback_callbacks):
+                callback()
+        else:
+            for callback in commit_callbacks:
+                callback()
+
+
+    def close(self) -> None:
+        """
+        Closes the underlying connection and that of the replica session used
+        by :meth:`read_only`, if any.
+        """
+        self._close_replica()
+        self.connection.close()
 
 
     @contextmanager
@@ -113,6 +341,10 @@ class DatabaseSession:
             cursor.execute(
                 SQL("savepoint {}").format(id))
 
+            depth = len(self._rollback_callbacks)
+            self._rollback_callbacks.append([])
+            self._commit_callbacks.append([])
+
             try:
                 yield
 
@@ -122,6 +354,11 @@ class DatabaseSession:
                 cursor.execute(
                     SQL("rollback to savepoint {}").format(id))
 
+                rollback_callbacks, _ = self._unwind_callbacks(depth)
+
+                for callback in reversed(rollback_callbacks):
+                    callback()
+
                 raise error from None
 
             else:
@@ -130,30 +367,519 @@ class DatabaseSession:
                 cursor.execute(
                     SQL("release savepoint {}").format(id))
 
+                # Released changes are rolled back or committed with the
+                # enclosing savepoint or transaction.
+                rollback_callbacks, commit_callbacks = self._unwind_callbacks(depth)
+                self._rollback_callbacks[-1].extend(rollback_callbacks)
+                self._commit_callbacks[-1].extend(commit_callbacks)
+
+
+    def set_role(self, role: str) -> None:
+        """
+        Switches the current user of this session to *role* using ``SET
+        ROLE``, so that privilege checks and row-level security policies are
+        evaluated for *role* instead of the logged in user.
+
+        The logged in user must be a member of *role*.  Like any other
+        setting, the switch is undone if the current transaction is rolled
+        back, so commit afterwards to make it stick for the session.
+        """
+        LOG.debug(f"Switching to role «{role}»")
+
+        with self.cursor() as cursor:
+            cursor.execute(
+                SQL("set role {}").format(Identifier(role)))
+
+        self.role = role
+
+
+    def reset_role(self) -> None:
+        """
+        Switches the current user of this session back to the logged in user.
+
+        Like :meth:`set_role`, commit afterwards to make it stick.
+        """
+        LOG.debug("Resetting role")
+
+        with self.cursor() as cursor:
+            cursor.execute("reset role")
+
+        self.role = None
+
+
+    @contextmanager
+    def read_only(self) -> Iterator["DatabaseSession"]:
+        """
+        Context manager providing a session for read-only queries, with its
+        transaction committed on exit (or rolled back on error) like ``with
+        session:``.
+
+        The session provided is one connected to the replica configured by
+        ``ID3C_REPLICA_DSN`` and switched to this session's current role
+        (:attr:`role`), unless no replica is configured, it can't be reached,
+        or it is more than :attr:`replica_max_lag` seconds behind, in which
+        case it is this session itself.  Writes made by this session become
+        visible on the replica only after replication, so don't use this for
+        reads which must see them.
+
+        >>> with db.read_only() as reader: # doctest: +SKIP
+        ...     reader.fetch_row("select 1 as one")
+        Record(one=1)
+        """
+        session = self._replica_session() or self
+
+        with session:
+            yield session
+
+
+    def replication_lag(self) -> float:
+        """
+        Returns the number of seconds this session's server is behind its
+        primary.  Always 0 if the server is a primary or a standby which has
+        replayed everything it has received.
+        """
+        lag = self.fetch_row("""
+            select case
+                when not pg_is_in_recovery() then 0
+                when pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() then 0
+                else coalesce(extract(epoch from now() - pg_last_xact_replay_timestamp()), 'infinity')
+            end as seconds
+            """)
+
+        return float(lag.seconds)
+
+
+    def _replica_session(self) -> Optional["DatabaseSession"]:
+        """
+        Returns the replica session for :meth:`read_only`, connecting it if
+        necessary, or ``None`` if the primary should be used instead.
+        """
+        if not self.replica_dsn:
+            return None
+
+        now = monotonic()
+
+        if self._replica is not None and self._replica.connection.closed:
+            self._replica = None
+
+        if self._replica is None:
+            if now < self._replica_retry_after:
+                return None
+
+            try:
+                self._replica = DatabaseSession(**self._replica_params, dsn = self.replica_dsn)
+            except DatabaseError as error:
+                LOG.warning(f"Using primary since replica is unavailable: {error}")
+                self._replica_retry_after = now + REPLICA_RETRY_INTERVAL
+                return None
+
+            # A replica of a replica isn't useful.
+            self._replica.replica_dsn = None
+            self._replica_checked = 0.0
+
+        replica = self._replica
+
+        try:
+            if replica.role != self.role:
+                if self.role is not None:
+                    replica.set_role(self.role)
+                else:
+                    replica.reset_role()
+                replica.commit()
+
+            if now - self._replica_checked >= REPLICA_LAG_CHECK_INTERVAL:
+                lag = replica.replication_lag()
+                replica.commit()
+
+                lagging = lag > self.replica_max_lag
+
+                if lagging and not self._replica_lagging:
+                    LOG.warning(f"Using primary since replica is {lag:,.1f}s behind (max {self.replica_max_lag:,}s)")
+                elif self._replica_lagging and not lagging:
+                    LOG.info(f"Using replica again now that it is {lag:,.1f}s behind")
 
-    def fetch_row(self, sql: str, values: Union[Tuple, Mapping] = None) -> Any:
+                self._replica_lagging = lagging
+                self._replica_checked = now
+
+        except DatabaseError as error:
+            LOG.warning(f"Using primary since replica failed: {error}")
+            self._close_replica()
+            self._replica_retry_after = now + REPLICA_RETRY_INTERVAL
+            return None
+
+        return None if self._replica_lagging else replica
+
+
+    def _close_replica(self) -> None:
+        if self._replica is not None:
+            try:
+                self._replica.connection.close()
+            except DatabaseError as error:
+                LOG.debug(f"Error closing replica session: {error}")
+
+            self._replica = None
+
+
+    def fetch_row(self, sql: str, values: Union[Tuple, Mapping] = None, *, prepare: bool = False) -> Any:
         """
         Fetches the first row from the results of the *sql* query.
 
         Most useful for queries which only return a single row, such as selects on
         a unique key or ``insert ... returning`` statements for a single record.
+
+        If *prepare* is true, the query is run as a server-side prepared
+        statement once it's been run :attr:`prepare_threshold` times.  Use it
+        for hot lookups run once per record.
+
+        >>> from unittest.mock import MagicMock
+        >>> db = DatabaseSession.__new__(DatabaseSession)
+        >>> db.connection = MagicMock()
+        >>> db._prepared = OrderedDict()
+        >>> db._statement_uses = OrderedDict()
+        >>> db._statement_names = count(1)
+        >>> db._rollback_callbacks = [[]]
+        >>> db._commit_callbacks = [[]]
+        >>> cursor = db.connection.cursor.return_value.__enter__.return_value
+        >>> cursor.rowcount = 1
+        >>> cursor.fetchone.return_value.types = ["integer"]
+        >>> for id in range(db.prepare_threshold):
+        ...     row = db.fetch_row("select %s", (id,), prepare = True)
+        >>> for call in cursor.execute.call_args_list:
+        ...     if isinstance(call.args[0], str):
+        ...         print(call.args)
+        ('select %s', (0,))
+        ('select %s', (1,))
+        ('select %s', (2,))
+        ('select %s', (3,))
+        ('prepare "id3c_1" as select $1',)
+        ('select parameter_types::text[] as types from pg_prepared_statements where name = %s', ('id3c_1',))
+        ('execute "id3c_1" (%s)', (4,))
+
+        Without *prepare*, the query is always run as is.
+
+        >>> cursor.execute.reset_mock()
+        >>> row = db.fetch_row("select %s + 1", (0,))
+        >>> cursor.execute.call_args_list
+        [call('select %s + 1', (0,))]
+        >>> db._statement_uses
+        OrderedDict()
         """
         with self.cursor() as cursor:
-            cursor.execute(sql, values)
+            self._execute(cursor, sql, values, prepare)
             assert cursor.rowcount <= 1, f"More than one result row for fetch_row({sql!r}, {values!r})"
             return cursor.fetchone()
 
 
-    def fetch_all(self, sql: str, values: Union[Tuple, Mapping] = None) -> Any:
+    def fetch_all(self, sql: str, values: Union[Tuple, Mapping] = None, *, prepare: bool = False) -> Any:
         """
         Fetches all rows from the results of the *sql* query. Useful for
         writing alerts for new rows in queries of interest.
+
+        *prepare* is as for :meth:`fetch_row`.
         """
         with self.cursor() as cursor:
-            cursor.execute(sql, values)
+            self._execute(cursor, sql, values, prepare)
             return cursor.fetchall()
 
 
+    def _execute(self, cursor, sql: str, values: Union[Tuple, Mapping, None], prepare: bool = False) -> None:
+        """
+        Executes *sql* with *values* on *cursor*.  If *prepare* is true, uses a
+        server-side prepared statement once *sql* has been run
+        :attr:`prepare_threshold` times.
+        """
+        prepared = self._prepared_statement(sql, values) if prepare else None
+
+        if prepared:
+            name, parameters = prepared
+            placeholders = ", ".join(["%s"] * len(parameters))
+
+            cursor.execute(
+                f'execute "{name}" ({placeholders})' if parameters else f'execute "{name}"',
+                parameters)
+        else:
+            cursor.execute(sql, values)
+
+
+    def _prepared_statement(self, sql: str, values: Union[Tuple, Mapping, None]) -> Optional[Tuple[str, Tuple]]:
+        """
+        Returns the name of the prepared statement for *sql* and its positional
+        parameters from *values*, preparing it if it's now due.
+
+        Returns ``None`` if *sql* should be executed normally.
+        """
+        if not isinstance(sql, str):
+            return None
+
+        parameterized = parameterize(sql, values)
+
+        if parameterized is None:
+            return None
+
+        text, parameters = parameterized
+
+        name = self._prepared.get(sql)
+
+        if name:
+            self._prepared.move_to_end(sql)
+            return name, parameters
+
+        # Statements which failed to prepare are remembered with a negative
+        # count so they aren't tried again.
+        uses = self._statement_uses.pop(sql, 0)
+
+        if uses >= 0:
+            uses += 1
+
+        if uses < 0 or uses < self.prepare_threshold:
+            self._statement_uses[sql] = uses
+
+            while len(self._statement_uses) > 10 * self.max_prepared:
+                self._statement_uses.popitem(last = False)
+
+            return None
+
+        name = f"id3c_{next(self._statement_names)}"
+
+        try:
+            # PREPARE fails for some statements, e.g. utility commands, so
+            # don't let it abort the transaction.
+            with self.savepoint(), self.cursor() as cursor:
+                cursor.execute(f'prepare "{name}" as {text}')
+
+                # A parameter whose type isn't implied by its context is
+                # inferred as text, unlike when psycopg2 interpolates a
+                # non-string value as a literal.  Don't change results by
+                # running such statements prepared.
+                cursor.execute(
+                    "select parameter_types::text[] as types from pg_prepared_statements where name = %s",
+                    (name,))
+
+                types = cursor.fetchone().types
+
+                if any(type_ == "text" and not isinstance(value, str) and value is not None
+                       for type_, value in zip(types, parameters)):
+                    cursor.execute(f'deallocate "{name}"')
+                    raise TypeError("parameter of non-string value inferred as text")
+
+        except (DatabaseError, TypeError) as error:
+            LOG.debug(f"Not preparing statement {shorten(text, 80, '…')!r}: {error}")
+            self._statement_uses[sql] = -1
+            return None
+
+        LOG.debug(f"Prepared statement {name} as {shorten(text, 80, '…')!r}")
+
+        self._prepared[sql] = name
+
+        if len(self._prepared) > self.max_prepared:
+            _, evicted = self._prepared.popitem(last = False)
+
+            with self.cursor() as cursor:
+                cursor.execute(f'deallocate "{evicted}"')
+
+        return name, parameters
+
+
+    def invalidate_prepared(self) -> None:
+        """
+        Deallocates all server-side prepared statements of this session.
+
+        Call this after changing the schema of tables used by previously
+        prepared statements, e.g. when adding a column to a table queried by
+        ``select *``, to avoid errors like "cached plan must not change result
+        type".  Must be called outside of an aborted transaction.
+        """
+        if self._prepared:
+            with self.cursor() as cursor:
+                cursor.execute("deallocate all")
+
+        self._prepared.clear()
+        self._statement_uses.clear()
+
+
+    def execute_many(self, sql: Union[str, Composable], values: Iterable[Union[Tuple, Mapping]], page_size: int = 100) -> None:
+        """
+        Executes the *sql* statement once for each item of *values*, sending
+        *page_size* statements to the server per round trip.
+
+        Any results of the statements are discarded.  Use :meth:`fetch_values`
+        or :meth:`upsert_unnest` when results are needed.
+
+        >>> db.execute_many(  # doctest: +SKIP
+        ...     "update receiving.manifest set processing_log = processing_log || %s where manifest_id = %s",
+        ...     [(Json({"status": "skipped"}), 1), (Json({"status": "skipped"}), 2)])
+        """
+        with self.cursor() as cursor:
+            execute_batch(cursor, sql, values, page_size = page_size)
+
+
+    def fetch_values(self,
+                     sql: Union[str, Composable],
+                     values: Sequence[Union[Tuple, Mapping]],
+                     template: str = None,
+                     page_size: int = 1000) -> List[Any]:
+        """
+        Executes the *sql* statement, which must contain a single ``VALUES
+        %s`` placeholder, with up to *page_size* items of *values* expanded
+        into a multi-row ``VALUES`` list per round trip.
+
+        Returns all result rows (e.g. from a ``RETURNING`` clause) of all
+        pages, page by page.  Within a page, rows are in the order the
+        statement produces them, which for an ``insert ... values ...
+        returning`` is the order of *values*.
+
+        *template* is passed through to :func:`psycopg2.extras.execute_values`
+        and is required when items of *values* are mappings.
+
+        >>> db.fetch_values(  # doctest: +SKIP
+        ...     "insert into warehouse.target (identifier, control) values %s returning target_id as id",
+        ...     [("a", False), ("b", True)])
+        [Record(id=1), Record(id=2)]
+        """
+        with self.cursor() as cursor:
+            return execute_values(cursor, sql, values, template = template, page_size = page_size, fetch = True)
+
+
+    def upsert_unnest(self,
+                      table: Tuple[str, str],
+                      columns: Mapping[str, str],
+                      rows: Sequence[Mapping],
+                      conflict: Sequence[str],
+                      update: Sequence[str] = None,
+                      merge: Sequence[str] = (),
+                      digest: str = None,
+                      returning: Sequence[str] = (),
+                      previous: Sequence[str] = (),
+                      page_size: int = 1000) -> List[Any]:
+        """
+        Inserts *rows* into *table*, updating existing rows which conflict on
+        the *conflict* columns, using one statement per *page_size* rows.
+
+        *table* is a (schema, table) tuple.  *columns* maps each column name
+        to its PostgreSQL type (e.g. ``{"identifier": "text", "details":
+        "jsonb"}``).  Each item of *rows* is a mapping providing a value for
+        every column.  Values are sent as one array per column and expanded
+        server-side with ``unnest()``.
+
+        On conflict, the *update* columns (default: all non-*conflict*
+        columns) are overwritten with the incoming values, except for the
+        jsonb columns named in *merge*, whose incoming values are merged into
+        the existing ones with ``||``.  Rows are updated only if at least one
+        of the *update* columns changes, or, if *digest* names a content
+        digest column, only if the stored digest differs from the incoming
+        one.  If *update* is empty, conflicting rows are left as-is.
+
+        Returns one row per item of *rows*, in the same order, containing the
+        *returning* columns of the inserted, updated, or existing row, the
+        *previous* columns of the existing row prefixed with ``previous_``
+        (or nulls if there was none), and a ``status`` column with the value
+        ``created``, ``updated``, or ``unchanged``.  An existing row whose
+        only change is its *digest* is ``unchanged``.
+
+        The *conflict* columns must match a unique constraint of *table* and
+        each page of *rows* must not contain the same conflict values twice.
+
+        >>> db.upsert_unnest(  # doctest: +SKIP
+        ...     ("warehouse", "target"),
+        ...     {"identifier": "text", "control": "bool"},
+        ...     [{"identifier": "a", "control": False}],
+        ...     conflict = ["identifier"],
+        ...     returning = ["target_id"])
+        [Record(target_id=1, status='created')]
+        """
+        names = list(columns)
+
+        if update is None:
+            update = [ name for name in names if name not in conflict ]
+
+        def incoming(source: str, name: str) -> Composable:
+            if name in merge:
+                return SQL("coalesce(existing.{0}, '{{}}'::jsonb) || coalesce({1}.{0}, '{{}}'::jsonb)").format(Identifier(name), Identifier(source))
+            else:
+                return SQL("{}.{}").format(Identifier(source), Identifier(name))
+
+        def compare(source: str) -> Composable:
+            compared = [ name for name in update if name != digest ]
+
+            if not compared:
+                return SQL("false")
+
+            return SQL("({}) is distinct from ({})").format(
+                SQL(", ").join(SQL("existing.{}").format(Identifier(name)) for name in compared),
+                SQL(", ").join(incoming(source, name) for name in compared))
+
+        if update:
+            on_conflict = SQL("""
+                do update
+                   set ({update}) = row ({excluded})
+                 where {changed}
+                """).format(
+                    update   = SQL(", ").join(map(Identifier, update)),
+                    excluded = SQL(", ").join(incoming("excluded", name) for name in update),
+                    changed  = (
+                        SQL("existing.{0} is distinct from excluded.{0}").format(Identifier(digest)) if digest
+                            else compare("excluded")))
+        else:
+            on_conflict = SQL("do nothing")
+
+        query = SQL("""
+            with input as (
+                select *
+                  from unnest({arrays})
+                  with ordinality as input ({names}, ordinal)
+            ),
+            -- Not locked, as rows which the upsert below modifies can't be
+            -- locked by the same statement.  It locks them itself.
+            previous as (
+                select {conflict}, {previous_columns} {changed} as changed
+                  from {table} as existing
+                  join input using ({conflict})
+            ),
+            upserted as (
+                insert into {table} as existing ({names})
+                select {names}
+                  from input
+                 order by ordinal
+                on conflict ({conflict}) {on_conflict}
+                returning {conflict}, {upserted_returning} xmax = 0 as inserted
+            )
+            select {returning} {previous_returning}
+                   case
+                       when upserted.inserted then 'created'
+                       when upserted.inserted is not null and previous.changed then 'updated'
+                       else 'unchanged'
+                   end as status
+              from input
+              left join previous using ({conflict})
+              left join upserted using ({conflict})
+              left join {table} as existing using ({conflict})
+             order by input.ordinal
+            """).format(
+                table       = SQL(".").join(map(Identifier, table)),
+                names       = SQL(", ").join(map(Identifier, names)),
+                arrays      = SQL(", ").join(SQL("%s::{}[]").format(SQL(columns[name])) for name in names),
+                conflict    = SQL(", ").join(map(Identifier, conflict)),
+                on_conflict = on_conflict,
+                changed     = compare("input"),
+                previous_columns = SQL("").join(
+                    SQL("existing.{} as {}, ").format(Identifier(name), Identifier(f"previous_{name}")) for name in previous),
+                upserted_returning = SQL("").join(
+                    SQL("{}, ").format(Identifier(name)) for name in returning if name not in conflict),
+                returning = SQL("").join(
+                    SQL("coalesce(upserted.{0}, existing.{0}) as {0}, ").format(Identifier(name)) for name in returning),
+                previous_returning = SQL("").join(
+                    SQL("previous.{0}, ").format(Identifier(f"previous_{name}")) for name in previous))
+
+        results: List[Any] = []
+
+        with self.cursor() as cursor:
+            for page in chunked(rows, page_size):
+                cursor.execute(query, [ [ row[name] for row in page ] for name in names ])
+                results += cursor.fetchall()
+
+        return results
+
+
     def copy_from_ndjson(self, qualified_column: Tuple, stream) -> int:
         """
         Copies JSON documents (one per line) from the file-like object *stream*
@@ -208,6 +934,80 @@ class DatabaseSession:
                  if params.get(param))
 
 
+def parameterize(sql: str, values: Union[Tuple, Mapping, None]) -> Optional[Tuple[str, Tuple]]:
+    """
+    Converts *sql* with psycopg2-style placeholders for *values* to use
+    PostgreSQL's positional parameters instead, as required by ``PREPARE``.
+
+    Returns a tuple of the converted SQL and the positional parameters, or
+    ``None`` if *sql* can't be converted.
+
+    >>> parameterize("select %s, %s, '100%%'", ("a", 1))
+    ("select $1, $2, '100%'", ('a', 1))
+    >>> parameterize("select %(a)s, %(b)s, %(a)s", {"a": 1, "b": 2, "c": 3})
+    ('select $1, $2, $1', (1, 2))
+    >>> parameterize("select '100%%'", None)
+    ("select '100%%'", ())
+
+    Placeholders of the wrong style or count and SQL which already contains
+    ``$`` (e.g. dollar quoting) aren't converted.
+
+    >>> parameterize("select %s", {"a": 1})
+    >>> parameterize("select %s, %s", ("a",))
+    >>> parameterize("select $$%s$$", ("a",))
+    """
+    if "$" in sql:
+        return None
+
+    # psycopg2 doesn't interpolate (or unescape %%) without values.
+    if values is None:
+        return sql, ()
+
+    named = isinstance(values, Mapping)
+    positions: dict = {}
+    parameters: list = []
+    invalid = False
+
+    def replace(match) -> str:
+        nonlocal invalid
+
+        if match[0] == "%%":
+            return "%"
+
+        name = match[1]
+
+        if named != (name is not None):
+            invalid = True
+            return match[0]
+
+        if named:
+            if name not in positions:
+                if name not in values:  # type: ignore
+                    invalid = True
+                    return match[0]
+
+                parameters.append(values[name])  # type: ignore
+                positions[name] = len(parameters)
+
+            return f"${positions[name]}"
+
+        parameters.append(None)
+        return f"${len(parameters)}"
+
+    text = PLACEHOLDER.sub(replace, sql)
+
+    if invalid or "%" in PLACEHOLDER.sub("", sql.replace("%%", "")):
+        return None
+
+    if not named:
+        if len(parameters) != len(values):
+            return None
+
+        parameters = list(values)
+
+    return text, tuple(parameters)
+
+
 def pg_environment() -> dict:
     """
     Returns a dictionary of environment variables starting with ``PG``.
@@ -2,8 +2,9 @@
 Standardized JSON conventions.
 """
 import json
+import re
 from datetime import datetime
-from typing import Iterable
+from typing import Any, Iterable, Iterator, Tuple
 from uuid import UUID
 from .utils import contextualize_char, shorten_left
 
@@ -28,6 +29,106 @@ def load_json(value):
         raise JSONDecodeError(e) from e
 
 
+def load_json_items(value: str, key: str) -> Iterator:
+    """
+    Yields the items of the array at *key* in the JSON object *value*, one at
+    a time, without decoding the rest of the array first.
+
+    Only the item being yielded and the other top-level values of the object
+    are decoded, so a document with a huge array can be processed with
+    memory for one of its items (plus the JSON text itself).
+
+    Raises a :exc:`KeyError` if *value* has no *key* and an
+    :exc:`id3c.json.JSONDecodeError` like :func:`load_json` if *value* isn't
+    an object or *key* isn't an array.
+
+    >>> list(load_json_items('{"a": 1, "samples": [{"b": 2}, [3], "c"], "d": {}}', "samples"))
+    [{'b': 2}, [3], 'c']
+    >>> list(load_json_items(' { "samples" : [ ] } ', "samples"))
+    []
+    >>> list(load_json_items('{"a": 1}', "samples"))
+    Traceback (most recent call last):
+        ...
+    KeyError: 'samples'
+    >>> list(load_json_items('{}', "samples"))
+    Traceback (most recent call last):
+        ...
+    KeyError: 'samples'
+    >>> list(load_json_items('{"samples": {}}', "samples"))
+    Traceback (most recent call last):
+        ...
+    id3c.json.JSONDecodeError: Expecting '[': line 1 column 13 (char 12): '…samples": ▸▸▸{◂◂◂}}'
+    >>> list(load_json_items('{"samples": [1, 2', "samples"))
+    Traceback (most recent call last):
+        ...
+    id3c.json.JSONDecodeError: Expecting ',' delimiter: line 1 column 18 (char 17): unexpected end of document: '…s": [1, 2'
+    """
+    def skip(position: int) -> int:
+        return _WHITESPACE.match(value, position).end() # type: ignore
+
+    def expect(position: int, delimiter: str) -> int:
+        position = skip(position)
+
+        if value[position:position + 1] != delimiter:
+            message = f"Expecting {delimiter!r}" + (" delimiter" if delimiter in ",:" else "")
+            raise JSONDecodeError(json.JSONDecodeError(message, value, position))
+
+        return position + 1
+
+    def decode(position: int) -> Tuple[Any, int]:
+        try:
+            return _DECODER.raw_decode(value, skip(position))
+        except json.JSONDecodeError as e:
+            raise JSONDecodeError(e) from e
+
+    def at(position: int, delimiter: str) -> bool:
+        return value[position:position + 1] == delimiter
+
+    position = skip(expect(0, "{"))
+
+    if at(position, "}"):
+        raise KeyError(key)
+
+    while True:
+        name, position = decode(position)
+
+        if not isinstance(name, str):
+            raise JSONDecodeError(json.JSONDecodeError("Expecting property name enclosed in double quotes", value, skip(position)))
+
+        position = expect(position, ":")
+
+        if name == key:
+            position = skip(expect(position, "["))
+
+            if at(position, "]"):
+                return
+
+            while True:
+                item, position = decode(position)
+                yield item
+
+                position = skip(position)
+
+                if at(position, "]"):
+                    return
+
+                position = expect(position, ",")
+
+        # Other values are decoded only to find where they end.
+        _, position = decode(position)
+
+        position = skip(position)
+
+        if at(position, "}"):
+            raise KeyError(key)
+
+        position = expect(position, ",")
+
+
+_DECODER = json.JSONDecoder()
+_WHITESPACE = re.compile(r"[ \t\n\r]*")
+
+
 def dump_ndjson(iterable: Iterable) -> None:
     """
     :func:`print` *iterable* as a set of newline-delimited JSON records.
@@ -0,0 +1,10 @@
+-- Deploy seattleflu/schema:archive/schema to pg
+
+begin;
+
+create schema archive;
+
+comment on schema archive is
+    'Partitions of receiving tables detached once fully processed, kept out of the way of the ETL';
+
+commit;
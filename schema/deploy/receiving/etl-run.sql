@@ -0,0 +1,81 @@
+-- Deploy seattleflu/schema:receiving/etl-run to pg
+-- requires: receiving/schema
+-- requires: roles/consensus-genome-processor/create
+-- requires: roles/enrollment-processor/rename
+-- requires: roles/fhir-processor/create
+-- requires: roles/kit-processor/create
+-- requires: roles/manifest-processor/create
+-- requires: roles/presence-absence-processor
+-- requires: roles/redcap-det-processor/create
+
+begin;
+
+set local search_path to receiving;
+
+create table etl_run (
+    etl_run_id integer primary key generated by default as identity,
+    routine text not null,
+    action text not null,
+    host text not null,
+    pid integer not null,
+    started timestamp with time zone not null,
+    finished timestamp with time zone,
+
+    status text not null default 'running'
+        constraint etl_run_status_is_known
+            check (status in ('running', 'succeeded', 'failed')),
+
+    error text,
+
+    records jsonb not null default '{}'
+        constraint etl_run_records_is_object
+            check (jsonb_typeof(records) = 'object'),
+
+    stages jsonb not null default '{}'
+        constraint etl_run_stages_is_object
+            check (jsonb_typeof(stages) = 'object'),
+
+    peak_rss bigint
+);
+
+create index etl_run_routine_started_idx
+    on etl_run (routine, started);
+
+comment on table etl_run is
+    'Ledger of ETL runs, for spotting changes in their duration and throughput';
+comment on column etl_run.etl_run_id is
+    'Internal id of this run';
+comment on column etl_run.routine is
+    'ETL routine, as the id3c etl subcommand run (e.g. "fhir" or "redcap-det <project>")';
+comment on column etl_run.action is
+    'What was to be done with the run''s changes: "commit", "rollback", or "prompt"';
+comment on column etl_run.host is
+    'Host the run ran on';
+comment on column etl_run.pid is
+    'Process id of the run';
+comment on column etl_run.started is
+    'When the run started';
+comment on column etl_run.finished is
+    'When the run finished, or null if it''s still running or was killed';
+comment on column etl_run.status is
+    'Whether the run is running, succeeded, or failed';
+comment on column etl_run.error is
+    'Error which failed the run';
+comment on column etl_run.records is
+    'Number of records processed by the run, keyed by status (e.g. processed, skipped, failed).  Records are counted once the changes made processing them are committed, except for failed records';
+comment on column etl_run.stages is
+    'Cumulative seconds spent in each stage of the run (e.g. fetch, transform, write, commit, redcap), summed across workers.  Time spent in a stage nested within another counts only towards the nested stage';
+comment on column etl_run.peak_rss is
+    'Peak resident set size, in bytes, of the run''s largest process';
+
+grant select, insert, update
+   on etl_run
+   to "consensus-genome-processor",
+      "enrollment-processor",
+      "fhir-processor",
+      "kit-processor",
+      "manifest-processor",
+      "presence-absence-processor",
+      "redcap-det-processor";
+
+commit;
@@ -0,0 +1,30 @@
+-- Deploy seattleflu/schema:receiving/notify-received to pg
+-- requires: receiving/partitions
+
+begin;
+
+set local search_path to receiving;
+
+create or replace function notify_received() returns trigger as $$
+    begin
+        perform pg_notify('receiving', TG_TABLE_NAME);
+        return null;
+    end
+$$ language plpgsql;
+
+comment on function notify_received() is
+    'Statement trigger which notifies the "receiving" channel with the name of the table records were inserted into';
+
+create trigger notify_received after insert on fhir
+    for each statement execute procedure notify_received();
+
+create trigger notify_received after insert on manifest
+    for each statement execute procedure notify_received();
+
+create trigger notify_received after insert on presence_absence
+    for each statement execute procedure notify_received();
+
+create trigger notify_received after insert on redcap_det
+    for each statement execute procedure notify_received();
+
+commit;
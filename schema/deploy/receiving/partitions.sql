@@ -0,0 +1,209 @@
+-- Deploy seattleflu/schema:receiving/partitions to pg
+-- requires: receiving/processing-queue
+-- requires: receiving/redcap-det/indexes/document-as-jsonb
+-- requires: archive/schema
+
+-- Converts the receiving tables which grow the fastest into tables partitioned
+-- by month received, so that old, fully processed months can be detached and
+-- archived (see `id3c receiving archive`).
+--
+-- Existing records are copied into their new partitions within this one
+-- transaction, which holds an access exclusive lock on each table until it
+-- commits.  Uploads and ETL runs against the tables block until then, so
+-- deploy this during a maintenance window.
+--
+-- The primary key of a partitioned table must include the partition key, so
+-- record ids are no longer unique by constraint alone.  They remain unique
+-- because they're only ever assigned from each table's sequence: writers may
+-- insert only documents and update only processing logs, and each partition
+-- has a unique index on the id.  Code which looks up records by id alone
+-- (e.g. receiving.pending and the ETLs) relies on this.
+
+begin;
+
+set local search_path to receiving;
+
+create or replace function create_partitions(relation text, since timestamp with time zone, through timestamp with time zone) returns setof regclass as $$
+    declare
+        default_partition text := relation || '_default';
+        id text := relation || '_id';
+        earliest timestamp with time zone;
+        month timestamp with time zone;
+        partition text;
+    begin
+        -- Records received for a month without a partition land in the default
+        -- partition.  Start early enough to move them into their own.
+        execute format('select min(received) from receiving.%I', default_partition)
+           into earliest;
+
+        month := date_trunc('month', coalesce(least(since, earliest), now()));
+
+        while month < through loop
+            partition := relation || '_' || to_char(month, 'YYYY_MM');
+
+            if to_regclass(format('receiving.%I', partition)) is null then
+                execute format('create table receiving.%I (like receiving.%I including defaults including constraints)',
+                    partition, relation);
+
+                -- Ids are unique across partitions as long as they're only
+                -- assigned from the table's sequence; see receiving/partitions.
+                execute format('create unique index %I on receiving.%I (%I)',
+                    partition || '_' || id || '_key', partition, id);
+
+                execute format($sql$
+                    with moved as (
+                        delete from receiving.%I
+                         where received >= $1
+                           and received < $2
+                        returning *
+                    )
+                    insert into receiving.%I
+                        select * from moved
+                    $sql$, default_partition, partition)
+                    using month, month + interval '1 month';
+
+                execute format('alter table receiving.%I attach partition receiving.%I for values from (%L) to (%L)',
+                    relation, partition, month, month + interval '1 month');
+
+                return next format('receiving.%I', partition)::regclass;
+            end if;
+
+            month := month + interval '1 month';
+        end loop;
+    end
+$$ language plpgsql;
+
+comment on function create_partitions(text, timestamp with time zone, timestamp with time zone) is
+    'Creates the missing monthly partitions of a receiving table from the month of since (or of the earliest record in its default partition) through the month before through, and returns them';
+
+
+do $$
+    declare
+        relation text;
+        id text;
+        old_table text;
+        sequence text;
+        earliest timestamp with time zone;
+        item record;
+    begin
+        foreach relation in array array['fhir', 'manifest', 'presence_absence', 'redcap_det'] loop
+            id := relation || '_id';
+            old_table := relation || '_unpartitioned';
+            sequence := relation || '_' || id || '_seq';
+
+            execute format('alter table receiving.%I rename to %I', relation, old_table);
+            execute format('alter index receiving.%I rename to %I', relation || '_pkey', old_table || '_pkey');
+
+            -- Same columns and constraints as before, except that the primary
+            -- key must include the partition key.
+            execute format($sql$
+                create table receiving.%1$I (
+                    %2$I integer not null,
+
+                    -- Using json not jsonb because we want to keep the exact text around for
+                    -- debugging purposes.
+                    document json not null
+                        constraint %3$I
+                            check (json_typeof(document) = 'object'),
+
+                    received timestamp with time zone not null default now(),
+
+                    processing_log jsonb not null default '[]'
+                        constraint %4$I
+                            check (jsonb_typeof(processing_log) = 'array'),
+
+                    primary key (%2$I, received)
+                ) partition by range (received)
+                $sql$, relation, id, relation || '_document_is_object', relation || '_processing_log_is_array');
+
+            execute format('create table receiving.%I partition of receiving.%I default', relation || '_default', relation);
+            execute format('create unique index %I on receiving.%I (%I)',
+                relation || '_default_' || id || '_key', relation || '_default', id);
+
+            execute format('select min(received) from receiving.%I', old_table)
+               into earliest;
+
+            perform receiving.create_partitions(relation, earliest, now() + interval '3 months');
+
+            execute format('insert into receiving.%I (%I, document, received, processing_log) select %I, document, received, processing_log from receiving.%I',
+                relation, id, id, old_table);
+
+            -- Carry over comments and grants, including column grants like
+            -- processors' update (processing_log).
+            execute format('comment on table receiving.%I is %L',
+                relation, obj_description(format('receiving.%I', old_table)::regclass, 'pg_class'));
+
+            for item in
+                select attname as column_name, col_description(attrelid, attnum) as description
+                  from pg_attribute
+                 where attrelid = format('receiving.%I', old_table)::regclass
+                   and attnum > 0
+                   and not attisdropped
+            loop
+                execute format('comment on column receiving.%I.%I is %L', relation, item.column_name, item.description);
+            end loop;
+
+            for item in
+                select acl.privilege_type, acl.grantee
+                  from pg_class, aclexplode(relacl) as acl
+                 where pg_class.oid = format('receiving.%I', old_table)::regclass
+                   and acl.grantee <> relowner
+            loop
+                execute format('grant %s on receiving.%I to %s',
+                    item.privilege_type, relation,
+                    case when item.grantee = 0 then 'public' else item.grantee::regrole::text end);
+            end loop;
+
+            for item in
+                select attname as column_name, acl.privilege_type, acl.grantee
+                  from pg_attribute, aclexplode(attacl) as acl
+                 where attrelid = format('receiving.%I', old_table)::regclass
+                   and attacl is not null
+            loop
+                execute format('grant %s (%I) on receiving.%I to %s',
+                    item.privilege_type, item.column_name, relation,
+                    case when item.grantee = 0 then 'public' else item.grantee::regrole::text end);
+            end loop;
+
+            execute format('drop table receiving.%I', old_table);
+
+            -- Identity columns aren't supported on partitioned tables, so use
+            -- a plain sequence in place of the dropped table's.
+            execute format('create sequence receiving.%I as integer owned by receiving.%I.%I', sequence, relation, id);
+            execute format('select setval(%L, coalesce(max(%I), 0) + 1, false) from receiving.%I', format('receiving.%I', sequence), id, relation);
+            execute format('alter table receiving.%I alter column %I set default nextval(%L)', relation, id, format('receiving.%I', sequence));
+
+            execute format('comment on column receiving.%I.%I is %L', relation, id,
+                format('Internal id of this record, assigned from receiving.%I and unique across partitions as only the table owner may set it or received', sequence));
+
+            -- Writers which may insert records, even if only some of their
+            -- columns, need to use the sequence for their ids.
+            for item in
+                select acl.grantee
+                  from pg_class, aclexplode(relacl) as acl
+                 where pg_class.oid = format('receiving.%I', relation)::regclass
+                   and acl.privilege_type = 'INSERT'
+                union
+                select acl.grantee
+                  from pg_attribute, aclexplode(attacl) as acl
+                 where attrelid = format('receiving.%I', relation)::regclass
+                   and acl.privilege_type = 'INSERT'
+            loop
+                execute format('grant usage on sequence receiving.%I to %s', sequence,
+                    case when item.grantee = 0 then 'public' else item.grantee::regrole::text end);
+            end loop;
+
+            execute format('create index %I on receiving.%I using gin (processing_log jsonb_path_ops)',
+                relation || '_processing_log_idx', relation);
+
+            execute format('create trigger enqueue_pending after insert on receiving.%I referencing new table as inserted for each statement execute procedure receiving.enqueue_pending()', relation);
+            execute format('create trigger dequeue_processed after update on receiving.%I referencing new table as updated for each statement execute procedure receiving.dequeue_processed()', relation);
+        end loop;
+    end
+$$;
+
+create index redcap_det_document_as_jsonb_idx
+  on redcap_det
+  using gin ((document::jsonb) jsonb_path_ops);
+
+commit;
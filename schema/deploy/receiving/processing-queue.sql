@@ -0,0 +1,216 @@
+-- Deploy seattleflu/schema:receiving/processing-queue to pg
+-- requires: receiving/fhir/indexes/processing-log
+-- requires: receiving/manifest/indexes/processing-log
+-- requires: receiving/presence-absence/indexes/processing-log
+-- requires: receiving/redcap-det/indexes/processing-log
+-- requires: roles/fhir-processor/create
+-- requires: roles/manifest-processor/create
+-- requires: roles/presence-absence-processor
+-- requires: roles/redcap-det-processor/create
+
+begin;
+
+set local search_path to receiving;
+
+create table etl (
+    etl_id integer primary key generated by default as identity,
+    relation text not null,
+    name text not null,
+    log_entry jsonb not null,
+    filter jsonb,
+    registered timestamp with time zone not null default now(),
+
+    constraint etl_relation_name_key unique (relation, name)
+);
+
+comment on table etl is
+    'ETL routines whose unprocessed records in a receiving table are tracked in receiving.pending';
+comment on column etl.etl_id is
+    'Internal id of this routine';
+comment on column etl.relation is
+    'Name of the receiving table processed by the routine';
+comment on column etl.name is
+    'Name of the routine, unique per receiving table';
+comment on column etl.log_entry is
+    'Processing log entry (e.g. name and revision) which marks a record as processed by the current revision of the routine';
+comment on column etl.filter is
+    'JSON which a record''s document must contain to be processed by the routine; null for all records';
+comment on column etl.registered is
+    'When the current log entry and filter were registered';
+
+
+create table pending (
+    etl_id integer not null references etl (etl_id) on delete cascade,
+    record_id integer not null,
+
+    primary key (etl_id, record_id)
+);
+
+comment on table pending is
+    'Receiving records not yet processed by a registered ETL routine';
+comment on column pending.etl_id is
+    'Routine which hasn''t yet processed the record';
+comment on column pending.record_id is
+    'Id of the unprocessed record in the routine''s receiving table';
+
+
+create or replace function enqueue_pending() returns trigger as $$
+    begin
+        execute format($sql$
+            insert into receiving.pending (etl_id, record_id)
+                select etl.etl_id, inserted.%I
+                  from inserted
+                  join receiving.etl on (
+                        etl.relation = %L
+                    and (etl.filter is null or inserted.document::jsonb @> etl.filter))
+            $sql$, TG_TABLE_NAME || '_id', TG_TABLE_NAME);
+
+        return null;
+    end
+$$ language plpgsql
+   security definer
+   -- Explicitly restrict which schemas the code inside the function can find
+   -- other tables, functions, etc. without qualification
+   SET search_path = pg_catalog, public, pg_temp; -- tests/search-path: ignore
+
+comment on function enqueue_pending() is
+    'Statement trigger which queues newly received records for each ETL routine registered for the table';
+
+
+create or replace function dequeue_processed() returns trigger as $$
+    begin
+        execute format($sql$
+            delete from receiving.pending
+             using updated, receiving.etl
+             where etl.relation = %L
+               and pending.etl_id = etl.etl_id
+               and pending.record_id = updated.%I
+               and updated.processing_log @> jsonb_build_array(etl.log_entry)
+            $sql$, TG_TABLE_NAME, TG_TABLE_NAME || '_id');
+
+        return null;
+    end
+$$ language plpgsql
+   security definer
+   -- Explicitly restrict which schemas the code inside the function can find
+   -- other tables, functions, etc. without qualification
+   SET search_path = pg_catalog, public, pg_temp; -- tests/search-path: ignore
+
+comment on function dequeue_processed() is
+    'Statement trigger which removes records from the queues of the ETL routines whose log entry was added to their processing log';
+
+
+create or replace function register_etl(relation text, name text, log_entry jsonb, filter jsonb = null) returns integer as $$
+    declare
+        registered receiving.etl;
+        registered_id integer;
+    begin
+        -- Check once cheaply, as this is the common case, and again after
+        -- locking in case another session registered the routine meanwhile.
+        for attempt in 1..2 loop
+            select * into registered
+              from receiving.etl
+             where etl.relation = register_etl.relation
+               and etl.name = register_etl.name;
+
+            if found then
+                if registered.log_entry = register_etl.log_entry
+               and registered.filter is not distinct from register_etl.filter then
+                    return registered.etl_id;
+                end if;
+
+                -- Don't let an older revision still running elsewhere take the
+                -- queue back from a newer one.
+                if (registered.log_entry->>'revision')::integer > (register_etl.log_entry->>'revision')::integer then
+                    return null;
+                end if;
+            end if;
+
+            if attempt = 1 then
+                -- Block inserts and processing log updates while the queue is
+                -- rebuilt so no record is missed or left behind.
+                execute format('lock table receiving.%I in share row exclusive mode', relation);
+            end if;
+        end loop;
+
+        insert into receiving.etl (relation, name, log_entry, filter)
+            values (relation, name, log_entry, filter)
+            on conflict on constraint etl_relation_name_key do update
+                set log_entry  = excluded.log_entry,
+                    filter     = excluded.filter,
+                    registered = now()
+            returning etl_id into registered_id;
+
+        delete from receiving.pending where etl_id = registered_id;
+
+        execute format($sql$
+            insert into receiving.pending (etl_id, record_id)
+                select $1, %I
+                  from receiving.%I
+                 where not processing_log @> jsonb_build_array($2)
+                   and ($3 is null or document::jsonb @> $3)
+            $sql$, relation || '_id', relation)
+            using registered_id, log_entry, filter;
+
+        return registered_id;
+    end
+$$ language plpgsql
+   security definer
+   -- Explicitly restrict which schemas the code inside the function can find
+   -- other tables, functions, etc. without qualification
+   SET search_path = pg_catalog, public, pg_temp; -- tests/search-path: ignore
+
+comment on function register_etl(text, text, jsonb, jsonb) is
+    'Registers the log entry and filter of an ETL routine for a receiving table, rebuilding its queue of pending records if they changed, and returns its id.  Returns null if a newer revision of the routine is already registered.';
+
+
+create trigger enqueue_pending after insert on fhir
+    referencing new table as inserted
+    for each statement execute procedure enqueue_pending();
+
+create trigger enqueue_pending after insert on manifest
+    referencing new table as inserted
+    for each statement execute procedure enqueue_pending();
+
+create trigger enqueue_pending after insert on presence_absence
+    referencing new table as inserted
+    for each statement execute procedure enqueue_pending();
+
+create trigger enqueue_pending after insert on redcap_det
+    referencing new table as inserted
+    for each statement execute procedure enqueue_pending();
+
+create trigger dequeue_processed after update on fhir
+    referencing new table as updated
+    for each statement execute procedure dequeue_processed();
+
+create trigger dequeue_processed after update on manifest
+    referencing new table as updated
+    for each statement execute procedure dequeue_processed();
+
+create trigger dequeue_processed after update on presence_absence
+    referencing new table as updated
+    for each statement execute procedure dequeue_processed();
+
+create trigger dequeue_processed after update on redcap_det
+    referencing new table as updated
+    for each statement execute procedure dequeue_processed();
+
+
+revoke all on function register_etl(text, text, jsonb, jsonb) from public;
+
+grant execute
+   on function register_etl(text, text, jsonb, jsonb)
+   to "fhir-processor",
+      "manifest-processor",
+      "presence-absence-processor",
+      "redcap-det-processor";
+
+grant select
+   on etl, pending
+   to "fhir-processor",
+      "manifest-processor",
+      "presence-absence-processor",
+      "redcap-det-processor";
+
+commit;
@@ -0,0 +1,125 @@
+-- Deploy seattleflu/schema:warehouse/content-digest to pg
+-- requires: warehouse/encounter/triggers/update-modified-timestamp
+-- requires: warehouse/individual/triggers/update-modified-timestamp
+-- requires: warehouse/sample/triggers/update-modified-timestamp
+-- requires: warehouse/presence_absence/triggers/update-modified-timestamp
+
+begin;
+
+set local search_path to warehouse;
+
+alter table encounter        add column content_digest bytea;
+alter table individual       add column content_digest bytea;
+alter table sample           add column content_digest bytea;
+alter table presence_absence add column content_digest bytea;
+
+comment on column encounter.content_digest is
+    'Digest of the normalized content last written to this row by an ETL, for cheap change detection; null if unknown';
+comment on column individual.content_digest is
+    'Digest of the normalized content last written to this row by an ETL, for cheap change detection; null if unknown';
+comment on column sample.content_digest is
+    'Digest of the normalized content last written to this row by an ETL, for cheap change detection; null if unknown';
+comment on column presence_absence.content_digest is
+    'Digest of the normalized content last written to this row by an ETL, for cheap change detection; null if unknown';
+
+-- The triggers' when clauses decide which case applies by comparing the
+-- table's columns, so the function itself doesn't have to.
+create or replace function validate_content_digest() returns trigger as $$
+    begin
+        if NEW.content_digest is not distinct from OLD.content_digest then
+            -- The row was changed by a writer which doesn't maintain the
+            -- digest, so it no longer describes the row.
+            NEW.content_digest = null;
+        else
+            -- Only the digest was set, which isn't a modification of the row.
+            NEW.modified = OLD.modified;
+        end if;
+
+        return NEW;
+    end;
+$$ language plpgsql
+    stable;
+
+comment on function validate_content_digest is
+    'Nulls the content_digest column on updates which change a row without setting it, and keeps the modified timestamp on updates which only set it, as selected by the when clauses of the validate_content_digest_changed and validate_content_digest_set triggers';
+
+-- Named to fire after update_modified_timestamp, since before triggers fire in
+-- alphabetical order.  The column lists exclude only content_digest and
+-- modified, and must be updated when columns are added to the tables.
+create trigger validate_content_digest_changed
+    before update on encounter
+    for each row
+    when (old.content_digest is not null
+      and old.content_digest is not distinct from new.content_digest
+      and (old.encounter_id, old.identifier, old.individual_id, old.site_id, old.encountered, old.age, old.details, old.created)
+          is distinct from
+          (new.encounter_id, new.identifier, new.individual_id, new.site_id, new.encountered, new.age, new.details, new.created))
+        execute procedure validate_content_digest();
+
+create trigger validate_content_digest_set
+    before update on encounter
+    for each row
+    when (old.content_digest is distinct from new.content_digest
+      and (old.encounter_id, old.identifier, old.individual_id, old.site_id, old.encountered, old.age, old.details, old.created)
+          is not distinct from
+          (new.encounter_id, new.identifier, new.individual_id, new.site_id, new.encountered, new.age, new.details, new.created))
+        execute procedure validate_content_digest();
+
+create trigger validate_content_digest_changed
+    before update on individual
+    for each row
+    when (old.content_digest is not null
+      and old.content_digest is not distinct from new.content_digest
+      and (old.individual_id, old.identifier, old.sex, old.details, old.created)
+          is distinct from
+          (new.individual_id, new.identifier, new.sex, new.details, new.created))
+        execute procedure validate_content_digest();
+
+create trigger validate_content_digest_set
+    before update on individual
+    for each row
+    when (old.content_digest is distinct from new.content_digest
+      and (old.individual_id, old.identifier, old.sex, old.details, old.created)
+          is not distinct from
+          (new.individual_id, new.identifier, new.sex, new.details, new.created))
+        execute procedure validate_content_digest();
+
+create trigger validate_content_digest_changed
+    before update on sample
+    for each row
+    when (old.content_digest is not null
+      and old.content_digest is not distinct from new.content_digest
+      and (old.sample_id, old.identifier, old.collection_identifier, old.encounter_id, old.collected, old.details, old.access_role, old.created)
+          is distinct from
+          (new.sample_id, new.identifier, new.collection_identifier, new.encounter_id, new.collected, new.details, new.access_role, new.created))
+        execute procedure validate_content_digest();
+
+create trigger validate_content_digest_set
+    before update on sample
+    for each row
+    when (old.content_digest is distinct from new.content_digest
+      and (old.sample_id, old.identifier, old.collection_identifier, old.encounter_id, old.collected, old.details, old.access_role, old.created)
+          is not distinct from
+          (new.sample_id, new.identifier, new.collection_identifier, new.encounter_id, new.collected, new.details, new.access_role, new.created))
+        execute procedure validate_content_digest();
+
+create trigger validate_content_digest_changed
+    before update on presence_absence
+    for each row
+    when (old.content_digest is not null
+      and old.content_digest is not distinct from new.content_digest
+      and (old.presence_absence_id, old.identifier, old.sample_id, old.target_id, old.present, old.details, old.created)
+          is distinct from
+          (new.presence_absence_id, new.identifier, new.sample_id, new.target_id, new.present, new.details, new.created))
+        execute procedure validate_content_digest();
+
+create trigger validate_content_digest_set
+    before update on presence_absence
+    for each row
+    when (old.content_digest is distinct from new.content_digest
+      and (old.presence_absence_id, old.identifier, old.sample_id, old.target_id, old.present, old.details, old.created)
+          is not distinct from
+          (new.presence_absence_id, new.identifier, new.sample_id, new.target_id, new.present, new.details, new.created))
+        execute procedure validate_content_digest();
+
+commit;
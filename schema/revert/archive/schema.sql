@@ -0,0 +1,7 @@
+-- Revert seattleflu/schema:archive/schema from pg
+
+begin;
+
+drop schema archive;
+
+commit;
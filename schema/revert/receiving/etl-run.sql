@@ -0,0 +1,7 @@
+-- Revert seattleflu/schema:receiving/etl-run from pg
+
+begin;
+
+drop table receiving.etl_run;
+
+commit;
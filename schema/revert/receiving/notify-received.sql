@@ -0,0 +1,14 @@
+-- Revert seattleflu/schema:receiving/notify-received from pg
+
+begin;
+
+set local search_path to receiving;
+
+drop trigger notify_received on redcap_det;
+drop trigger notify_received on presence_absence;
+drop trigger notify_received on manifest;
+drop trigger notify_received on fhir;
+
+drop function notify_received();
+
+commit;
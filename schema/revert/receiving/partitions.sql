@@ -0,0 +1,103 @@
+-- Revert seattleflu/schema:receiving/partitions from pg
+
+-- Copies records back into unpartitioned tables.  Partitions already archived
+-- by `id3c receiving archive` are not restored.
+
+begin;
+
+set local search_path to receiving;
+
+do $$
+    declare
+        relation text;
+        id text;
+        new_table text;
+        item record;
+    begin
+        foreach relation in array array['fhir', 'manifest', 'presence_absence', 'redcap_det'] loop
+            id := relation || '_id';
+            new_table := relation || '_unpartitioned';
+
+            execute format($sql$
+                create table receiving.%1$I (
+                    %2$I integer primary key generated by default as identity,
+
+                    -- Using json not jsonb because we want to keep the exact text around for
+                    -- debugging purposes.
+                    document json not null
+                        constraint %3$I
+                            check (json_typeof(document) = 'object'),
+
+                    received timestamp with time zone not null default now(),
+
+                    processing_log jsonb not null default '[]'
+                        constraint %4$I
+                            check (jsonb_typeof(processing_log) = 'array')
+                )
+                $sql$, new_table, id, relation || '_document_is_object', relation || '_processing_log_is_array');
+
+            execute format('insert into receiving.%I (%I, document, received, processing_log) overriding system value select %I, document, received, processing_log from receiving.%I',
+                new_table, id, id, relation);
+
+            execute format('select setval(pg_get_serial_sequence(%L, %L), coalesce(max(%I), 0) + 1, false) from receiving.%I',
+                format('receiving.%I', new_table), id, id, new_table);
+
+            execute format('comment on table receiving.%I is %L',
+                new_table, obj_description(format('receiving.%I', relation)::regclass, 'pg_class'));
+
+            for item in
+                select attname as column_name, col_description(attrelid, attnum) as description
+                  from pg_attribute
+                 where attrelid = format('receiving.%I', relation)::regclass
+                   and attnum > 0
+                   and not attisdropped
+            loop
+                execute format('comment on column receiving.%I.%I is %L', new_table, item.column_name, item.description);
+            end loop;
+
+            for item in
+                select acl.privilege_type, acl.grantee
+                  from pg_class, aclexplode(relacl) as acl
+                 where pg_class.oid = format('receiving.%I', relation)::regclass
+                   and acl.grantee <> relowner
+            loop
+                execute format('grant %s on receiving.%I to %s',
+                    item.privilege_type, new_table,
+                    case when item.grantee = 0 then 'public' else item.grantee::regrole::text end);
+            end loop;
+
+            for item in
+                select attname as column_name, acl.privilege_type, acl.grantee
+                  from pg_attribute, aclexplode(attacl) as acl
+                 where attrelid = format('receiving.%I', relation)::regclass
+                   and attacl is not null
+            loop
+                execute format('grant %s (%I) on receiving.%I to %s',
+                    item.privilege_type, item.column_name, new_table,
+                    case when item.grantee = 0 then 'public' else item.grantee::regrole::text end);
+            end loop;
+
+            execute format('comment on column receiving.%I.%I is %L', new_table, id, 'Internal id of this record');
+
+            execute format('drop table receiving.%I', relation);
+
+            execute format('alter table receiving.%I rename to %I', new_table, relation);
+            execute format('alter index receiving.%I rename to %I', new_table || '_pkey', relation || '_pkey');
+            execute format('alter sequence receiving.%I rename to %I', new_table || '_' || id || '_seq', relation || '_' || id || '_seq');
+
+            execute format('create index %I on receiving.%I using gin (processing_log jsonb_path_ops)',
+                relation || '_processing_log_idx', relation);
+
+            execute format('create trigger enqueue_pending after insert on receiving.%I referencing new table as inserted for each statement execute procedure receiving.enqueue_pending()', relation);
+            execute format('create trigger dequeue_processed after update on receiving.%I referencing new table as updated for each statement execute procedure receiving.dequeue_processed()', relation);
+        end loop;
+    end
+$$;
+
+create index redcap_det_document_as_jsonb_idx
+  on redcap_det
+  using gin ((document::jsonb) jsonb_path_ops);
+
+drop function create_partitions(text, timestamp with time zone, timestamp with time zone);
+
+commit;
@@ -0,0 +1,24 @@
+-- Revert seattleflu/schema:receiving/processing-queue from pg
+
+begin;
+
+set local search_path to receiving;
+
+drop trigger dequeue_processed on redcap_det;
+drop trigger dequeue_processed on presence_absence;
+drop trigger dequeue_processed on manifest;
+drop trigger dequeue_processed on fhir;
+
+drop trigger enqueue_pending on redcap_det;
+drop trigger enqueue_pending on presence_absence;
+drop trigger enqueue_pending on manifest;
+drop trigger enqueue_pending on fhir;
+
+drop function register_etl(text, text, jsonb, jsonb);
+drop function dequeue_processed();
+drop function enqueue_pending();
+
+drop table pending;
+drop table etl;
+
+commit;
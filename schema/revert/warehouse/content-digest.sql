@@ -0,0 +1,23 @@
+-- Revert seattleflu/schema:warehouse/content-digest from pg
+
+begin;
+
+set local search_path to warehouse;
+
+drop trigger validate_content_digest_set on presence_absence;
+drop trigger validate_content_digest_changed on presence_absence;
+drop trigger validate_content_digest_set on sample;
+drop trigger validate_content_digest_changed on sample;
+drop trigger validate_content_digest_set on individual;
+drop trigger validate_content_digest_changed on individual;
+drop trigger validate_content_digest_set on encounter;
+drop trigger validate_content_digest_changed on encounter;
+
+drop function validate_content_digest();
+
+alter table presence_absence drop column content_digest;
+alter table sample           drop column content_digest;
+alter table individual       drop column content_digest;
+alter table encounter        drop column content_digest;
+
+commit;
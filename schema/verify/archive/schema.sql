@@ -0,0 +1,7 @@
+-- Verify seattleflu/schema:archive/schema on pg
+
+begin;
+
+select 1/pg_catalog.has_schema_privilege('archive', 'usage')::int;
+
+rollback;
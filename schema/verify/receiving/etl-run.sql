@@ -0,0 +1,9 @@
+-- Verify seattleflu/schema:receiving/etl-run on pg
+
+begin;
+
+select etl_run_id, routine, action, host, pid, started, finished, status, error, records, stages, peak_rss
+  from receiving.etl_run
+ where false;
+
+rollback;
@@ -0,0 +1,12 @@
+-- Verify seattleflu/schema:receiving/notify-received on pg
+
+begin;
+
+set local search_path to receiving;
+
+select 1/(count(*) = 4)::int
+  from pg_trigger
+ where tgname = 'notify_received'
+   and tgrelid in ('fhir'::regclass, 'manifest'::regclass, 'presence_absence'::regclass, 'redcap_det'::regclass);
+
+rollback;
@@ -0,0 +1,56 @@
+-- Verify seattleflu/schema:receiving/partitions on pg
+
+begin;
+
+set local search_path to receiving;
+
+select 1/(count(*) = 4)::int
+  from pg_partitioned_table
+ where partrelid in ('fhir'::regclass, 'manifest'::regclass, 'presence_absence'::regclass, 'redcap_det'::regclass);
+
+select 1/(to_regclass('fhir_default') is not null)::int;
+
+select pg_catalog.has_function_privilege('create_partitions(text, timestamp with time zone, timestamp with time zone)', 'execute');
+
+-- Record ids are unique across partitions only as long as nobody but the
+-- table owner can set them or move records between partitions.
+do $$
+    declare
+        relation text;
+        partition regclass;
+    begin
+        foreach relation in array array['fhir', 'manifest', 'presence_absence', 'redcap_det'] loop
+            assert not exists(
+                select from pg_roles
+                 where not rolsuper
+                   and rolname !~ '^pg_'
+                   and not pg_has_role(rolname, (select relowner from pg_class where oid = format('receiving.%I', relation)::regclass), 'member')
+                   and (has_column_privilege(rolname, format('receiving.%I', relation), relation || '_id', 'insert, update')
+                     or has_column_privilege(rolname, format('receiving.%I', relation), 'received', 'insert, update'))),
+                format('roles other than the owner of receiving.%I can set its record ids or received timestamps', relation);
+
+            assert not exists(
+                select from pg_roles
+                 where rolname !~ '^pg_'
+                   and has_column_privilege(rolname, format('receiving.%I', relation), 'document', 'insert')
+                   and not has_sequence_privilege(rolname, format('receiving.%I', relation || '_' || relation || '_id_seq'), 'usage')),
+                format('roles which can insert into receiving.%I can''t assign record ids', relation);
+
+            for partition in
+                select inhrelid::regclass
+                  from pg_inherits
+                 where inhparent = format('receiving.%I', relation)::regclass
+            loop
+                assert exists(
+                    select from pg_index
+                     where indrelid = partition
+                       and indisunique
+                       and indnkeyatts = 1
+                       and indkey[0] = (select attnum from pg_attribute where attrelid = partition and attname = relation || '_id')),
+                    format('partition %s has no unique index on its record id', partition);
+            end loop;
+        end loop;
+    end
+$$;
+
+rollback;
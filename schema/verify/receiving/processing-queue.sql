@@ -0,0 +1,44 @@
+-- Verify seattleflu/schema:receiving/processing-queue on pg
+
+begin;
+
+set local search_path to receiving;
+
+select etl_id, relation, name, log_entry, filter, registered from etl where false;
+select etl_id, record_id from pending where false;
+
+do $$
+    declare
+        queue integer;
+        record integer;
+    begin
+        queue := receiving.register_etl('fhir', 'verify', '{"etl": "verify", "revision": 1}');
+
+        insert into receiving.fhir (document)
+            values ('{"verify": true}')
+            returning fhir_id into strict record;
+
+        assert exists (select from receiving.pending where etl_id = queue and record_id = record),
+            'new record is pending';
+
+        assert queue = receiving.register_etl('fhir', 'verify', '{"etl": "verify", "revision": 1}'),
+            're-registering the same log entry keeps the queue';
+
+        assert receiving.register_etl('fhir', 'verify', '{"etl": "verify", "revision": 0}') is null,
+            'an older revision is not registered';
+
+        update receiving.fhir
+           set processing_log = processing_log || '[{"etl": "verify", "revision": 1, "status": "processed"}]'
+         where fhir_id = record;
+
+        assert not exists (select from receiving.pending where etl_id = queue and record_id = record),
+            'processed record is no longer pending';
+
+        perform receiving.register_etl('fhir', 'verify', '{"etl": "verify", "revision": 2}');
+
+        assert exists (select from receiving.pending where etl_id = queue and record_id = record),
+            'record is pending again for a new revision';
+    end
+$$;
+
+rollback;
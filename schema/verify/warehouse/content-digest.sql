@@ -0,0 +1,67 @@
+-- Verify seattleflu/schema:warehouse/content-digest on pg
+
+begin;
+
+set local search_path to warehouse;
+
+select content_digest from encounter where false;
+select content_digest from individual where false;
+select content_digest from sample where false;
+select content_digest from presence_absence where false;
+
+select 1/(count(*) = 8)::int
+  from pg_trigger
+ where tgname in ('validate_content_digest_changed', 'validate_content_digest_set')
+   and tgrelid in ('encounter'::regclass, 'individual'::regclass, 'sample'::regclass, 'presence_absence'::regclass);
+
+do $$
+    declare
+        digest bytea;
+        modified_before timestamp with time zone;
+        modified_after timestamp with time zone;
+    begin
+        create temporary table tests (
+            a text,
+            content_digest bytea,
+            modified timestamp with time zone
+        );
+
+        create trigger validate_content_digest_changed
+            before update on tests
+            for each row
+            when (old.content_digest is not null
+              and old.content_digest is not distinct from new.content_digest
+              and (old.a) is distinct from (new.a))
+                execute procedure warehouse.validate_content_digest();
+
+        create trigger validate_content_digest_set
+            before update on tests
+            for each row
+            when (old.content_digest is distinct from new.content_digest
+              and (old.a) is not distinct from (new.a))
+                execute procedure warehouse.validate_content_digest();
+
+        insert into tests values ('test', '\x01', now() - interval '1 hour')
+            returning modified into strict modified_before;
+
+        -- Setting only the digest keeps the modified timestamp
+        update tests set content_digest = '\x02', modified = now()
+            returning modified into strict modified_after;
+
+        assert modified_after = modified_before;
+
+        -- Setting the digest along with a change keeps both
+        update tests set a = 'set', content_digest = '\x03'
+            returning content_digest into strict digest;
+
+        assert digest = '\x03';
+
+        -- Changing the row without setting the digest clears it
+        update tests set a = 'changed'
+            returning content_digest into strict digest;
+
+        assert digest is null;
+    end
+$$;
+
+rollback;
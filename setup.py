@@ -88,6 +88,9 @@ setup(
     ],
 
     extras_require = {
+        "async": [
+            "psycopg >=3.1",
+        ],
         "dev": [
             "mypy",
             "pylint",
@@ -97,5 +100,8 @@ setup(
             "types-PyYAML",
             "types-requests",
         ],
+        "zstd": [
+            "zstandard",
+        ],
     },
 )
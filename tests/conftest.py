@@ -0,0 +1,52 @@
+import os
+import pytest
+from psycopg2.extensions import parse_dsn
+from id3c.db.session import DatabaseSession
+
+
+@pytest.fixture
+def test_dsn(monkeypatch):
+    """
+    Connection string of a scratch database with the ID3C schema deployed,
+    from the ``ID3C_TEST_DSN`` environment variable.  Tests which use it are
+    skipped if it isn't set.
+
+    Tests may commit changes to the database, so never point it at a database
+    whose data matters.
+
+    The standard libpq environment variables are set to match, so that
+    sessions the code under test opens itself connect to the same database.
+    """
+    dsn = os.environ.get("ID3C_TEST_DSN")
+
+    if not dsn:
+        pytest.skip("ID3C_TEST_DSN isn't set to a scratch database with the ID3C schema deployed")
+
+    for param, value in parse_dsn(dsn).items():
+        variable = {
+            "host": "PGHOST",
+            "port": "PGPORT",
+            "dbname": "PGDATABASE",
+            "user": "PGUSER",
+            "password": "PGPASSWORD",
+        }.get(param)
+
+        if variable:
+            monkeypatch.setenv(variable, value)
+
+    return dsn
+
+
+@pytest.fixture
+def db(test_dsn):
+    """
+    A session connected to the ``ID3C_TEST_DSN`` database, whose changes are
+    rolled back after the test unless it commits them.
+    """
+    session = DatabaseSession(dsn = test_dsn)
+
+    try:
+        yield session
+    finally:
+        session.rollback()
+        session.close()
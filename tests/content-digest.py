@@ -0,0 +1,34 @@
+import pytest
+import re
+
+
+@pytest.mark.parametrize("table", ["encounter", "individual", "sample", "presence_absence"])
+def test_trigger_columns(db, table):
+    """
+    The when clauses of the content digest triggers must compare every column
+    of their table except content_digest and modified, or changes to the
+    columns they miss would keep a stale digest.
+    """
+    columns = {
+        row.column_name
+            for row in db.fetch_all("""
+                select column_name
+                  from information_schema.columns
+                 where table_schema = 'warehouse'
+                   and table_name = %s
+                """, (table,)) }
+
+    assert {"content_digest", "modified"} <= columns
+
+    for trigger in ["validate_content_digest_changed", "validate_content_digest_set"]:
+        definition = db.fetch_row("""
+            select pg_get_triggerdef(oid) as definition
+              from pg_trigger
+             where tgrelid = %s::regclass
+               and tgname = %s
+            """, (f"warehouse.{table}", trigger)).definition
+
+        compared = set(re.findall(r'\bold\.(\w+)', definition, re.IGNORECASE)) - {"content_digest"}
+
+        assert compared == columns - {"content_digest", "modified"}, \
+            f"{trigger} on {table} doesn't compare the columns {sorted(columns - compared - {'content_digest', 'modified'})}"
@@ -0,0 +1,186 @@
+import pytest
+from psycopg2 import OperationalError
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, TRANSACTION_STATUS_INTRANS
+from unittest.mock import MagicMock
+import id3c.db.pool as pool
+from id3c.db.pool import CredentialsVerifier, DatabaseSessionPool, PoolTimeoutError, RoleSwitchingSessionPool
+
+
+@pytest.fixture
+def sessions(monkeypatch):
+    """
+    Replaces the sessions created by the pool with fakes, which fail to log
+    in with the password "wrong", and returns the list of them.
+    """
+    sessions = []
+
+    def connect(*, username = None, password = None):
+        if password == "wrong":
+            raise OperationalError(f"password authentication failed for user \"{username}\"")
+
+        session = MagicMock()
+        session.username = username
+        session.connection.closed = 0
+        session.connection.notices = []
+        session.connection.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+
+        sessions.append(session)
+        return session
+
+    monkeypatch.setattr(pool, "DatabaseSession", connect)
+
+    return sessions
+
+
+def test_reuse_by_credentials(sessions):
+    """
+    Released sessions are reused only for the credentials they were created
+    with, after rolling back whatever their last user left open.
+    """
+    db_pool = DatabaseSessionPool()
+
+    with db_pool.session("alice", "s3cret") as alice:
+        alice.connection.get_transaction_status.return_value = TRANSACTION_STATUS_INTRANS
+
+    alice.rollback.assert_called_once_with()
+    alice.connection.get_transaction_status.return_value = TRANSACTION_STATUS_IDLE
+
+    with db_pool.session("alice", "other") as other:
+        assert other is not alice
+
+    with db_pool.session("bob", "s3cret") as bob:
+        assert bob is not alice
+
+    with db_pool.session("alice", "s3cret") as again:
+        assert again is alice
+
+    assert [ session.username for session in sessions ] == ["alice", "alice", "bob"]
+
+    stats = db_pool.stats()
+
+    assert (stats["size"], stats["idle"], stats["checked_out"]) == (3, 3, 0)
+    assert (stats["created"], stats["reused"]) == (3, 1)
+
+
+def test_unhealthy_sessions_discarded(sessions):
+    db_pool = DatabaseSessionPool(ping_after = 0)
+
+    with db_pool.session("alice", "s3cret") as first:
+        pass
+
+    # The server went away while the session was idle.
+    first.cursor.return_value.__enter__.return_value.execute.side_effect = OperationalError("server closed the connection unexpectedly")
+
+    with db_pool.session("alice", "s3cret") as second:
+        assert second is not first
+
+    first.close.assert_called_once_with()
+
+    stats = db_pool.stats()
+
+    assert (stats["size"], stats["failed_health_checks"], stats["discarded"]) == (1, 1, 1)
+
+
+def test_limits(sessions):
+    """
+    The pool keeps at most *max_idle* sessions per credentials and opens at
+    most *max_size* in all, evicting idle sessions of other credentials to
+    make room before giving up.
+    """
+    db_pool = DatabaseSessionPool(max_size = 2, max_idle = 1, checkout_timeout = 0)
+
+    first = db_pool.checkout("alice", "s3cret")
+    second = db_pool.checkout("alice", "s3cret")
+
+    with pytest.raises(PoolTimeoutError):
+        db_pool.checkout("bob", "s3cret")
+
+    db_pool.release(first)
+    db_pool.release(second)
+
+    second.close.assert_called_once_with()
+    first.close.assert_not_called()
+
+    bob = db_pool.checkout("bob", "s3cret")
+    db_pool.checkout("bob", "s3cret")
+
+    first.close.assert_called_once_with()
+    assert bob.username == "bob"
+
+    stats = db_pool.stats()
+
+    assert (stats["size"], stats["checked_out"], stats["evicted"], stats["timeouts"]) == (2, 2, 1, 1)
+
+
+def test_failed_login_frees_room(sessions):
+    db_pool = DatabaseSessionPool(max_size = 1, checkout_timeout = 0)
+
+    with pytest.raises(OperationalError):
+        db_pool.checkout("alice", "wrong")
+
+    with db_pool.session("alice", "s3cret"):
+        assert db_pool.stats()["size"] == 1
+
+
+def test_verifier(sessions, monkeypatch):
+    """
+    Credentials are verified by logging in once, and then by their cached
+    hash until it expires or doesn't match.
+    """
+    now = 1000.0
+    monkeypatch.setattr(pool, "monotonic", lambda: now)
+
+    verifier = CredentialsVerifier(ttl = 60)
+
+    verifier.verify("alice", "s3cret")
+    verifier.verify("alice", "s3cret")
+
+    assert len(sessions) == 1
+    sessions[0].connection.close.assert_called_once_with()
+
+    # A wrong password isn't accepted from the cache, nor cached.
+    with pytest.raises(OperationalError):
+        verifier.verify("alice", "wrong")
+
+    verifier.verify("alice", "s3cret")
+    assert len(sessions) == 1
+
+    now += 61
+    verifier.verify("alice", "s3cret")
+    assert len(sessions) == 2
+
+    verifier.forget("alice")
+    verifier.verify("alice", "s3cret")
+    assert len(sessions) == 3
+
+
+def test_role_switching(sessions):
+    """
+    Users share the service user's sessions, each switched to the user's role
+    while checked out.
+    """
+    db_pool = RoleSwitchingSessionPool(max_size = 1)
+
+    with pytest.raises(OperationalError):
+        db_pool.checkout("alice", "wrong")
+
+    with db_pool.session("alice", "s3cret") as alice:
+        alice.set_role.assert_called_once_with("alice")
+
+    alice.reset_role.assert_called_once_with()
+
+    with db_pool.session("bob", "s3cret") as bob:
+        assert bob is alice
+        bob.set_role.assert_called_with("bob")
+
+    # Logins to verify alice and bob, and one service user session.
+    assert [ session.username for session in sessions ] == ["alice", None, "bob"]
+
+    # Switching to a role the service user isn't a member of releases the
+    # session.
+    alice.set_role.side_effect = OperationalError("permission denied to set role \"carol\"")
+
+    with pytest.raises(OperationalError):
+        db_pool.checkout("carol", "s3cret")
+
+    assert db_pool.stats()["checked_out"] == 0
@@ -0,0 +1,97 @@
+from id3c.db.datatypes import Json
+
+
+def create_table(db):
+    with db.cursor() as cursor:
+        cursor.execute("""
+            create temporary table upserted (
+                upserted_id integer primary key generated always as identity,
+                identifier text not null unique,
+                value integer,
+                details jsonb,
+                content_digest bytea
+            )
+            """)
+
+        cursor.execute("""
+            insert into upserted (identifier, value, details, content_digest)
+                values ('a', 1, '{"x": 1}', '\\x0a'),
+                       ('b', 2, '{}', '\\x0b')
+            """)
+
+
+def test_execute_many(db):
+    create_table(db)
+
+    db.execute_many("update upserted set value = %s where identifier = %s",
+        [ (10, "a"), (20, "b"), (30, "c") ],
+        page_size = 2)
+
+    assert db.fetch_all("select identifier, value from upserted order by identifier") \
+        == [ ("a", 10), ("b", 20) ]
+
+
+def test_fetch_values(db):
+    create_table(db)
+
+    rows = db.fetch_values("insert into upserted (identifier, value) values %s returning identifier, value",
+        [ ("c", 3), ("d", 4), ("e", 5) ],
+        page_size = 2)
+
+    assert [ (row.identifier, row.value) for row in rows ] == [ ("c", 3), ("d", 4), ("e", 5) ]
+
+
+def test_upsert_unnest(db):
+    create_table(db)
+
+    columns = {"identifier": "text", "value": "integer"}
+
+    rows = db.upsert_unnest(("pg_temp", "upserted"), columns,
+        [ {"identifier": "c", "value": 3},
+          {"identifier": "b", "value": 2},
+          {"identifier": "a", "value": 10} ],
+        conflict  = ["identifier"],
+        returning = ["upserted_id", "identifier", "value"],
+        previous  = ["value"],
+        page_size = 2)
+
+    # Results are in the order of the input rows, across pages.
+    assert [ (row.identifier, row.value, row.previous_value, row.status) for row in rows ] == [
+        ("c", 3, None, "created"),
+        ("b", 2, 2, "unchanged"),
+        ("a", 10, 1, "updated"),
+    ]
+
+    assert rows[1].upserted_id == db.fetch_row("select upserted_id from upserted where identifier = 'b'").upserted_id
+
+
+def test_upsert_unnest_merge_and_digest(db):
+    create_table(db)
+
+    columns = {"identifier": "text", "value": "integer", "details": "jsonb", "content_digest": "bytea"}
+
+    rows = db.upsert_unnest(("pg_temp", "upserted"), columns,
+        [ {"identifier": "a", "value": 1, "details": Json({"y": 2}), "content_digest": b"\x0a"},
+          {"identifier": "b", "value": 2, "details": None, "content_digest": b"\x0c"} ],
+        conflict  = ["identifier"],
+        merge     = ["details"],
+        digest    = "content_digest",
+        returning = ["identifier"])
+
+    # "a" has the same digest, so isn't updated despite its new details.  "b"
+    # gets its new digest, but nothing else changed.
+    assert [ (row.identifier, row.status) for row in rows ] == [ ("a", "unchanged"), ("b", "unchanged") ]
+
+    assert db.fetch_all("select identifier, details, encode(content_digest, 'hex') from upserted order by identifier") \
+        == [ ("a", {"x": 1}, "0a"), ("b", {}, "0c") ]
+
+    rows = db.upsert_unnest(("pg_temp", "upserted"), columns,
+        [ {"identifier": "a", "value": 1, "details": Json({"y": 2}), "content_digest": b"\x1a"},
+          {"identifier": "b", "value": 3, "details": None, "content_digest": b"\x1b"} ],
+        conflict  = ["identifier"],
+        merge     = ["details"],
+        digest    = "content_digest",
+        returning = ["identifier", "details"])
+
+    assert [ (row.identifier, row.details, row.status) for row in rows ] \
+        == [ ("a", {"x": 1, "y": 2}, "updated"), ("b", {}, "updated") ]
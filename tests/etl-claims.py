@@ -0,0 +1,225 @@
+import json
+import pytest
+from uuid import uuid4
+from id3c.cli.command import DatabaseSessionAction
+import id3c.cli.command.etl as etl
+from id3c.cli.command.etl import process_receiving_records, receiving_records
+from id3c.db.datatypes import Json
+from id3c.db.session import DatabaseSession
+
+
+@pytest.fixture
+def dets(db):
+    """
+    Commits DETs for a few REDCap records, each marked with the same new
+    project id so that only this test's DETs are processed, and returns the
+    filter which selects them and their (id, record) pairs in order of id.
+    """
+    contains = {"project_id": uuid4().hex}
+
+    records = ["a", "b", "a", "c", "a", "b", "d", "a", "c", "e"]
+
+    rows = db.fetch_values("insert into receiving.redcap_det (document) values %s returning redcap_det_id as id, document->>'record' as record",
+        [ (Json({**contains, "record": record}),) for record in records ])
+
+    db.commit()
+
+    return contains, [ (row.id, row.record) for row in rows ]
+
+
+def test_skip_locked(test_dsn, dets):
+    contains, expected = dets
+    log_entry = {"etl": "test-skip-locked", "revision": 1}
+
+    first = DatabaseSession(dsn = test_dsn)
+    second = DatabaseSession(dsn = test_dsn)
+
+    try:
+        claimed = [ record.id for record in receiving_records(first, "redcap_det", log_entry, contains = contains, limit = 4, skip_locked = True) ]
+
+        # The second session skips the first's claim instead of waiting for it.
+        skipped = [ record.id for record in receiving_records(second, "redcap_det", log_entry, contains = contains, skip_locked = True) ]
+
+        assert claimed == [ id for id, _ in expected[:4] ]
+        assert skipped == [ id for id, _ in expected[4:] ]
+
+        # Claims are released when the first session's transaction ends.
+        first.rollback()
+        second.rollback()
+
+        assert [ record.id for record in receiving_records(second, "redcap_det", log_entry, contains = contains, skip_locked = True) ] \
+            == [ id for id, _ in expected ]
+
+    finally:
+        first.close()
+        second.close()
+
+
+def record_batches(log_entry, fail_at = None):
+    """
+    Returns a *process* function for :func:`process_receiving_records` which
+    marks records processed with *log_entry* and the ids of the batch they
+    were processed in, as workers run in other processes.  It fails when it
+    gets to the record with id *fail_at*.
+    """
+    def process(db, records):
+        records = list(records)
+        batch = [ record.id for record in records ]
+
+        assert batch == sorted(batch)
+
+        if fail_at in batch:
+            raise Exception(f"Failing at record {fail_at}")
+
+        db.execute_many("""
+            update receiving.redcap_det
+               set processing_log = processing_log || %s
+             where redcap_det_id = %s
+            """, [ (Json([{**log_entry, "batch": batch}]), record.id) for record in records ])
+
+    return process
+
+
+def processed_batches(db, contains, expected, grouped = True):
+    """
+    Returns the batch each of the *expected* DETs was processed in by
+    :func:`record_batches`, keyed by REDCap record, after checking that each
+    was processed exactly once and, if *grouped*, with the other DETs of its
+    record.
+    """
+    rows = db.fetch_all("""
+        select redcap_det_id as id,
+               document->>'record' as record,
+               processing_log
+          from receiving.redcap_det
+         where document::jsonb @> %s
+         order by redcap_det_id
+        """, (Json(contains),))
+
+    assert [ (row.id, row.record) for row in rows ] == expected
+
+    batches = {}
+
+    for row in rows:
+        assert len(row.processing_log) == 1, f"DET {row.id} was processed {len(row.processing_log)} times"
+
+        batch = row.processing_log[0]["batch"]
+
+        assert row.id in batch
+
+        if grouped:
+            assert batches.setdefault(row.record, batch) == batch, \
+                f"DETs of record {row.record} were processed in different batches"
+
+    return batches
+
+
+@pytest.mark.parametrize("workers", [None, 2])
+def test_claims_complete_groups(db, dets, workers):
+    """
+    With *ordered_by*, each claim includes all pending DETs of its REDCap
+    records, so a batch never holds only some of a record's DETs.
+    """
+    contains, expected = dets
+    log_entry = {"etl": f"test-claims-{uuid4().hex}", "revision": 1}
+
+    # Without workers, batches are committed periodically instead.
+    if not workers:
+        db.commit_every = 2
+
+    process_receiving_records(db, DatabaseSessionAction.COMMIT, record_batches(log_entry), "redcap_det", log_entry,
+        workers     = workers,
+        claim_size  = 2,
+        ordered_by  = "document->>'record'",
+        contains    = contains)
+
+    batches = processed_batches(db, contains, expected)
+
+    # Records were still claimed a few at a time.
+    assert len({ tuple(batch) for batch in batches.values() }) > 1
+
+
+def test_backfill_completes_groups(db, dets):
+    """
+    A backfill with *ordered_by* processes a record's DETs in later ranges
+    along with those in the first.
+    """
+    contains, expected = dets
+    log_entry = {"etl": f"test-backfill-{uuid4().hex}", "revision": 1}
+
+    process_receiving_records(db, DatabaseSessionAction.COMMIT, record_batches(log_entry), "redcap_det", log_entry,
+        workers     = 2,
+        claim_size  = 2,
+        ordered_by  = "document->>'record'",
+        contains    = contains,
+        backfill    = "",
+        range_size  = 3)
+
+    processed_batches(db, contains, expected)
+
+
+def test_backfill_checkpoint(db, dets, tmp_path):
+    """
+    A failed backfill resumed from its checkpoint skips the ranges already
+    committed and processes the rest.
+    """
+    contains, expected = dets
+    log_entry = {"etl": f"test-backfill-{uuid4().hex}", "revision": 1}
+    checkpoint = str(tmp_path / "checkpoint.json")
+
+    def backfill(process):
+        process_receiving_records(db, DatabaseSessionAction.COMMIT, process, "redcap_det", log_entry,
+            workers     = 1,
+            claim_size  = 2,
+            contains    = contains,
+            backfill    = checkpoint,
+            range_size  = 3)
+
+    # A single worker takes ranges in order of id, so stops at the one with
+    # the failing record, after committing those before it.
+    fail_at = expected[5][0]
+
+    with pytest.raises(Exception, match = "workers failed"):
+        backfill(record_batches(log_entry, fail_at = fail_at))
+
+    committed = [ id for id, _ in expected if id < fail_at - fail_at % 3 ]
+
+    assert committed
+    with open(checkpoint, encoding = "utf-8") as file:
+        assert json.load(file)["rows"] == len(committed)
+
+    # Ranges already committed aren't processed again, or the DETs in them
+    # would be processed twice.
+    backfill(record_batches(log_entry))
+
+    processed_batches(db, contains, expected, grouped = False)
+
+
+def test_registered_once(db, dets, monkeypatch):
+    """
+    A routine run again, as by ``id3c etl run --follow``, finds its queue
+    instead of registering again.
+    """
+    contains, expected = dets
+    log_entry = {"etl": f"test-register-{uuid4().hex}", "revision": 1}
+
+    registered = []
+    register_etl = etl.register_etl
+
+    def register(*args):
+        registered.append(args)
+        return register_etl(*args)
+
+    monkeypatch.setattr(etl, "register_etl", register)
+
+    for _ in range(2):
+        process_receiving_records(db, DatabaseSessionAction.COMMIT, record_batches(log_entry), "redcap_det", log_entry,
+            workers     = None,
+            claim_size  = 2,
+            contains    = contains)
+
+        db.commit()
+
+    assert len(registered) == 1
+
+    processed_batches(db, contains, expected, grouped = False)
@@ -0,0 +1,211 @@
+import pytest
+from collections import namedtuple
+from copy import deepcopy
+from unittest.mock import MagicMock
+import id3c.cli.command.etl.fhir as fhir
+from id3c.cli.command.etl import fhir_fast
+
+
+SYSTEM = fhir.INTERNAL_SYSTEM
+
+Row = namedtuple("Row", "id hierarchy")
+Identifier = namedtuple("Identifier", "uuid set_name")
+
+#: Identifier sets of the barcodes in :data:`BUNDLES`.
+BARCODES = {
+    "aaaaaaaa": Identifier("a0000000-0000-4000-8000-000000000000", "collections-kiosks"),
+    "bbbbbbbb": Identifier("b0000000-0000-4000-8000-000000000000", "samples"),
+}
+
+#: Bundles like those our FHIR ETL receives: a household of two encounters,
+#: with their specimens, locations, questionnaire responses and immunization,
+#: and test results of specimens from earlier bundles.
+BUNDLES = {
+    "encounters": {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [
+            { "fullUrl": "urn:uuid:patient", "resource": {
+                "resourceType": "Patient",
+                "identifier": [{ "system": f"{SYSTEM}/individual", "value": "0123456789abcdef" }],
+                "gender": "female",
+                "communication": [
+                    { "language": { "coding": [{ "system": fhir.LANGUAGE_SYSTEM, "code": "es" }] }, "preferred": True },
+                    { "language": { "coding": [{ "system": fhir.LANGUAGE_SYSTEM, "code": "en" }] }, "preferred": False },
+                ],
+            }},
+            { "fullUrl": "urn:uuid:household", "resource": {
+                "resourceType": "Encounter",
+                "meta": { "source": "data:application/json,%7B%22project%22%3A%22test%22%7D" },
+                "identifier": [{ "system": f"{SYSTEM}/encounter", "value": "household-encounter" }],
+                "status": "finished",
+                "class": { "system": "http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "HH" },
+                "subject": { "reference": "urn:uuid:patient", "type": "Patient" },
+                "period": { "start": "2020-01-01T10:00:00-08:00" },
+                "reasonCode": [{ "coding": [{ "system": fhir.SNOMED_SYSTEM, "code": "95891005", "display": "Influenza-like illness" }] }],
+                "location": [
+                    { "location": { "type": "Location", "identifier": { "system": f"{SYSTEM}/site", "value": "HomeTest" } } },
+                    { "location": { "reference": "#residence", "type": "Location" } },
+                ],
+                "contained": [
+                    { "resourceType": "Location", "id": "residence",
+                      "identifier": [{ "system": f"{SYSTEM}/location/address", "value": "household-0123" }],
+                      "type": [{ "coding": [{ "system": fhir.LOCATION_RELATION_SYSTEM, "code": "PTRES" }] }],
+                      "partOf": { "reference": "urn:uuid:tract", "type": "Location" } },
+                ],
+            }},
+            { "fullUrl": "urn:uuid:encounter", "resource": {
+                "resourceType": "Encounter",
+                "identifier": [{ "system": f"{SYSTEM}/encounter", "value": "member-encounter" }],
+                "status": "finished",
+                "class": { "system": "http://terminology.hl7.org/CodeSystem/v3-ActCode", "code": "HH" },
+                "subject": { "reference": "urn:uuid:patient", "type": "Patient" },
+                "partOf": { "reference": "urn:uuid:household", "type": "Encounter" },
+                "period": { "start": "2020-01-02" },
+                "location": [
+                    { "location": { "type": "Location", "identifier": { "system": f"{SYSTEM}/site", "value": "HomeTest" } } },
+                    { "location": { "reference": "urn:uuid:tract", "type": "Location" } },
+                ],
+            }},
+            { "fullUrl": "urn:uuid:tract", "resource": {
+                "resourceType": "Location",
+                "identifier": [{ "system": f"{SYSTEM}/location/tract", "value": "53033000100" }],
+                "type": [{ "coding": [{ "system": fhir.LOCATION_RELATION_SYSTEM, "code": "WORK" }] }],
+            }},
+            { "fullUrl": "urn:uuid:specimen", "resource": {
+                "resourceType": "Specimen",
+                "identifier": [{ "system": f"{SYSTEM}/sample", "value": "aaaaaaaa " }],
+                "subject": { "reference": "urn:uuid:patient", "type": "Patient" },
+                "type": { "coding": [{ "system": fhir.SNOMED_SYSTEM, "code": "258500001", "display": "Nasopharyngeal swab" }] },
+                "collection": { "collectedDateTime": "2020-01-01" },
+                "note": [{ "text": "Swabbed at home" }],
+            }},
+            { "fullUrl": "urn:uuid:observation", "resource": {
+                "resourceType": "Observation",
+                "status": "final",
+                "code": { "coding": [{ "system": "http://loinc.org", "code": "85478-6" }] },
+                "subject": { "reference": "urn:uuid:patient", "type": "Patient" },
+                "encounter": { "reference": "urn:uuid:encounter", "type": "Encounter" },
+                "specimen": { "reference": "urn:uuid:specimen", "type": "Specimen" },
+            }},
+            { "fullUrl": "urn:uuid:questionnaire-response", "resource": {
+                "resourceType": "QuestionnaireResponse",
+                "status": "completed",
+                "subject": { "reference": "urn:uuid:patient", "type": "Patient" },
+                "encounter": { "reference": "urn:uuid:encounter", "type": "Encounter" },
+                "item": [
+                    { "linkId": "age", "answer": [{ "valueInteger": 3 }] },
+                    { "linkId": "age_months", "answer": [{ "valueInteger": 42 }] },
+                    { "linkId": "symptoms", "answer": [{ "valueCoding": { "code": "cough" } }] },
+                ],
+            }},
+            { "fullUrl": "urn:uuid:immunization", "resource": {
+                "resourceType": "Immunization",
+                "status": "completed",
+                "vaccineCode": { "coding": [{ "system": "http://hl7.org/fhir/sid/cvx", "code": "88" }] },
+                "patient": { "reference": "urn:uuid:patient", "type": "Patient" },
+                "occurrenceDateTime": "2019-10-01",
+            }},
+        ],
+    },
+
+    "results": {
+        "resourceType": "Bundle",
+        "type": "collection",
+        "entry": [
+            { "fullUrl": "urn:uuid:specimen", "resource": {
+                "resourceType": "Specimen",
+                "identifier": [{ "system": f"{SYSTEM}/sample", "value": "aaaaaaaa" }],
+            }},
+            { "fullUrl": "urn:uuid:report", "resource": {
+                "resourceType": "DiagnosticReport",
+                "status": "final",
+                "code": { "coding": [{ "system": "http://loinc.org", "code": "85477-8" }] },
+                "effectiveDateTime": "2020-01-03T12:00:00Z",
+                "specimen": [
+                    { "reference": "urn:uuid:specimen", "type": "Specimen" },
+                    { "type": "Specimen", "identifier": { "system": f"{SYSTEM}", "value": "bbbbbbbb" } },
+                    { "type": "Specimen", "identifier": { "system": f"{SYSTEM}", "value": "cccccccc" } },
+                ],
+                "result": [
+                    { "reference": "urn:uuid:present", "type": "Observation" },
+                    { "reference": "urn:uuid:absent", "type": "Observation" },
+                    { "reference": "urn:uuid:inconclusive", "type": "Observation" },
+                ],
+            }},
+            { "fullUrl": "urn:uuid:present", "resource": {
+                "resourceType": "Observation",
+                "status": "final",
+                "code": { "coding": [{ "system": fhir.SNOMED_SYSTEM, "code": "181000124108" }] },
+                "valueBoolean": True,
+                "device": { "identifier": { "system": "https://seattleflu.org/device", "value": "Ellume" } },
+            }},
+            { "fullUrl": "urn:uuid:absent", "resource": {
+                "resourceType": "Observation",
+                "status": "final",
+                "code": { "coding": [{ "system": fhir.SNOMED_SYSTEM, "code": "840539006" }] },
+                "valueCodeableConcept": { "coding": [{ "system": fhir.SNOMED_SYSTEM, "code": "260385009" }] },
+                "device": { "identifier": { "system": "https://seattleflu.org/device", "value": "Cepheid" } },
+            }},
+            { "fullUrl": "urn:uuid:inconclusive", "resource": {
+                "resourceType": "Observation",
+                "status": "final",
+                "code": { "coding": [{ "system": fhir.SNOMED_SYSTEM, "code": "911000124104" }] },
+                "device": { "identifier": { "system": "https://seattleflu.org/device", "value": "Cepheid" } },
+            }},
+        ],
+    },
+}
+
+
+def record_calls(monkeypatch):
+    """
+    Replaces the database functions used by the FHIR ETL's transforms with
+    fakes, and returns the list of calls made to them.
+    """
+    calls = []
+
+    def fake(name, result):
+        def call(db, *args, **kwargs):
+            calls.append((name, args, kwargs))
+            return result(*args, **kwargs) if callable(result) else result
+
+        monkeypatch.setattr(fhir, name, call)
+
+    for name in ["find_or_create_site", "find_or_create_target", "upsert_individual",
+                 "upsert_encounter", "upsert_location", "upsert_encounter_location",
+                 "upsert_presence_absence", "upsert_sample"]:
+        fake(name, lambda *args, **kwargs: Row(len(calls), None))
+
+    fake("find_identifier", lambda barcode: BARCODES.get(barcode))
+    fake("find_location", lambda scale, identifier: Row(1, f"tract => {identifier}"))
+    fake("find_sample", lambda uuid: Row(2, None))
+
+    return calls
+
+
+@pytest.mark.parametrize("name", BUNDLES)
+def test_fast_decode_matches_models(monkeypatch, name):
+    """
+    The ETL's transforms do the same with bundles decoded by the fast path as
+    with the full FHIR models.
+    """
+    def transform(strict):
+        calls = record_calls(monkeypatch)
+        document = deepcopy(BUNDLES[name])
+
+        fhir.assert_bundle_collection(document)
+        bundle = fhir.decode_bundle(document, strict)
+
+        assert isinstance(bundle, fhir_fast.ElementView) is not strict
+
+        index = fhir.BundleIndex(bundle)
+        fhir.assert_required_resource_types_present(index.by_type)
+        fhir.process_bundle_entries(MagicMock(), index)
+
+        return calls
+
+    fast = transform(strict = False)
+
+    assert fast
+    assert fast == transform(strict = True)
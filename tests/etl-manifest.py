@@ -0,0 +1,116 @@
+from uuid import uuid4
+from id3c.db import mint_identifiers
+from id3c.db.datatypes import Json
+from id3c.cli.command.etl.manifest import load_manifest_batch, process_manifest_records_serially
+
+
+def test_bulk_matches_serial(db):
+    """
+    Loading manifest records in bulk must leave the same samples and
+    processing log entries as processing them one at a time.
+    """
+    def universe():
+        """
+        Mints identifiers in new sample and collection sets and returns the
+        sets' names and barcodes, so that both ways of loading see the same
+        manifests with different barcodes.
+        """
+        suffix = uuid4().hex
+
+        with db.cursor() as cursor:
+            for use in ["sample", "collection"]:
+                cursor.execute("insert into warehouse.identifier_set (name, use) values (%s, %s)", (f"{use}s-{suffix}", use))
+
+        samples = [ row.barcode for row in mint_identifiers(db, f"samples-{suffix}", 8) ]
+        collections = [ row.barcode for row in mint_identifiers(db, f"collections-{suffix}", 8) ]
+
+        return f"samples-{suffix}", f"collections-{suffix}", samples, collections
+
+    serial = universe()
+    bulk = universe()
+
+    expected_identifier_sets = {
+        "samples": { serial[0], bulk[0] },
+        "collections": { serial[1], bulk[1] },
+        "rdt": set(),
+    }
+
+    def documents(samples, collections, round):
+        """
+        Manifest documents covering the cases the bulk load handles
+        differently: new, updated and unchanged samples, records which skip
+        or match the same sample, and records without identifiers.
+        """
+        if round == 1:
+            return [
+                { "sample": samples[0], "collection": collections[0], "date": "2020-01-01", "aliquot": "a" },
+                { "sample": samples[1], "date": "2020-01-02" },
+                { "collection": collections[2], "date": "2020-01-03" },
+                { "sample": samples[3], "collection": collections[3] },
+                { "sample": samples[3], "collection": collections[3], "aliquot": "b" },
+                { "sample": "unknown0", "collection": collections[4] },
+                { "date": "2020-01-04" },
+                { "sample": samples[5], "collection": collections[5], "date": "2020-01-05" },
+            ]
+        else:
+            return [
+                # Unchanged
+                { "sample": samples[0], "collection": collections[0], "date": "2020-01-01", "aliquot": "a" },
+                # Updated details and date
+                { "sample": samples[1], "date": "2020-02-02", "aliquot": "c" },
+                # Collection barcode now with its sample barcode
+                { "sample": samples[2], "collection": collections[2], "date": "2020-01-03" },
+                # Identifiers not updated without both keys
+                { "sample": samples[5], "date": "2020-01-05" },
+                # New
+                { "sample": samples[6], "collection": collections[6] },
+            ]
+
+    def load(universe, round, process):
+        _, _, samples, collections = universe
+
+        records = db.fetch_values("insert into receiving.manifest (document) values %s returning manifest_id as id, document",
+            [ (Json(document),) for document in documents(samples, collections, round) ])
+
+        process(records)
+
+        return records
+
+    def results(universe, records):
+        """
+        Returns the processing log entry of each of *records* and the sample
+        it names, with barcodes replaced by their position among the
+        universe's.  Each record is processed once, so has one entry.
+        """
+        _, _, samples, collections = universe
+        positions = {
+            **{ barcode: f"sample {n}" for n, barcode in enumerate(samples) },
+            **{ barcode: f"collection {n}" for n, barcode in enumerate(collections) },
+        }
+
+        rows = db.fetch_all("""
+            select (processing_log->0) - 'timestamp' - 'sample_id' as entry,
+                   (select barcode from warehouse.identifier where uuid = sample.identifier::uuid) as sample,
+                   (select barcode from warehouse.identifier where uuid = sample.collection_identifier::uuid) as collection,
+                   sample.collected,
+                   sample.details,
+                   sample.content_digest is not null as digested
+              from receiving.manifest
+              left join warehouse.sample on (sample_id = (processing_log->0->>'sample_id')::integer)
+             where manifest_id = any(%s)
+             order by manifest_id
+            """, ([ record.id for record in records ],))
+
+        return [
+            (row.entry, positions.get(row.sample), positions.get(row.collection), row.collected, row.details, row.digested)
+                for row in rows ]
+
+    for round in [1, 2]:
+        serial_records = load(serial, round,
+            lambda records: process_manifest_records_serially(db, records, expected_identifier_sets, 1))
+
+        bulk_records = load(bulk, round,
+            lambda records: load_manifest_batch(db, records, expected_identifier_sets))
+
+        assert results(bulk, bulk_records) == results(serial, serial_records)
+        assert len(results(bulk, bulk_records)) == len(bulk_records)
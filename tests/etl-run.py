@@ -0,0 +1,99 @@
+import click
+import pytest
+from click.testing import CliRunner
+from psycopg2 import OperationalError
+from unittest.mock import MagicMock
+from id3c.cli.command import with_database_session
+from id3c.cli.command.etl import etl
+from id3c.db.session import DatabaseSession
+import id3c.cli.command.etl.run as run
+
+
+class Stop(BaseException):
+    """
+    Raised by the fake routine to end ``--follow``, as it isn't an
+    :class:`Exception` which ``id3c etl run`` logs and carries on from.
+    """
+
+
+def test_follow(monkeypatch):
+    sessions = []
+
+    def connect():
+        session = MagicMock()
+        session.connection.closed = 0
+        sessions.append(session)
+        return session
+
+    monkeypatch.setattr(run, "DatabaseSession", connect)
+    monkeypatch.setattr(run, "sleep", lambda seconds: None)
+
+    # The first listener loses its connection when woken.
+    polls = iter([ OperationalError("server closed the connection unexpectedly") ])
+
+    def poll():
+        error = next(polls, None)
+        if error:
+            raise error
+
+    # Every wake brings a notification of records received into fhir.
+    def select(readable, writable, exceptional, timeout):
+        connection, = readable
+        connection.poll.side_effect = poll
+        connection.notifies = [ MagicMock(payload = "fhir") ]
+        return readable, [], []
+
+    monkeypatch.setattr(run.select, "select", select)
+
+    # The routine's second run loses its connection, its fourth stops.
+    runs = []
+
+    def main(arguments, obj, **kwargs):
+        runs.append(obj)
+
+        if len(runs) == 2:
+            obj.connection.closed = 2
+            raise OperationalError("server closed the connection unexpectedly")
+
+        if len(runs) == 4:
+            raise Stop()
+
+    routine = MagicMock(main = main)
+    monkeypatch.setattr(run, "find_command", lambda ctx, name: routine)
+
+    with pytest.raises(Stop):
+        CliRunner().invoke(etl, ["run", "fhir", "--follow", "--commit"], catch_exceptions = False)
+
+    listeners = [ session for session in sessions if session not in runs ]
+
+    # Listening again after the lost connection.
+    assert len(listeners) == 2
+
+    for listener in listeners:
+        listener.cursor().__enter__().execute.assert_called_with(f"listen {run.CHANNEL}")
+
+    assert listeners[0].close.called
+
+    # The routine keeps its session between runs until its connection is lost.
+    assert runs[0] is runs[1]
+    assert runs[1] is not runs[2]
+    assert runs[2] is runs[3]
+    assert runs[1].close.called
+
+
+def test_session_reused():
+    """
+    Commands use the session they're invoked with as their context object.
+    """
+    @click.command
+    @with_database_session(periodic_commits = True)
+    def command(db):
+        assert db is session
+        assert db.commit_every == 25
+
+    session = MagicMock(spec = DatabaseSession)
+
+    command.main(["--commit", "--commit-every", "25"], standalone_mode = False, obj = session)
+
+    session.commit.assert_called_once_with()
+    session.close.assert_not_called()
@@ -0,0 +1,47 @@
+import pytest
+from psycopg2.errors import DivisionByZero
+from id3c.cli.command.etl import savepoint_batches
+
+
+@pytest.mark.parametrize("batch_size", [1, 4, 20])
+def test_savepoint_batches(db, batch_size):
+    """
+    Records processed in batched savepoints leave the same rows and raise the
+    same errors as records processed each in their own savepoint, including
+    after errors which abort the transaction.
+    """
+    with db.cursor() as cursor:
+        cursor.execute("create temporary table processed (n integer primary key)")
+
+    attempts = []
+    failed = []
+
+    for n, savepoint in savepoint_batches(db, range(1, 11), str, batch_size):
+        try:
+            with savepoint, db.cursor() as cursor:
+                attempts.append(n)
+
+                # A record's changes are kept only if it's processed without
+                # error, and only once, or the primary key would be violated.
+                cursor.execute("insert into processed (n) values (%s)", (n,))
+
+                if n == 3:
+                    raise ValueError(f"record {n}")
+
+                if n in {7, 8}:
+                    cursor.execute("select 1/0")
+
+        except Exception as error:
+            failed.append((n, type(error)))
+
+    assert failed == [(3, ValueError), (7, DivisionByZero), (8, DivisionByZero)]
+
+    assert [ row.n for row in db.fetch_all("select n from processed order by n") ] \
+        == [1, 2, 4, 5, 6, 9, 10]
+
+    # Records are processed again only after an error in their batch.
+    if batch_size == 1:
+        assert attempts == list(range(1, 11))
+    else:
+        assert sorted(set(attempts)) == list(range(1, 11))
+        assert len(attempts) > 10
@@ -0,0 +1,98 @@
+from pathlib import Path
+from sqlparse import parse, split
+from sqlparse.tokens import Keyword
+from id3c.db.datatypes import Json
+
+topdir = Path(__file__).resolve().parent.parent
+
+
+def run_script(db, kind, change):
+    """
+    Runs the *kind* (deploy, revert or verify) script of the Sqitch *change*
+    within the session's transaction, without the script's own begin and
+    commit or rollback.
+    """
+    script = topdir / "schema" / kind / f"{change}.sql"
+    statements = split(script.read_text(encoding = "utf-8"))
+
+    assert parse(statements[0])[0].token_first(skip_cm = True).match(Keyword, ["begin"])
+
+    with db.cursor() as cursor:
+        cursor.execute("\n".join(statements[1:-1]))
+
+
+def test_revert_and_deploy(db):
+    """
+    Reverting and redeploying receiving/partitions must keep every record,
+    its id, and the queues of pending records.  Everything is rolled back
+    afterwards.
+    """
+    etl_id = db.fetch_row("""
+        select receiving.register_etl('manifest', 'test-partitions', %s) as etl_id
+        """, (Json({"etl": "test-partitions", "revision": 1}),)).etl_id
+
+    with db.cursor() as cursor:
+        cursor.execute("""
+            insert into receiving.manifest (document, received)
+                values ('{"n": 1}', '2019-12-15 12:00:00+00'),
+                       ('{"n": 2}', '2020-01-15 12:00:00+00'),
+                       ('{"n": 3}', now())
+            """)
+
+        cursor.execute("""
+            update receiving.manifest
+               set processing_log = processing_log || '[{"etl": "test-partitions", "revision": 1}]'
+             where document::jsonb = '{"n": 2}'
+            """)
+
+    def snapshot():
+        return (
+            db.fetch_all("""
+                select manifest_id, document::text, received, processing_log
+                  from receiving.manifest
+                 order by manifest_id
+                """),
+            db.fetch_all("""
+                select record_id
+                  from receiving.pending
+                 where etl_id = %s
+                 order by record_id
+                """, (etl_id,)),
+        )
+
+    def relkind():
+        return db.fetch_row("select relkind from pg_class where oid = 'receiving.manifest'::regclass").relkind
+
+    before = snapshot()
+
+    assert relkind() == "p"
+    assert len(before[1]) == 2
+
+    run_script(db, "revert", "receiving/notify-received")
+    run_script(db, "revert", "receiving/partitions")
+
+    assert relkind() == "r"
+    assert snapshot() == before
+
+    run_script(db, "deploy", "receiving/partitions")
+    run_script(db, "deploy", "receiving/notify-received")
+    run_script(db, "verify", "receiving/partitions")
+    run_script(db, "verify", "receiving/notify-received")
+
+    assert relkind() == "p"
+    assert snapshot() == before
+
+    # The oldest record got a partition for its month.
+    assert db.fetch_row("""
+        select tableoid = 'receiving.manifest_2019_12'::regclass as partitioned
+          from receiving.manifest
+         where manifest_id = %s
+        """, (before[0][0].manifest_id,)).partitioned
+
+    # New records still get new ids and are queued.
+    with db.cursor() as cursor:
+        cursor.execute("insert into receiving.manifest (document) values ('{\"n\": 4}') returning manifest_id")
+        manifest_id, = cursor.fetchone()
+
+    assert manifest_id > max(row.manifest_id for row in before[0])
+    assert (manifest_id,) in snapshot()[1]
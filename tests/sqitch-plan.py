@@ -2,6 +2,7 @@ import pytest
 import re
 from os import environ
 from pathlib import Path
+from sqlparse import format as format_sql, split
 
 GITHUB_EVENT_NAME = environ.get("GITHUB_EVENT_NAME", "")
 GITHUB_REF = environ.get("GITHUB_REF", "")
@@ -14,17 +15,18 @@ testing_master = (
     or GITHUB_EVENT_NAME == "pull_request"
 )
 
-# Only test on master, since we only care that master always has a sqitch tag
-# as the final sqitch plan element.  This avoids spurious failures on branches
-# which add the tag as their last commit.
-if not testing_master:
-    pytest.skip("skipping master-only test", allow_module_level = True)
-
-
 topdir = Path(__file__).resolve().parent.parent
 plan = topdir / "schema/sqitch.plan"
 
+# Changes planned up to this tag predate checking their requires headers and
+# verify scripts, and not all of them would pass.
+checked_after = "@2023-08-21"
 
+
+# Only test on master, since we only care that master always has a sqitch tag
+# as the final sqitch plan element.  This avoids spurious failures on branches
+# which add the tag as their last commit.
+@pytest.mark.skipif(not testing_master, reason = "skipping master-only test")
 def test_sqitch_plan():
     change_or_tag_lines = [
         line.strip()
@@ -42,3 +44,74 @@ def param_comment_or_blank(line):
     """
     return re.search(r'^\s*([%#]|$)', line)
 
+
+
+def plan_entries():
+    """
+    Yields a (name, dependencies) pair for each change and tag in the plan, in
+    order.  Tags have no dependencies.
+    """
+    for line in plan.read_text(encoding = "utf-8").splitlines():
+        if param_comment_or_blank(line):
+            continue
+
+        name, dependencies = re.search(r'^\s*(\S+)(?:\s+\[([^\]]*)\])?', line).groups()
+
+        yield name, (dependencies or "").split()
+
+
+def test_planned_scripts():
+    planned = set()
+    tag = None
+
+    for name, _ in plan_entries():
+        if name.startswith("@"):
+            tag = name
+            continue
+
+        for kind in ["deploy", "revert", "verify"]:
+            script = topdir / "schema" / kind / f"{name}.sql"
+            assert script.exists(), f"{name} is planned, but {script.relative_to(topdir)} doesn't exist"
+
+            # Sqitch runs the scripts of a reworked change's previous version
+            # from copies named for the last tag before the rework.
+            if name in planned:
+                script = topdir / "schema" / kind / f"{name}{tag}.sql"
+                assert script.exists(), f"{name} is reworked after {tag}, but {script.relative_to(topdir)} doesn't exist"
+
+        planned.add(name)
+
+
+def checked_changes():
+    """
+    Yields the (name, dependencies) pair of each change planned after
+    :data:`checked_after`.
+    """
+    checked = False
+
+    for name, dependencies in plan_entries():
+        if name.startswith("@"):
+            checked |= name == checked_after
+        elif checked:
+            yield name, dependencies
+
+
+def test_planned_requires():
+    for name, dependencies in checked_changes():
+        script = topdir / "schema/deploy" / f"{name}.sql"
+        requires = re.findall(r'^-- requires: (\S+)', script.read_text(encoding = "utf-8"), re.MULTILINE)
+
+        assert sorted(requires) == sorted(dependencies), \
+            f"{script.relative_to(topdir)} requires {requires}, but {plan.relative_to(topdir)} says {dependencies}"
+
+
+def test_verify_scripts():
+    for name, _ in checked_changes():
+        script = topdir / "schema/verify" / f"{name}.sql"
+
+        checks = [
+            statement
+                for statement in split(format_sql(script.read_text(encoding = "utf-8"), strip_comments = True))
+                 if not re.search(r'^(begin|rollback|set\s+local)\b', statement, re.IGNORECASE) ]
+
+        assert checks, f"{script.relative_to(topdir)} doesn't verify anything"